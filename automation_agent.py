@@ -1,27 +1,41 @@
 import os
+import re
+import asyncio
+import functools
+import threading
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
 from langchain.agents import AgentExecutor, create_tool_calling_agent
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.tools import tool # Importa el decorador @tool
-from langchain_core.messages import HumanMessage, AIMessage # Importar para el historial de chat
-import traceback
+from langchain_core.caches import InMemoryCache
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage # Importar para el historial de chat
 from typing import List, Dict, Any, Tuple, Optional, Union
 import time
 import pyautogui
 import uuid # Para generar nombres de archivos únicos
-import tempfile # Para manejar directorios temporales de forma segura
 from PIL import Image # NECESARIO: Importar PIL para trabajar con imágenes para OCR
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 # Importar las clases y funciones necesarias de nuestros módulos
-from qdrant_handler import QdrantHandler
-from image_processor import ImageProcessor
+from qdrant_handler import QdrantHandler, BatchedSearcher
+from image_processor import ImageProcessor, EMBEDDING_DIMENSION
 # Asumo que take_screenshot devuelve PIL.Image y find_image_on_screen puede tomar PIL.Image directamente
-from utils.screen_utils import take_screenshot, find_image_on_screen 
-from plc_handler import PLCHandler, PLCConnectionError, PLCReadWriteError
+from utils.screen_utils import Box, take_screenshot, take_screenshot_gray, find_image_on_screen, find_image_near 
+from plc_handler import PLCHandler, PLCConnectionError, PLCReadWriteError, S7Item, S7Write, S7_AREA_DB, DATA_TYPE_SIZES
+from utils.log_utils import get_logger
+from utils.http_utils import openai_http_client, openai_async_http_client
 
 load_dotenv()
 
+# PyAutoGUI duerme PAUSE segundos (0.1 por defecto) después de cada llamada; las herramientas ya
+# esperan explícitamente donde la UI lo necesita, así que esa pausa global solo añade latencia.
+pyautogui.PAUSE = 0
+
+# Logger asíncrono (ver utils/log_utils.py): los mensajes se formatean y escriben en un hilo aparte
+log = get_logger("automation_agent")
+
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY debe estar configurado en el archivo .env")
@@ -29,68 +43,463 @@ if not OPENAI_API_KEY:
 # Inicializar los handlers necesarios
 # Estas instancias se inicializan una única vez al cargar el módulo
 qdrant_handler = QdrantHandler()
+qdrant_searcher = BatchedSearcher(qdrant_handler) # Agrupa búsquedas concurrentes en una sola petición
 image_processor = ImageProcessor()
+
+# El modelo de embeddings y la colección deben tener la misma dimensión: se comprueba una sola vez aquí,
+# con la dimensión declarada (sin cargar el modelo; ImageProcessor valida la real al cargarlo)
+if EMBEDDING_DIMENSION != qdrant_handler.VECTOR_DIMENSION:
+    raise ValueError(
+        f"El modelo de embeddings genera vectores de {EMBEDDING_DIMENSION} dimensiones, "
+        f"pero la colección de Qdrant espera {qdrant_handler.VECTOR_DIMENSION}."
+    )
 plc_handler = PLCHandler()
 
+# Límites del bucle del agente: acotan la latencia y el gasto de tokens si una herramienta
+# devuelve algo que hace que el LLM entre en un bucle de llamadas.
+AGENT_MAX_ITERATIONS = int(os.getenv("AGENT_MAX_ITERATIONS", 6))
+AGENT_MAX_EXECUTION_TIME = float(os.getenv("AGENT_MAX_EXECUTION_TIME", 45)) # segundos
+AGENT_VERBOSE = os.getenv("AGENT_VERBOSE", "false").lower() in ("1", "true", "yes")
+# Cada observación de herramienta vuelve al prompt en todas las iteraciones siguientes del bucle: solo las
+# SCRATCHPAD_FULL_STEPS más recientes se envían completas; las anteriores se recortan a SCRATCHPAD_OBSERVATION_CHARS
+# caracteres (se conserva la llamada a la herramienta y el SUCCESS/ERROR, que es lo que el modelo necesita).
+SCRATCHPAD_FULL_STEPS = int(os.getenv("SCRATCHPAD_FULL_STEPS", 2))
+SCRATCHPAD_OBSERVATION_CHARS = int(os.getenv("SCRATCHPAD_OBSERVATION_CHARS", 160))
+# Calentar en segundo plano las conexiones (OpenAI, Qdrant) y el modelo de embeddings al crear el agente
+AGENT_WARMUP = os.getenv("AGENT_WARMUP", "true").lower() in ("1", "true", "yes")
+
+# Caché de respuestas del LLM por coincidencia exacta de prompt (modelo + mensajes, incluido el historial
+# y los resultados de herramientas): con temperature=0, la misma instrucción en el mismo contexto produce
+# el mismo plan, así que se reutiliza sin otra llamada a OpenAI. Cualquier resultado de herramienta distinto
+# (otra lectura de PLC, otra hora) cambia el prompt y provoca una llamada nueva.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "true").lower() in ("1", "true", "yes")
+_llm_cache = InMemoryCache(maxsize=int(os.getenv("LLM_CACHE_SIZE", 256))) if LLM_CACHE_ENABLED else None
+
+
+def _chat_model(model_name: str, temperature: float) -> ChatOpenAI:
+    """Crea un ChatOpenAI que usa los clientes HTTP compartidos y, con temperature=0, la caché de respuestas."""
+    return ChatOpenAI(
+        model=model_name,
+        temperature=temperature,
+        http_client=openai_http_client, # Clientes HTTP compartidos (router, planner, resumen, visión)
+        http_async_client=openai_async_http_client,
+        # Con temperature > 0 la respuesta no es determinista: no cachear
+        cache=_llm_cache if _llm_cache is not None and temperature == 0 else False,
+    )
+
+
+# Modelos del agente: el router (rápido y barato) atiende las tareas normales; el planner se usa
+# para instrucciones complejas (ver _needs_planner) o si el router responde ESCALATE, falla o se queda sin iteraciones.
+ROUTER_MODEL = os.getenv("ROUTER_MODEL", "gpt-4o-mini")
+PLANNER_MODEL = os.getenv("PLANNER_MODEL", "gpt-4o")
+PLANNER_ESCALATION_LENGTH = int(os.getenv("PLANNER_ESCALATION_LENGTH", 400))
+ESCALATE_TOKEN = "ESCALATE"
+# Indicios de que la instrucción requiere planificar varios pasos: palabras clave explícitas,
+# o varios conectores de secuencia ("abre X, luego Y y después Z")
+_PLANNER_KEYWORDS_RE = re.compile(r'\b(complej[oa]s?|planifica\w*|paso a paso|escribe (el|un) (código|programa))\b', re.IGNORECASE)
+_SEQUENCE_MARKERS_RE = re.compile(r'\b(luego|después|despues|a continuación|a continuacion|finalmente|por último|y por ultimo)\b', re.IGNORECASE)
+PLANNER_SEQUENCE_MARKERS = 2
+# Salida de AgentExecutor cuando se agotan las iteraciones o el tiempo (early_stopping_method="force")
+_AGENT_STOPPED_PREFIX = "Agent stopped"
+
+# Comandos estructurados de PLC (ej. 'WRITE DB1.DBW10 INT 123', 'READ DB1.DBX0.3 BOOL'):
+# se ejecutan directamente sobre plc_handler, sin pasar por el LLM.
+_PLC_CMD_RE = re.compile(
+    r'^\s*(READ|WRITE)\s+DB(\d+)\.DB([BWDX])(\d+)(?:\.(\d+))?\s+(BOOL|INT|REAL)(?:\s+(.+?))?\s*$',
+    re.IGNORECASE,
+)
+_BOOL_TRUE = {"1", "TRUE", "ON", "VERDADERO"}
+_BOOL_FALSE = {"0", "FALSE", "OFF", "FALSO"}
+
+# Historial de chat acotado: al superar HISTORY_MAX_MESSAGES, los mensajes más antiguos se resumen
+# en un único SystemMessage y solo se conservan literalmente los HISTORY_KEEP_MESSAGES más recientes.
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", 12))
+HISTORY_KEEP_MESSAGES = int(os.getenv("HISTORY_KEEP_MESSAGES", 6))
+# Además del número de mensajes, se acota el tamaño: unas pocas respuestas largas (OCR, lecturas
+# de PLC en lote) bastan para inflar el prompt. Estimación barata: ~4 caracteres por token.
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", 1500))
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "gpt-4o-mini")
+HISTORY_SUMMARY_PREFIX = "Resumen de la conversación anterior: "
+
 # Definir la carpeta temporal para el agente si es necesaria, aunque take_screenshot ya la usa internamente
 # para las imágenes que necesita PyAutoGUI
 AGENT_TEMP_DIR = "agent_temp_files"
 os.makedirs(AGENT_TEMP_DIR, exist_ok=True)
 
+# Pool para capturar la pantalla en segundo plano mientras se calcula el embedding y se consulta Qdrant.
+# Ambas operaciones son de E/S (mss / red) y liberan el GIL, así que se solapan de verdad.
+_screenshot_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="screenshot")
+
+# Última captura por monitor: si otra herramienta la pide dentro de SCREENSHOT_MAX_AGE segundos y no ha
+# habido clics ni escritura desde entonces, la pantalla no ha podido cambiar por acción del agente.
+SCREENSHOT_MAX_AGE = float(os.getenv("SCREENSHOT_MAX_AGE", 0.3))
+_LAST_SHOT: Dict[Optional[int], Tuple[float, np.ndarray]] = {}
+_last_shot_lock = threading.Lock()
+
+# Con ainvoke, LangChain puede ejecutar en paralelo varias herramientas de un mismo paso. Las que usan
+# el ratón y el teclado no pueden solaparse: cada secuencia captura-localizar-clic/escribir es exclusiva.
+_ui_lock = threading.RLock()
+# Se incrementa tras cada clic/escritura: permite saber si una captura tomada antes de adquirir _ui_lock sigue vigente
+_ui_generation = 0
+
+# Última posición en pantalla de cada elemento clicado: (descripción normalizada, monitor) -> (recorte, Box, instante).
+# Si se vuelve a pedir el mismo elemento antes de POSITION_CACHE_TTL segundos, basta comprobar el recorte en esa
+# posición (matchTemplate sobre un área del tamaño del recorte) y clicar, sin embedding, Qdrant ni búsqueda completa.
+# Se vacía tras escribir texto en la UI o ante cualquier error de localización.
+POSITION_CACHE_TTL = float(os.getenv("POSITION_CACHE_TTL", 3.0))
+_position_cache: Dict[Tuple[str, Optional[int]], Tuple[str, Box, float]] = {}
+
+
+def _get_screenshot(monitor_id: Optional[int]) -> Optional[np.ndarray]:
+    """
+    Devuelve una captura del monitor en escala de grises, reutilizando la última si tiene menos de
+    SCREENSHOT_MAX_AGE segundos. Se convierte a grises una sola vez al capturar: todas las búsquedas de
+    recortes que reutilizan la captura trabajan ya sobre un solo canal.
+    """
+    now = time.monotonic()
+    with _last_shot_lock:
+        taken_at, image = _LAST_SHOT.get(monitor_id, (0.0, None))
+    if image is not None and now - taken_at < SCREENSHOT_MAX_AGE:
+        log.debug("Reutilizando captura del monitor %s tomada hace %.0f ms.", monitor_id, (now - taken_at) * 1000)
+        return image
+
+    image = take_screenshot_gray(monitor_number=monitor_id)
+    if image is not None:
+        with _last_shot_lock:
+            _LAST_SHOT[monitor_id] = (now, image)
+    return image
+
+
+def _invalidate_screenshots():
+    """Descarta las capturas recientes: tras un clic o escritura la UI probablemente ha cambiado."""
+    global _ui_generation
+    with _last_shot_lock:
+        _LAST_SHOT.clear()
+        _ui_generation += 1
+
+
+def _search_text(text: str, limit: int = 1) -> list:
+    """
+    Embedding (cacheado) + búsqueda en Qdrant en una sola llamada. La dimensión del modelo se valida
+    una vez al cargar el módulo, no en cada consulta.
+    Returns:
+        list: Resultados de Qdrant (ScoredPoint); vacía si el embedding no se pudo generar.
+    """
+    # ImageProcessor cachea los embeddings (memoria + disco) por texto normalizado
+    query_embedding = image_processor.generate_embedding_from_text(text)
+    if not query_embedding.any():
+        # generate_embedding_from_text devuelve ceros si el modelo falla: no tiene sentido buscar con él
+        log.error("No se pudo generar el embedding para: '%s'", text[:50])
+        return []
+    return qdrant_searcher.search(query_embedding, limit=limit)
+
+
+def _search_texts(texts: list, limit: int = 1) -> list:
+    """
+    Versión por lotes de _search_text: embeddings en un solo lote y una sola petición a Qdrant.
+    Returns:
+        list: Por cada texto, en el mismo orden, sus resultados de Qdrant, o None si su embedding no se pudo
+              generar (esas filas de ceros no se envían a Qdrant).
+    """
+    query_embeddings = image_processor.generate_embeddings_from_texts(texts)
+    results = [None] * len(texts)
+    valid = []
+    for i, query_embedding in enumerate(query_embeddings):
+        if query_embedding.any():
+            valid.append(i)
+        else:
+            log.error("No se pudo generar el embedding para: '%s'", texts[i][:50])
+    if valid:
+        batch_results = qdrant_handler.search_batch([query_embeddings[i] for i in valid], limit=limit)
+        for i, search_results in zip(valid, batch_results):
+            results[i] = search_results
+    return results
+
+
+def _click_clipping(clipping_file_path: str, description: str, monitor_id: Optional[int], confidence: float,
+                    screenshot: Optional[np.ndarray] = None, double_click: bool = False) -> str:
+    """
+    Toma una captura de pantalla, localiza en ella el recorte indicado y hace clic en su centro.
+    Compartido por las herramientas de clic individual y por lotes.
+    Args:
+        screenshot (np.ndarray, optional): Captura en grises ya tomada (p. ej. en paralelo con la búsqueda en Qdrant).
+                                           Si es None, se toma una nueva.
+        double_click (bool): Doble clic en lugar de clic simple (para abrir programas/carpetas).
+    Returns:
+        str: 'SUCCESS: ...' o 'ERROR: ...', con el mismo formato que devuelven las herramientas.
+    """
+    # 3. Tomar captura de pantalla actual (si no se ha tomado ya)
+    current_screenshot_image = screenshot
+    if current_screenshot_image is None:
+        log.debug("Tomando captura de pantalla del monitor %s.", monitor_id if monitor_id is not None else 'principal')
+        # Captura como np.ndarray en grises, sin pasar por PIL (reutilizada si es muy reciente)
+        current_screenshot_image = _get_screenshot(monitor_id)
+    
+    if current_screenshot_image is None:
+        return f"ERROR: No se pudo tomar una captura de pantalla del monitor {monitor_id if monitor_id is not None else 'principal'}."
+
+    # 4. Localizar el recorte en la captura de pantalla (en memoria, sin archivo temporal)
+    location = find_image_on_screen(clipping_file_path, current_screenshot_image, confidence=confidence)
+
+    if location:
+        _position_cache[(description.strip().lower(), monitor_id)] = (clipping_file_path, location, time.monotonic())
+        return _click_at(location, description, double_click)
+    elif not os.path.exists(clipping_file_path):
+        # Solo tras fallar la búsqueda se comprueba si el recorte existe, para dar un error más útil
+        log.error("La ruta de imagen del recorte no es válida o no existe: %s", clipping_file_path)
+        return f"ERROR: La ruta de imagen del recorte no es válida o no existe: {clipping_file_path}. Por favor, verifica la carpeta 'clippings'."
+    else:
+        log.warning("No se pudo localizar '%s' en la pantalla actual con confianza %s.", description, confidence)
+        return f"ERROR: No se pudo localizar '{description}' en la pantalla actual con confianza {confidence}. Intenta ajustar la descripción o la confianza."
+
+
+def _click_at(location: Box, description: str, double_click: bool = False) -> str:
+    """Hace clic (o doble clic) en el centro de 'location' y devuelve el mensaje 'SUCCESS: ...' de la herramienta."""
+    center_x = location.left + location.width / 2
+    center_y = location.top + location.height / 2
+
+    # Un solo click suele ser suficiente para botones/iconos, 
+    # pero doubleClick puede ser necesario para abrir carpetas/programas.
+    # El agente decide si es necesario un doble clic basado en el contexto (parámetro double_click).
+    if double_click:
+        pyautogui.doubleClick(center_x, center_y)
+    else:
+        pyautogui.click(center_x, center_y)
+    _invalidate_screenshots()
+
+    click_kind = "Doble clic" if double_click else "Clic"
+    log.debug("%s ejecutado en (%s, %s) para: '%s'", click_kind, center_x, center_y, description)
+    return f"SUCCESS: {click_kind} ejecutado en '{description}'."
+
+
+def _click_cached_position(description: str, monitor_id: Optional[int], confidence: float,
+                           double_click: bool = False) -> Optional[str]:
+    """
+    Camino rápido de _locate_and_click: si el elemento se clicó hace menos de POSITION_CACHE_TTL segundos
+    y el recorte sigue en esa posición, hace clic directamente. Debe llamarse con _ui_lock adquirido.
+    Returns:
+        str: Mensaje 'SUCCESS: ...' si se hizo clic, o None si hay que seguir el camino completo.
+    """
+    key = (description.strip().lower(), monitor_id)
+    hit = _position_cache.get(key)
+    if hit is None:
+        return None
+    clipping_file_path, box, found_at = hit
+    if time.monotonic() - found_at >= POSITION_CACHE_TTL:
+        _position_cache.pop(key, None)
+        return None
+
+    screenshot = _get_screenshot(monitor_id)
+    location = find_image_near(clipping_file_path, screenshot, box, confidence) if screenshot is not None else None
+    if location is None:
+        _position_cache.pop(key, None)
+        return None
+    log.debug("Posición de '%s' reutilizada (verificada en %s).", description, location)
+    _position_cache[key] = (clipping_file_path, location, time.monotonic())
+    return _click_at(location, description, double_click)
+
+
+def _run_plc_command(match: re.Match) -> str:
+    """
+    Ejecuta un comando estructurado de PLC reconocido por _PLC_CMD_RE.
+    Returns:
+        str: 'SUCCESS: ...' o 'ERROR: ...', con el mismo formato que las herramientas de PLC.
+    """
+    operation, db_number, area_letter, byte_offset, bit_offset, data_type, raw_value = match.groups()
+    operation, area_letter, data_type = operation.upper(), area_letter.upper(), data_type.upper()
+    db_number, byte_offset = int(db_number), int(byte_offset)
+    bit_offset = int(bit_offset) if bit_offset is not None else None
+    address = f"DB{db_number}.DB{area_letter}{byte_offset}{f'.{bit_offset}' if bit_offset is not None else ''}"
+
+    if data_type == "BOOL" and (area_letter != "X" or bit_offset is None):
+        return f"ERROR: Para 'BOOL' use una dirección de bit (ej. DB{db_number}.DBX{byte_offset}.0)."
+    if data_type != "BOOL" and bit_offset is not None:
+        return f"ERROR: La dirección {address} incluye un bit, pero el tipo '{data_type}' no es BOOL."
+
+    try:
+        if operation == "READ":
+            if raw_value:
+                return f"ERROR: READ no admite valor ('{raw_value}')."
+            if data_type == "BOOL":
+                value = plc_handler.read_bool(db_number, byte_offset, bit_offset)
+            elif data_type == "INT":
+                value = plc_handler.read_int(db_number, byte_offset)
+            else:
+                value = plc_handler.read_real(db_number, byte_offset)
+            return f"SUCCESS: Valor leído de PLC ({data_type}, {address}): {value}"
+
+        if raw_value is None:
+            return f"ERROR: WRITE requiere un valor (ej. 'WRITE {address} {data_type} 1')."
+        if data_type == "BOOL":
+            token = raw_value.strip().upper()
+            if token not in _BOOL_TRUE | _BOOL_FALSE:
+                return f"ERROR: Valor '{raw_value}' no es compatible con el tipo de dato 'BOOL'."
+            value = token in _BOOL_TRUE
+            success = plc_handler.write_bool(db_number, byte_offset, bit_offset, value)
+        elif data_type == "INT":
+            value = int(raw_value)
+            success = plc_handler.write_int(db_number, byte_offset, value)
+        else:
+            value = float(raw_value.replace(",", "."))
+            success = plc_handler.write_real(db_number, byte_offset, value)
+
+        if success:
+            return f"SUCCESS: Valor '{value}' escrito en PLC ({data_type}, {address})."
+        return f"ERROR: Falló la escritura en PLC para {data_type} con valor {value}."
+    except (PLCConnectionError, PLCReadWriteError) as plc_err:
+        return f"ERROR PLC: {plc_err}"
+    except ValueError as ve:
+        return f"ERROR: Valor '{raw_value}' no es compatible con el tipo de dato '{data_type}': {ve}"
+
+
+def _needs_planner(instruction: str) -> bool:
+    """
+    Heurística barata para decidir si una instrucción va directamente al modelo planner:
+    instrucciones largas, con palabras clave de planificación o con varios pasos encadenados.
+    """
+    if len(instruction) > PLANNER_ESCALATION_LENGTH:
+        return True
+    if _PLANNER_KEYWORDS_RE.search(instruction):
+        return True
+    return len(_SEQUENCE_MARKERS_RE.findall(instruction)) >= PLANNER_SEQUENCE_MARKERS
+
+
+def _router_gave_up(final_output: Any) -> bool:
+    """True si el router pidió escalar o agotó sus iteraciones/tiempo sin terminar la tarea."""
+    output = str(final_output).strip()
+    return output.upper().startswith(ESCALATE_TOKEN) or output.startswith(_AGENT_STOPPED_PREFIX)
+
+
+def _locate_and_click(description: str, monitor_id: Optional[int] = None, confidence: float = 0.8,
+                      double_click: bool = False) -> Tuple[bool, str]:
+    """
+    Lógica de search_and_click_ui_element como función Python normal, para que otras herramientas
+    (p. ej. write_text_ui) la llamen directamente sin pasar por la validación y los callbacks de LangChain.
+    Returns:
+        tuple: (éxito, mensaje 'SUCCESS: ...' o 'ERROR: ...')
+    """
+    log.debug("Descripción recibida: '%s'", description)
+    log.debug("monitor_id: %s, confidence: %s", monitor_id, confidence)
+
+    try:
+        # Elemento clicado hace un momento y que sigue en el mismo sitio: sin embedding, Qdrant ni búsqueda completa
+        with _ui_lock:
+            result = _click_cached_position(description, monitor_id, confidence, double_click)
+        if result is not None:
+            return True, result
+
+        # La captura no depende de la búsqueda: lanzarla ya para que se solape con el embedding y Qdrant
+        log.debug("Tomando captura de pantalla del monitor %s en segundo plano.", monitor_id if monitor_id is not None else 'principal')
+        generation = _ui_generation
+        screenshot_future = _screenshot_executor.submit(_get_screenshot, monitor_id)
+
+        # 1 y 2. Embedding de la instrucción (cacheado) y búsqueda de recortes relevantes en Qdrant
+        log.debug("Buscando en Qdrant para: '%s'", description)
+        search_results = _search_text(description, limit=1)
+
+        if not search_results:
+            log.warning("No se encontraron recortes relevantes en Qdrant para: '%s'.", description)
+            return False, f"ERROR: No se encontraron recortes relevantes en Qdrant para: '{description}'. Asegúrate de que el recorte esté ingresado y la descripción sea precisa."
+
+        best_match = search_results[0]
+        clipping_file_path = best_match.payload.get("image_path")
+
+        log.debug("Mejor coincidencia en Qdrant (score: %.4f): %s (Path: %s)", best_match.score, best_match.payload.get('description'), clipping_file_path)
+
+        # La ruta la genera la ingesta: no se comprueba en disco en cada clic, solo si el recorte
+        # no se localiza (ver _click_clipping)
+        if not clipping_file_path:
+            log.error("El recorte de Qdrant no tiene ruta de imagen: %s", best_match.id)
+            return False, "ERROR: El recorte encontrado en Qdrant no tiene ruta de imagen. Por favor, vuelve a ingresarlo."
+
+        # 3 y 4. Recoger la captura tomada en paralelo, localizar el recorte y hacer clic.
+        # Solo esta parte es exclusiva: el embedding y la búsqueda pueden solaparse con otras herramientas.
+        with _ui_lock:
+            current_screenshot_image = screenshot_future.result()
+            if generation != _ui_generation:
+                # Otra herramienta ha hecho clic mientras se buscaba: la captura anticipada ya no vale
+                current_screenshot_image = _get_screenshot(monitor_id)
+            if current_screenshot_image is None:
+                return False, f"ERROR: No se pudo tomar una captura de pantalla del monitor {monitor_id if monitor_id is not None else 'principal'}."
+            result = _click_clipping(clipping_file_path, description, monitor_id, confidence,
+                                     screenshot=current_screenshot_image, double_click=double_click)
+        if not result.startswith("SUCCESS"):
+            _position_cache.clear()
+        return result.startswith("SUCCESS"), result
+
+    except Exception as e:
+        log.exception("Error no controlado en _locate_and_click")
+        _position_cache.clear()
+        return False, f"ERROR: Ocurrió un error en search_and_click_ui_element: {e}"
+
 
 class AutomationAgent:
-    def __init__(self):
-        # Utilizar el modelo "gpt-4o" para un mejor rendimiento
-        self.llm = ChatOpenAI(model="gpt-4o", temperature=0) 
-        
-        # Definir las herramientas que el agente de LangChain puede usar
-        self.tools = self._define_tools() # Llama al método para obtener la lista de herramientas
-        
-        # Definir el prompt del agente
-        self.prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", 
-                "Eres un asistente experto en automatización de interfaces de usuario y control de PLCs Siemens S7-1200. "
-                "Tu objetivo es ayudar al usuario a realizar tareas complejas en Windows y en el PLC. "
-                "Utiliza las herramientas disponibles para lograr los objetivos. "
-                "Prioriza siempre el uso de las herramientas para interacciones con la UI y el PLC. "
-                "Sé **extremadamente preciso y descriptivo** con las 'description_or_instruction' que uses para la herramienta `search_and_click_ui_element`. "
-                "Incluye el tipo de elemento (ej. 'icono', 'botón'), el texto visible exacto y cualquier característica visual distintiva para asegurar que se encuentre el elemento correcto y no uno parecido. "
-                "Cuando el usuario te dé una instrucción compleja que involucre una secuencia de pasos en la UI (como abrir programas, navegar por menús, o escribir texto en campos), desglosa la tarea en pasos individuales y llama a las herramientas `search_and_click_ui_element` y `write_text_ui` para cada paso. "
-                "Por ejemplo, si el usuario dice 'abre el TIA Portal y crea un nuevo proyecto', tu primer paso debería ser `search_and_click_ui_element(description_or_instruction='icono de TIA Portal V15')` y luego continuar con los pasos para crear el proyecto. "
-                "Cuando el usuario te pida escribir código en un IDE, primero deberás usar las herramientas de UI para navegar hasta ese IDE y localizar el área donde se escribe el código. Una vez localizado, utiliza la herramienta `write_text_ui` para insertar el código proporcionado por ti o por el usuario. "
-                "Para la interacción con el PLC, puedes leer y escribir en Data Blocks (DBs) o en memoria Merker (M), y con tipos específicos (BOOL, INT, REAL)."
-                "Cuando interactúes con el PLC, el usuario puede darte comandos estructurados (ej. 'WRITE DB1.DBW10 INT 123') o lenguaje natural (ej. 'Arranca la secuencia de mezclado'). "
-                "Si es lenguaje natural para el PLC, tradúcelo a operaciones de lectura/escritura de bits/bytes/palabras en el PLC y usa la herramienta adecuada."
-                "Muestra el estado actual del PLC cuando se te pida o después de una operación de escritura relevante."
-                "Utiliza la herramienta `perform_ocr_on_screen` cuando necesites leer texto directamente de la pantalla, como valores numéricos, etiquetas, o cualquier información textual que no pueda ser obtenida a través de la búsqueda de elementos UI o interacciones directas con el PLC. "
-                "Esta herramienta es útil para extraer datos de interfaces que no son fácilmente accesibles por otros medios, como HMI, aplicaciones legacy, o reportes visuales. "
-                "Especifica claramente la región de interés (x, y, width, height) o la descripción del elemento UI si la región es la de un recorte conocido."
-                ),
-                MessagesPlaceholder(variable_name="chat_history"),
-                ("user", "{input}"),
-                MessagesPlaceholder(variable_name="agent_scratchpad"),
-            ]
-        )
-        
-        # Crear el agente que usa llamadas a herramientas
-        self.agent = create_tool_calling_agent(self.llm, self.tools, self.prompt)
+    def __init__(self, router_model: str = ROUTER_MODEL, planner_model: str = PLANNER_MODEL, temperature: float = 0):
+        # Dos niveles de modelo: un modelo rápido y barato ("router", gpt-4o-mini) resuelve la mayoría
+        # de pasos de enrutado de herramientas, y "gpt-4o" ("planner") solo se usa para tareas largas
+        # o cuando el router pide escalar.
+        # El LLM, las herramientas, el prompt y el agente se reutilizan entre instancias (ver _build_agent).
+        self.llm, self.tools, self.prompt, self.agent = _build_agent(router_model, temperature, True)
+        self.planner_llm, _, self.planner_prompt, self.planner_agent = _build_agent(planner_model, temperature, False)
+        self.router_llm = self.llm
         
-        # Crear el ejecutor del agente
-        self.agent_executor = AgentExecutor(agent=self.agent, tools=self.tools, verbose=True)
+        # Crear los ejecutores del agente
+        self.agent_executor = self._create_executor(self.agent)
+        self.planner_executor = self._create_executor(self.planner_agent)
 
         self.chat_history = [] # Para mantener el contexto de la conversación
 
+        if AGENT_WARMUP:
+            # En segundo plano: la primera tarea encuentra las conexiones ya abiertas sin retrasar el arranque
+            threading.Thread(target=self._warmup, name="agent-warmup", daemon=True).start()
+
+    def _warmup(self):
+        """
+        Abre las conexiones HTTPS con OpenAI (router y planner), hace una pasada del modelo de embeddings
+        y una búsqueda en Qdrant, para que la primera llamada real no pague esos costes de arranque.
+        Los errores solo se registran: el calentamiento es opcional.
+        """
+        start = time.perf_counter()
+        try:
+            image_processor.sentence_transformer_model.encode("warmup") # Directo al modelo: sin caché de embeddings
+            # Consulta directa al cliente (no search_points) para no dejar resultados en la caché de búsquedas
+            probe = [1.0] + [0.0] * (qdrant_handler.VECTOR_DIMENSION - 1)
+            qdrant_handler.client.query_points(collection_name=qdrant_handler.COLLECTION_NAME, query=probe, limit=1)
+            # Modelos propios sin caché (sobre el mismo cliente HTTP, que es el que se calienta): con la caché
+            # de respuestas, el "ping" se serviría desde memoria y no abriría ninguna conexión
+            for model_name in dict.fromkeys((self.router_llm.model_name, self.planner_llm.model_name)):
+                ChatOpenAI(model=model_name, max_tokens=1, http_client=openai_http_client, cache=False).invoke("ping")
+            log.info("[AGENT] Calentamiento completado en %.2f s.", time.perf_counter() - start)
+        except Exception as e:
+            log.warning("[AGENT] Calentamiento incompleto: %s", e)
 
-    def _define_tools(self) -> List[tool]:
+    def _create_executor(self, agent) -> AgentExecutor:
+        """Crea un ejecutor del agente, con límites de iteraciones y de tiempo."""
+        # early_stopping_method="force": los agentes de tool calling (multi-acción) no admiten "generate".
+        return AgentExecutor(
+            agent=agent,
+            tools=self.tools,
+            verbose=AGENT_VERBOSE,
+            max_iterations=AGENT_MAX_ITERATIONS,
+            max_execution_time=AGENT_MAX_EXECUTION_TIME,
+            early_stopping_method="force",
+            return_intermediate_steps=False,
+            trim_intermediate_steps=_trim_scratchpad,
+        )
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _define_tools() -> List[tool]:
         """
         Define las herramientas que el agente puede utilizar.
         Estas funciones se convierten en herramientas de LangChain gracias al decorador @tool.
         Acceden a las instancias globales de qdrant_handler, image_processor y plc_handler.
+        Se construyen una sola vez por proceso (lru_cache): el router, el planner y todas las instancias
+        comparten las mismas herramientas, sin volver a analizar docstrings ni generar modelos Pydantic.
         """
 
         @tool
-        def search_and_click_ui_element(description_or_instruction: str, monitor_id: Optional[int] = None, confidence: float = 0.8) -> str:
+        def search_and_click_ui_element(description_or_instruction: str, monitor_id: Optional[int] = None, confidence: float = 0.8, double_click: bool = False) -> str:
             """
             Busca un elemento de UI en pantalla basado en su descripción y hace clic en él.
             Útil para navegar por ventanas, abrir aplicaciones o interactuar con botones/iconos.
@@ -98,80 +507,65 @@ class AutomationAgent:
             ej: 'icono de la papelera de reciclaje', 'botón Aceptar', 'pestaña Configuración', 'carpeta Prueba'.
             'monitor_id': ID del monitor (0 para el principal). Si es None, busca en el monitor principal.
             'confidence': Umbral de confianza para la detección de imagen (0.0 a 1.0).
+            'double_click': True para hacer doble clic (abrir programas, carpetas o archivos); por defecto clic simple.
             Devuelve 'SUCCESS: Clic ejecutado en [Descripción]' o 'ERROR: [Mensaje de error]'.
             """
-            print("\n[TOOL] search_and_click_ui_element invocado.")
-            print(f"DEBUG: description_or_instruction recibida: '{description_or_instruction}'")
-            print(f"DEBUG: monitor_id: {monitor_id}, confidence: {confidence}")
+            log.info("[TOOL] search_and_click_ui_element invocado.")
+            _, message = _locate_and_click(description_or_instruction, monitor_id, confidence, double_click)
+            return message
+
+        @tool
+        def search_and_click_ui_elements(descriptions: List[str], monitor_id: Optional[int] = None, confidence: float = 0.8) -> str:
+            """
+            Versión por lotes de search_and_click_ui_element: recibe una lista ordenada de descripciones
+            de elementos de UI y hace clic en cada uno, en ese orden.
+            Úsala cuando el plan enumere de antemano varios elementos a clicar seguidos,
+            ej: ['menú Archivo', 'opción Nuevo proyecto', 'botón Crear'].
+            La búsqueda en Qdrant de todas las descripciones se hace en una sola petición.
+            Se detiene en el primer elemento que no se pueda localizar o clicar.
+            Devuelve una línea 'SUCCESS: ...' o 'ERROR: ...' por cada elemento procesado.
+            """
+            log.info("[TOOL] search_and_click_ui_elements invocado.")
+            log.debug("descriptions recibidas: %s", descriptions)
+            log.debug("monitor_id: %s, confidence: %s", monitor_id, confidence)
+
+            if not descriptions:
+                return "ERROR: Debes proporcionar al menos una descripción."
 
-            clipping_file_path = None # Inicializar para el bloque finally
-            
             try:
-                # 1. Generar embedding de la instrucción
-                query_embedding = image_processor.generate_embedding_from_text(description_or_instruction)
-                
-                if len(query_embedding) != qdrant_handler.VECTOR_DIMENSION:
-                    return f"ERROR: El embedding de la instrucción no tiene la dimensión esperada ({len(query_embedding)} vs {qdrant_handler.VECTOR_DIMENSION})."
-                
-                # 2. Buscar recortes relevantes en Qdrant
-                print(f"DEBUG: Buscando en Qdrant para: '{description_or_instruction}'")
-                search_results = qdrant_handler.search_points(query_embedding, limit=1)
-                
-                if not search_results:
-                    print(f"WARNING: No se encontraron recortes relevantes en Qdrant para: '{description_or_instruction}'.")
-                    return f"ERROR: No se encontraron recortes relevantes en Qdrant para: '{description_or_instruction}'. Asegúrate de que el recorte esté ingresado y la descripción sea precisa."
-                
-                best_match = search_results[0]
-                clipping_file_path = best_match.payload.get("image_path")
-                
-                print(f"DEBUG: Mejor coincidencia en Qdrant (score: {best_match.score:.4f}): {best_match.payload.get('description')} (Path: {clipping_file_path})")
+                # 1-2. Embeddings en un solo lote (cacheados para descripciones repetidas) y una única petición
+                # a Qdrant con las descripciones cuyo embedding se pudo generar
+                batch_results = _search_texts(descriptions, limit=1)
 
-                if not clipping_file_path or not os.path.exists(clipping_file_path):
-                    print(f"ERROR: La ruta de imagen del recorte no es válida o no existe: {clipping_file_path}")
-                    return f"ERROR: La ruta de imagen del recorte no es válida o no existe: {clipping_file_path}. Por favor, verifica la carpeta 'clippings'."
-                
-                # 3. Tomar captura de pantalla actual
-                print(f"DEBUG: Tomando captura de pantalla del monitor {monitor_id if monitor_id is not None else 'principal'}.")
-                # take_screenshot ya devuelve un objeto PIL.Image
-                current_screenshot_image = take_screenshot(monitor_number=monitor_id) 
-                
-                if current_screenshot_image is None:
-                    return f"ERROR: No se pudo tomar una captura de pantalla del monitor {monitor_id if monitor_id is not None else 'principal'}."
-
-                # 4. Localizar el recorte en la captura de pantalla
-                # Opción b) Es la más sencilla y compatible con pyautogui, asegurando la limpieza.
-                # Generamos un nombre de archivo temporal para la captura de pantalla del agente.
-                # Usamos tempfile para un manejo más robusto de archivos temporales.
-                with tempfile.NamedTemporaryFile(suffix=".png", delete=False, dir=AGENT_TEMP_DIR) as temp_screenshot_file:
-                    current_screenshot_image.save(temp_screenshot_file.name)
-                    temp_screenshot_path = temp_screenshot_file.name
-                
-                location = find_image_on_screen(clipping_file_path, temp_screenshot_path, confidence=confidence)
-                
-                # Asegurar la eliminación del archivo temporal de la captura
-                if os.path.exists(temp_screenshot_path):
-                    os.remove(temp_screenshot_path)
-                    print(f"DEBUG: Archivo temporal de captura '{temp_screenshot_path}' eliminado.")
-
-                if location:
-                    center_x = location.left + location.width / 2
-                    center_y = location.top + location.height / 2
-                    
-                    # Un solo click suele ser suficiente para botones/iconos, 
-                    # pero doubleClick puede ser necesario para abrir carpetas/programas.
-                    # El agente debe decidir si es necesario un doble clic basado en el contexto.
-                    # Por simplicidad y para asegurar la acción, lo dejamos como doubleClick por ahora.
-                    pyautogui.doubleClick(center_x, center_y) 
-                    
-                    print(f"DEBUG: Clic ejecutado en ({center_x}, {center_y}) para: '{description_or_instruction}'")
-                    return f"SUCCESS: Clic ejecutado en '{description_or_instruction}'."
-                else:
-                    print(f"WARNING: No se pudo localizar '{description_or_instruction}' en la pantalla actual con confianza {confidence}.")
-                    return f"ERROR: No se pudo localizar '{description_or_instruction}' en la pantalla actual con confianza {confidence}. Intenta ajustar la descripción o la confianza."
-                
+                # 3. Clicar en orden; cada clic usa una captura nueva porque la UI cambia tras el anterior
+                with _ui_lock:
+                    outcomes = []
+                    for description, search_results in zip(descriptions, batch_results):
+                        if search_results is None:
+                            outcomes.append(f"ERROR: No se pudo generar el embedding para: '{description}'.")
+                            break
+                        if not search_results:
+                            outcomes.append(f"ERROR: No se encontraron recortes relevantes en Qdrant para: '{description}'.")
+                            break
+
+                        best_match = search_results[0]
+                        clipping_file_path = best_match.payload.get("image_path")
+                        log.debug("Mejor coincidencia en Qdrant (score: %.4f) para '%s': %s", best_match.score, description, clipping_file_path)
+
+                        if not clipping_file_path:
+                            outcomes.append("ERROR: El recorte encontrado en Qdrant no tiene ruta de imagen.")
+                            break
+
+                        result = _click_clipping(clipping_file_path, description, monitor_id, confidence)
+                        outcomes.append(result)
+                        if result.startswith("ERROR"):
+                            break
+                        time.sleep(0.5) # Dar tiempo a la UI a reaccionar antes del siguiente clic
+
+                return "\n".join(outcomes)
             except Exception as e:
-                traceback.print_exc()
-                return f"ERROR: Ocurrió un error en search_and_click_ui_element: {e}"
+                log.exception("Error no controlado en search_and_click_ui_elements")
+                return f"ERROR: Ocurrió un error en search_and_click_ui_elements: {e}"
 
         @tool
         def write_text_ui(text_to_write: str, target_element_description: Optional[str] = None, monitor_id: Optional[int] = None, confidence: float = 0.8) -> str:
@@ -181,31 +575,27 @@ class AutomationAgent:
             'target_element_description': ej. 'campo de texto Nombre de Usuario', 'barra de búsqueda'.
             Devuelve 'SUCCESS: Texto escrito' o 'ERROR: [Mensaje de error]'.
             """
-            print("\n[TOOL] write_text_ui invocado.")
-            print(f"DEBUG: Texto a escribir: '{text_to_write}'")
-            print(f"DEBUG: Target element description: '{target_element_description}'")
+            log.info("[TOOL] write_text_ui invocado.")
+            log.debug("Texto a escribir: '%s'", text_to_write)
+            log.debug("Target element description: '%s'", target_element_description)
             try:
-                if target_element_description:
-                    invoke_args = {
-                        'description_or_instruction': target_element_description,
-                        'confidence': confidence
-                    }
-                    if monitor_id is not None:
-                        invoke_args['monitor_id'] = monitor_id
-
-                    print(f"DEBUG: Intentando clicar el campo de texto con search_and_click_ui_element con args: {invoke_args}")
-                    click_result = search_and_click_ui_element.invoke(invoke_args)
-
-                    if "ERROR" in click_result:
-                        print(f"ERROR: No se pudo localizar el campo de texto '{target_element_description}': {click_result}")
-                        return f"ERROR: No se pudo localizar el campo de texto '{target_element_description}': {click_result}"
-                    time.sleep(0.5) # Pequeña pausa para asegurar el foco
-
-                pyautogui.write(text_to_write)
-                print(f"DEBUG: Texto '{text_to_write}' escrito en UI.")
-                return f"SUCCESS: Texto '{text_to_write}' escrito en la UI."
+                with _ui_lock: # El clic en el campo y la escritura no deben intercalarse con otros clics
+                    if target_element_description:
+                        log.debug("Intentando clicar el campo de texto '%s' (monitor: %s, confianza: %s)", target_element_description, monitor_id, confidence)
+                        clicked, click_result = _locate_and_click(target_element_description, monitor_id, confidence)
+
+                        if not clicked:
+                            log.error("No se pudo localizar el campo de texto '%s': %s", target_element_description, click_result)
+                            return f"ERROR: No se pudo localizar el campo de texto '{target_element_description}': {click_result}"
+                        time.sleep(0.5) # Pequeña pausa para asegurar el foco
+
+                    pyautogui.write(text_to_write)
+                    _invalidate_screenshots()
+                    _position_cache.clear() # Escribir puede mover o cambiar elementos (autocompletado, diálogos)
+                    log.debug("Texto '%s' escrito en UI.", text_to_write)
+                    return f"SUCCESS: Texto '{text_to_write}' escrito en la UI."
             except Exception as e:
-                traceback.print_exc()
+                log.exception("Error no controlado en write_text_ui")
                 return f"ERROR: Ocurrió un error al escribir texto en la UI: {e}"
             
         @tool
@@ -218,38 +608,69 @@ class AutomationAgent:
             bit_offset: Offset del bit (solo para BOOL).
             Devuelve el valor leído o un mensaje de error.
             """
-            print("\n[TOOL] read_plc_data invocado.")
-            print(f"DEBUG: Lectura PLC: {data_type}, DB:{db_number}, Byte:{byte_offset}, Bit:{bit_offset}")
+            log.info("[TOOL] read_plc_data invocado.")
+            log.debug("Lectura PLC: %s, DB:%s, Byte:%s, Bit:%s", data_type, db_number, byte_offset, bit_offset)
             try:
-                if not plc_handler.is_connected:
-                    print("DEBUG: PLC no conectado. Intentando conectar...")
-                    plc_handler.connect() # Intentar conectar si no lo está
-                    if not plc_handler.is_connected:
-                        raise PLCConnectionError("No se pudo conectar al PLC para lectura. Verifica la conexión y la configuración en .env.")
-
-                value = None
-                if data_type.upper() == "BOOL": # Usar .upper() para ser más robusto
-                    if db_number is None or bit_offset is None:
-                        return "ERROR: Para 'BOOL' se requiere 'db_number' y 'bit_offset'."
-                    value = plc_handler.read_bool(db_number, byte_offset, bit_offset)
-                elif data_type.upper() == "INT":
-                    if db_number is None:
-                        return "ERROR: Para 'INT' se requiere 'db_number'."
-                    value = plc_handler.read_int(db_number, byte_offset)
-                elif data_type.upper() == "REAL":
-                    if db_number is None:
-                        return "ERROR: Para 'REAL' se requiere 'db_number'."
-                    value = plc_handler.read_real(db_number, byte_offset)
-                else:
+                # La conexión (perezosa, con keepalive y backoff) la gestiona plc_handler en cada operación.
+                # read_item agrupa esta lectura con las de otras herramientas que se ejecuten en paralelo.
+                data_type = data_type.upper() # Usar .upper() para ser más robusto
+                if data_type not in DATA_TYPE_SIZES:
                     return f"ERROR: Tipo de dato no soportado para lectura: {data_type}. Use 'BOOL', 'INT', 'REAL'."
+                if data_type == "BOOL" and (db_number is None or bit_offset is None):
+                    return "ERROR: Para 'BOOL' se requiere 'db_number' y 'bit_offset'."
+                if db_number is None:
+                    return f"ERROR: Para '{data_type}' se requiere 'db_number'."
+                data = plc_handler.read_item(S7Item(S7_AREA_DB, db_number, byte_offset, DATA_TYPE_SIZES[data_type]))
+                value = PLCHandler.decode(data_type, data, bit_offset)
                 
-                print(f"SUCCESS: Valor leído: {value}")
+                log.info("Valor leído: %s", value)
                 return f"SUCCESS: Valor leído de PLC ({data_type}, DB{db_number}, Byte{byte_offset}, Bit{bit_offset if bit_offset is not None else ''}): {value}"
             except (PLCConnectionError, PLCReadWriteError) as plc_err:
-                traceback.print_exc()
+                log.exception("Error no controlado en read_plc_data")
+                return f"ERROR PLC: {plc_err}"
+            except Exception as e:
+                log.exception("Error no controlado en read_plc_data")
+                return f"ERROR: Ocurrió un error inesperado al leer del PLC: {e}"
+
+        @tool
+        def read_plc_data_batch(items: List[Dict[str, Any]]) -> str:
+            """
+            Lee varios valores del PLC (S7-1200) en una sola petición. Prefiérela a varias llamadas
+            a read_plc_data cuando necesites leer más de un valor.
+            items: Lista de lecturas, cada una un diccionario con las claves
+                   'data_type' ('BOOL', 'INT', 'REAL'), 'db_number', 'byte_offset' y 'bit_offset' (solo para BOOL).
+            Devuelve una línea 'SUCCESS: ...' por valor leído o 'ERROR: [Mensaje de error]'.
+            """
+            log.info("[TOOL] read_plc_data_batch invocado.")
+            log.debug("Lectura múltiple PLC: %s", items)
+            try:
+                s7_items = []
+                for item in items:
+                    data_type = str(item.get("data_type", "")).upper()
+                    db_number = item.get("db_number")
+                    if data_type not in DATA_TYPE_SIZES:
+                        return f"ERROR: Tipo de dato no soportado para lectura: {data_type}. Use 'BOOL', 'INT', 'REAL'."
+                    if db_number is None:
+                        return f"ERROR: Para '{data_type}' se requiere 'db_number'."
+                    if data_type == "BOOL" and item.get("bit_offset") is None:
+                        return "ERROR: Para 'BOOL' se requiere 'db_number' y 'bit_offset'."
+                    s7_items.append(S7Item(S7_AREA_DB, int(db_number), int(item.get("byte_offset", 0)), DATA_TYPE_SIZES[data_type]))
+
+                raw_values = plc_handler.read_many(s7_items)
+
+                lines = []
+                for item, data in zip(items, raw_values):
+                    data_type = str(item["data_type"]).upper()
+                    bit_offset = item.get("bit_offset")
+                    value = PLCHandler.decode(data_type, data, bit_offset)
+                    lines.append(f"SUCCESS: Valor leído de PLC ({data_type}, DB{item['db_number']}, Byte{item.get('byte_offset', 0)}, Bit{bit_offset if bit_offset is not None else ''}): {value}")
+                log.info("%s valores leídos.", len(lines))
+                return "\n".join(lines)
+            except (PLCConnectionError, PLCReadWriteError) as plc_err:
+                log.exception("Error no controlado en read_plc_data_batch")
                 return f"ERROR PLC: {plc_err}"
             except Exception as e:
-                traceback.print_exc()
+                log.exception("Error no controlado en read_plc_data_batch")
                 return f"ERROR: Ocurrió un error inesperado al leer del PLC: {e}"
 
         @tool
@@ -263,15 +684,10 @@ class AutomationAgent:
             bit_offset: Offset del bit (solo para BOOL).
             Devuelve 'SUCCESS: Valor escrito' o 'ERROR: [Mensaje de error]'.
             """
-            print("\n[TOOL] write_plc_data invocado.")
-            print(f"DEBUG: Escritura PLC: {data_type}, Value:{value}, DB:{db_number}, Byte:{byte_offset}, Bit:{bit_offset}")
+            log.info("[TOOL] write_plc_data invocado.")
+            log.debug("Escritura PLC: %s, Value:%s, DB:%s, Byte:%s, Bit:%s", data_type, value, db_number, byte_offset, bit_offset)
             try:
-                if not plc_handler.is_connected:
-                    print("DEBUG: PLC no conectado. Intentando conectar...")
-                    plc_handler.connect()
-                    if not plc_handler.is_connected:
-                        raise PLCConnectionError("No se pudo conectar al PLC para escritura. Verifica la conexión y la configuración en .env.")
-                        
+                # La conexión (perezosa, con keepalive y backoff) la gestiona plc_handler en cada operación
                 success = False
                 if data_type.upper() == "BOOL":
                     if db_number is None or bit_offset is None:
@@ -290,19 +706,75 @@ class AutomationAgent:
                     return f"ERROR: Tipo de dato no soportado para escritura: {data_type}. Use 'BOOL', 'INT', 'REAL'."
                 
                 if success:
-                    print(f"SUCCESS: Valor '{value}' escrito en PLC.")
+                    log.info("Valor '%s' escrito en PLC.", value)
                     return f"SUCCESS: Valor '{value}' escrito en PLC ({data_type}, DB{db_number}, Byte{byte_offset}, Bit{bit_offset if bit_offset is not None else ''})."
                 else:
-                    print(f"ERROR: Falló la escritura en PLC para {data_type} con valor {value}.")
+                    log.error("Falló la escritura en PLC para %s con valor %s.", data_type, value)
                     return f"ERROR: Falló la escritura en PLC para {data_type} con valor {value}."
             except (PLCConnectionError, PLCReadWriteError) as plc_err:
-                traceback.print_exc()
+                log.exception("Error no controlado en write_plc_data")
                 return f"ERROR PLC: {plc_err}"
             except ValueError as ve:
-                traceback.print_exc()
+                log.exception("Error no controlado en write_plc_data")
                 return f"ERROR: Valor '{value}' no es compatible con el tipo de dato '{data_type}': {ve}"
             except Exception as e:
-                traceback.print_exc()
+                log.exception("Error no controlado en write_plc_data")
+                return f"ERROR: Ocurrió un error inesperado al escribir en el PLC: {e}"
+
+        @tool
+        def write_plc_data_batch(items: List[Dict[str, Any]]) -> str:
+            """
+            Escribe varios valores en el PLC (S7-1200) en una sola petición. Prefiérela a varias llamadas
+            a write_plc_data cuando necesites escribir más de un valor.
+            items: Lista de escrituras, en el orden en que deben aplicarse; cada una un diccionario con las claves
+                   'data_type' ('BOOL', 'INT', 'REAL'), 'value', 'db_number', 'byte_offset' y 'bit_offset' (solo para BOOL).
+            Devuelve una línea 'SUCCESS: ...' por valor escrito o 'ERROR: [Mensaje de error]'.
+            """
+            log.info("[TOOL] write_plc_data_batch invocado.")
+            log.debug("Escritura múltiple PLC: %s", items)
+            try:
+                writes = []
+                for item in items:
+                    data_type = str(item.get("data_type", "")).upper()
+                    db_number = item.get("db_number")
+                    bit_offset = item.get("bit_offset")
+                    value = item.get("value")
+                    if data_type not in DATA_TYPE_SIZES:
+                        return f"ERROR: Tipo de dato no soportado para escritura: {data_type}. Use 'BOOL', 'INT', 'REAL'."
+                    if data_type == "BOOL" and (db_number is None or bit_offset is None):
+                        return "ERROR: Para 'BOOL' se requiere 'db_number' y 'bit_offset'."
+                    if db_number is None:
+                        return f"ERROR: Para '{data_type}' se requiere 'db_number'."
+                    if value is None:
+                        return f"ERROR: Falta 'value' en la escritura {item}."
+                    if data_type == "BOOL" and isinstance(value, str):
+                        # El LLM puede enviar 'false'/'0' como texto: bool('false') sería True
+                        token = value.strip().upper()
+                        if token not in _BOOL_TRUE | _BOOL_FALSE:
+                            return f"ERROR: Valor '{value}' no es compatible con el tipo de dato 'BOOL'."
+                        value = token in _BOOL_TRUE
+                    writes.append(S7Write(
+                        S7_AREA_DB, int(db_number), int(item.get("byte_offset", 0)),
+                        PLCHandler.encode(data_type, value),
+                        int(bit_offset) if data_type == "BOOL" else None,
+                    ))
+
+                plc_handler.write_many(writes)
+
+                lines = [
+                    f"SUCCESS: Valor '{item['value']}' escrito en PLC ({str(item['data_type']).upper()}, DB{item['db_number']}, Byte{item.get('byte_offset', 0)}, Bit{item.get('bit_offset') if item.get('bit_offset') is not None else ''})."
+                    for item in items
+                ]
+                log.info("%s valores escritos.", len(lines))
+                return "\n".join(lines)
+            except (PLCConnectionError, PLCReadWriteError) as plc_err:
+                log.exception("Error no controlado en write_plc_data_batch")
+                return f"ERROR PLC: {plc_err}"
+            except ValueError as ve:
+                log.exception("Error no controlado en write_plc_data_batch")
+                return f"ERROR: Algún valor no es compatible con su tipo de dato: {ve}"
+            except Exception as e:
+                log.exception("Error no controlado en write_plc_data_batch")
                 return f"ERROR: Ocurrió un error inesperado al escribir en el PLC: {e}"
 
         @tool
@@ -310,9 +782,9 @@ class AutomationAgent:
             """
             Obtiene la hora actual del sistema. Útil para tareas que necesitan información temporal.
             """
-            print("\n[TOOL] get_current_time invocado.")
+            log.info("[TOOL] get_current_time invocado.")
             current_time = time.strftime('%Y-%m-%d %H:%M:%S') # Formato más completo
-            print(f"SUCCESS: La hora actual es: {current_time}")
+            log.info("La hora actual es: %s", current_time)
             return f"SUCCESS: La hora actual es: {current_time}"
 
         @tool
@@ -326,8 +798,8 @@ class AutomationAgent:
                              Por defecto se guarda en el directorio temporal del agente.
             Devuelve 'SUCCESS: Captura guardada en [ruta]' o 'ERROR: [Mensaje de error]'.
             """
-            print("\n[TOOL] take_system_screenshot invocado.")
-            print(f"DEBUG: Tomando captura de pantalla para monitor_id: {monitor_id}, guardando en: {save_path}")
+            log.info("[TOOL] take_system_screenshot invocado.")
+            log.debug("Tomando captura de pantalla para monitor_id: %s, guardando en: %s", monitor_id, save_path)
             try:
                 # Asegurarse de que el directorio de destino exista
                 os.makedirs(os.path.dirname(save_path), exist_ok=True)
@@ -336,13 +808,12 @@ class AutomationAgent:
                 if screenshot:
                     screenshot.save(save_path)
                     absolute_path = os.path.abspath(save_path)
-                    print(f"SUCCESS: Captura de pantalla guardada en {absolute_path}")
+                    log.info("Captura de pantalla guardada en %s", absolute_path)
                     return f"SUCCESS: Captura de pantalla guardada en {absolute_path}"
                 else:
                     return f"ERROR: No se pudo tomar la captura de pantalla para el monitor {monitor_id if monitor_id is not None else 'principal'}."
             except Exception as e:
-                print(f"ERROR: Falló la captura de pantalla en take_system_screenshot: {e}")
-                traceback.print_exc()
+                log.exception("Falló la captura de pantalla en take_system_screenshot")
                 return f"ERROR: Falló la captura de pantalla: {e}"
 
         @tool
@@ -361,21 +832,19 @@ class AutomationAgent:
             
             Devuelve 'SUCCESS: Texto extraído: [texto]' o 'ERROR: [Mensaje de error]'.
             """
-            print("\n[TOOL] perform_ocr_on_screen invocado.")
-            print(f"DEBUG: OCR params: desc='{description_or_instruction}', coords=({x},{y},{width},{height}), monitor={monitor_id}, conf={confidence}")
+            log.info("[TOOL] perform_ocr_on_screen invocado.")
+            log.debug("OCR params: desc='%s', coords=(%s,%s,%s,%s), monitor=%s, conf=%s", description_or_instruction, x, y, width, height, monitor_id, confidence)
 
             try:
-                # Tomar una captura de pantalla del monitor especificado
-                screenshot_image = take_screenshot(monitor_number=monitor_id)
-                if screenshot_image is None:
-                    return f"ERROR: No se pudo tomar una captura de pantalla del monitor {monitor_id if monitor_id is not None else 'principal'} para OCR."
-
                 region_to_ocr = None # Variable para almacenar la imagen de la región a procesar
                 
                 if description_or_instruction:
+                    # Captura completa del monitor (necesaria para localizar el recorte), lanzada en segundo plano
+                    # para que se solape con el embedding y la búsqueda en Qdrant, igual que en _locate_and_click
+                    screenshot_future = _screenshot_executor.submit(take_screenshot, monitor_number=monitor_id)
+
                     # Si se proporciona una descripción, usar search_and_click para encontrar la región
-                    query_embedding = image_processor.generate_embedding_from_text(description_or_instruction)
-                    search_results = qdrant_handler.search_points(query_embedding, limit=1)
+                    search_results = _search_text(description_or_instruction, limit=1)
 
                     if not search_results:
                         return f"ERROR: No se encontraron recortes relevantes en Qdrant para: '{description_or_instruction}'. No se puede realizar OCR."
@@ -385,72 +854,173 @@ class AutomationAgent:
 
                     if not clipping_file_path or not os.path.exists(clipping_file_path):
                         return f"ERROR: La ruta de imagen del recorte no es válida o no existe: {clipping_file_path}. No se puede realizar OCR."
+
+                    screenshot_image = screenshot_future.result()
+                    if screenshot_image is None:
+                        return f"ERROR: No se pudo tomar una captura de pantalla del monitor {monitor_id if monitor_id is not None else 'principal'} para OCR."
                     
-                    # Guardar la captura de pantalla temporalmente para find_image_on_screen
-                    with tempfile.NamedTemporaryFile(suffix=".png", delete=False, dir=AGENT_TEMP_DIR) as temp_screenshot_file:
-                        screenshot_image.save(temp_screenshot_file.name)
-                        temp_screenshot_path = temp_screenshot_file.name
-                    
-                    location = find_image_on_screen(clipping_file_path, temp_screenshot_path, confidence=confidence)
-                    
-                    if os.path.exists(temp_screenshot_path):
-                        os.remove(temp_screenshot_path)
-                        print(f"DEBUG: Archivo temporal de captura '{temp_screenshot_path}' eliminado.")
+                    # find_image_on_screen acepta la captura en memoria y usa el recorte ya decodificado
+                    # (caché por ruta y mtime): sin codificar la pantalla a PNG ni volver a leerla de disco
+                    location = find_image_on_screen(clipping_file_path, screenshot_image, confidence=confidence)
 
                     if location:
                         # Recortar la región de interés de la captura de pantalla original
                         region_to_ocr = screenshot_image.crop((location.left, location.top, location.right, location.bottom))
-                        print(f"DEBUG: Región para OCR identificada por descripción: {location}")
+                        log.debug("Región para OCR identificada por descripción: %s", location)
                     else:
-                        print(f"WARNING: No se pudo localizar '{description_or_instruction}' en la pantalla con confianza {confidence}.")
+                        log.warning("No se pudo localizar '%s' en la pantalla con confianza %s.", description_or_instruction, confidence)
                         return f"ERROR: No se pudo localizar '{description_or_instruction}' en la pantalla actual para OCR. Intenta ajustar la descripción o la confianza."
                 elif x is not None and y is not None and width is not None and height is not None:
-                    # Recortar la región de interés usando las coordenadas proporcionadas
-                    # Asegurar que las coordenadas estén dentro de los límites de la imagen
-                    img_width, img_height = screenshot_image.size
-                    right = min(x + width, img_width)
-                    bottom = min(y + height, img_height)
-                    
-                    if x < 0 or y < 0 or right <= x or bottom <= y:
+                    # Capturar solo la región indicada: mss copia únicamente esos píxeles en lugar del monitor completo
+                    # (las coordenadas se validan y recortan a los límites del monitor en take_screenshot)
+                    if x < 0 or y < 0 or width <= 0 or height <= 0:
                         return f"ERROR: Coordenadas de la región de OCR ({x},{y},{width},{height}) están fuera de los límites de la pantalla o son inválidas."
-                    
-                    region_to_ocr = screenshot_image.crop((x, y, right, bottom))
-                    print(f"DEBUG: Región para OCR identificada por coordenadas: ({x},{y},{width},{height})")
+
+                    region_to_ocr = take_screenshot(monitor_number=monitor_id, region=(x, y, width, height))
+                    if region_to_ocr is None:
+                        return f"ERROR: No se pudo capturar la región ({x},{y},{width},{height}) del monitor {monitor_id if monitor_id is not None else 'principal'} para OCR."
+                    log.debug("Región para OCR identificada por coordenadas: (%s,%s,%s,%s)", x, y, width, height)
                 else:
                     return "ERROR: Debes proporcionar 'description_or_instruction' o las coordenadas (x, y, width, height) para realizar OCR."
                 
                 if region_to_ocr:
-                    # Generar un nombre de archivo temporal para la región recortada para OCR
-                    with tempfile.NamedTemporaryFile(suffix=".png", delete=False, dir=AGENT_TEMP_DIR) as temp_ocr_file:
-                        region_to_ocr.save(temp_ocr_file.name)
-                        temp_ocr_path = temp_ocr_file.name
-                    
-                    extracted_text = image_processor.extract_text_from_image(temp_ocr_path)
-                    
-                    if os.path.exists(temp_ocr_path):
-                        os.remove(temp_ocr_path)
-                        print(f"DEBUG: Archivo temporal de OCR '{temp_ocr_path}' eliminado.")
+                    # OCR directamente sobre el recorte en memoria, sin guardarlo en un archivo temporal
+                    extracted_text = image_processor.extract_text_from_pil(region_to_ocr)
+                    if extracted_text.startswith("ERROR"):
+                        return extracted_text
 
-                    print(f"SUCCESS: Texto extraído: '{extracted_text}'")
+                    log.info("Texto extraído: '%s'", extracted_text)
                     return f"SUCCESS: Texto extraído: '{extracted_text}'"
                 else:
                     return "ERROR: No se pudo definir la región para realizar OCR."
 
             except Exception as e:
-                traceback.print_exc()
+                log.exception("Error no controlado en perform_ocr_on_screen")
                 return f"ERROR: Ocurrió un error al realizar OCR: {e}"
 
+        @tool
+        def perform_ocr_batch(regions: List[Dict[str, Any]], monitor_id: Optional[int] = None, confidence: float = 0.8) -> str:
+            """
+            Versión por lotes de perform_ocr_on_screen: lee el texto de varias regiones de la pantalla
+            a partir de una única captura. Prefiérela cuando necesites leer dos o más campos (ej. varios valores de un HMI).
+            regions: Lista de regiones; cada una es un diccionario con 'description_or_instruction' (recorte ya ingresado
+                     en Qdrant) o con las coordenadas 'x', 'y', 'width', 'height' en píxeles.
+            monitor_id (int, optional): ID del monitor desde el que tomar la captura (0 para el principal).
+            confidence (float): Umbral de confianza para localizar los recortes indicados por descripción.
+            Devuelve una línea 'SUCCESS: Texto extraído (región N): [texto]' o 'ERROR: ...' por región, en el mismo orden.
+            """
+            log.info("[TOOL] perform_ocr_batch invocado.")
+            log.debug("Regiones OCR: %s, monitor=%s, conf=%s", regions, monitor_id, confidence)
+
+            if not regions:
+                return "ERROR: Debes proporcionar al menos una región."
+
+            try:
+                # Una sola captura para todas las regiones
+                screenshot_image = take_screenshot(monitor_number=monitor_id)
+                if screenshot_image is None:
+                    return f"ERROR: No se pudo tomar una captura de pantalla del monitor {monitor_id if monitor_id is not None else 'principal'} para OCR."
+                img_width, img_height = screenshot_image.size
+
+                # Las regiones por descripción se resuelven con un lote de embeddings y una sola petición a Qdrant
+                described = [i for i, region in enumerate(regions) if region.get("description_or_instruction")]
+                search_results = {}
+                if described:
+                    descriptions = [regions[i]["description_or_instruction"] for i in described]
+                    search_results = dict(zip(described, _search_texts(descriptions, limit=1)))
+
+                errors = {} # índice de región -> mensaje de error
+                crops = [] # (índice de región, recorte)
+                for i, region in enumerate(regions):
+                    description = region.get("description_or_instruction")
+                    if description:
+                        if search_results.get(i) is None:
+                            errors[i] = f"ERROR: No se pudo generar el embedding para: '{description}'."
+                            continue
+                        if not search_results[i]:
+                            errors[i] = f"ERROR: No se encontraron recortes relevantes en Qdrant para: '{description}'."
+                            continue
+                        clipping_file_path = search_results[i][0].payload.get("image_path")
+                        if not clipping_file_path or not os.path.exists(clipping_file_path):
+                            errors[i] = f"ERROR: La ruta de imagen del recorte no es válida o no existe: {clipping_file_path}."
+                            continue
+                        location = find_image_on_screen(clipping_file_path, screenshot_image, confidence=confidence)
+                        if not location:
+                            errors[i] = f"ERROR: No se pudo localizar '{description}' en la pantalla actual para OCR."
+                            continue
+                        crops.append((i, screenshot_image.crop((location.left, location.top, location.right, location.bottom))))
+                    elif all(region.get(key) is not None for key in ("x", "y", "width", "height")):
+                        x, y = int(region["x"]), int(region["y"])
+                        right = min(x + int(region["width"]), img_width)
+                        bottom = min(y + int(region["height"]), img_height)
+                        if x < 0 or y < 0 or right <= x or bottom <= y:
+                            errors[i] = f"ERROR: Coordenadas de la región de OCR ({region['x']},{region['y']},{region['width']},{region['height']}) están fuera de los límites de la pantalla o son inválidas."
+                            continue
+                        crops.append((i, screenshot_image.crop((x, y, right, bottom))))
+                    else:
+                        errors[i] = "ERROR: Cada región necesita 'description_or_instruction' o las coordenadas (x, y, width, height)."
+
+                texts = dict(zip((i for i, _ in crops), image_processor.extract_texts_batch([crop for _, crop in crops])))
+
+                lines = []
+                for i in range(len(regions)):
+                    if i in errors:
+                        lines.append(errors[i])
+                    elif texts[i].startswith("ERROR"):
+                        lines.append(texts[i])
+                    else:
+                        lines.append(f"SUCCESS: Texto extraído (región {i + 1}): '{texts[i]}'")
+                log.info("OCR por lotes completado: %s regiones, %s con error.", len(regions), len(errors))
+                return "\n".join(lines)
+            except Exception as e:
+                log.exception("Error no controlado en perform_ocr_batch")
+                return f"ERROR: Ocurrió un error al realizar OCR por lotes: {e}"
+
         # Devuelve la lista de todas las herramientas definidas
         return [
             search_and_click_ui_element,
+            search_and_click_ui_elements,
             write_text_ui,
             read_plc_data,
+            read_plc_data_batch,
             write_plc_data,
+            write_plc_data_batch,
             get_current_time,
             take_system_screenshot,
-            perform_ocr_on_screen # AÑADIDO: La nueva herramienta de OCR
+            perform_ocr_on_screen, # AÑADIDO: La nueva herramienta de OCR
+            perform_ocr_batch,
         ]
 
+    def _record_turn(self, instruction: str, final_output: Any):
+        """Añade la instrucción y la respuesta al historial y lo mantiene acotado."""
+        self.chat_history.append(HumanMessage(content=instruction))
+        self.chat_history.append(AIMessage(content=str(final_output)))
+        self._trim_history()
+
+    def _trim_history(self):
+        """
+        Mantiene el historial acotado: si supera HISTORY_MAX_MESSAGES o unos HISTORY_MAX_TOKENS tokens,
+        sustituye los mensajes antiguos por un resumen, de modo que el prompt de cada invocación no crezca con cada tarea.
+        """
+        if len(self.chat_history) <= HISTORY_MAX_MESSAGES and _estimate_tokens(self.chat_history) <= HISTORY_MAX_TOKENS:
+            return
+        # Conservar los mensajes recientes que quepan en la mitad del presupuesto (al menos el último turno)
+        keep = min(HISTORY_KEEP_MESSAGES, len(self.chat_history))
+        while keep > 2 and _estimate_tokens(self.chat_history[-keep:]) > HISTORY_MAX_TOKENS // 2:
+            keep -= 2
+        old_messages = self.chat_history[:-keep]
+        recent_messages = self.chat_history[-keep:]
+        if not old_messages:
+            return
+        try:
+            summary = _summarize_messages(old_messages)
+            self.chat_history = [SystemMessage(content=HISTORY_SUMMARY_PREFIX + summary)] + recent_messages
+            log.debug("Historial resumido: %s mensajes antiguos sustituidos por un resumen.", len(old_messages))
+        except Exception as e:
+            # Si el resumen falla, descartar los mensajes antiguos antes que dejar crecer el prompt
+            log.warning("No se pudo resumir el historial (%s). Se descartan los mensajes antiguos.", e)
+            self.chat_history = recent_messages
+
     def run_task(self, instruction: str) -> str:
         """
         Ejecuta una tarea compleja dada una instrucción en lenguaje natural.
@@ -459,27 +1029,200 @@ class AutomationAgent:
         Returns:
             str: El resultado de la ejecución de la tarea.
         """
-        print(f"\n[AGENT] Recibida instrucción para run_task: '{instruction}'")
+        log.info("[AGENT] Recibida instrucción para run_task: '%s'", instruction)
+
+        # Vía rápida: los comandos estructurados de PLC no necesitan razonamiento del LLM
+        plc_command = _PLC_CMD_RE.match(instruction)
+        if plc_command:
+            final_output = _run_plc_command(plc_command)
+            log.info("[AGENT] Comando de PLC ejecutado directamente. Resultado: %s", final_output)
+            self._record_turn(instruction, final_output)
+            return final_output
+
         try:
-            result = self.agent_executor.invoke(
-                {"input": instruction, "chat_history": self.chat_history}
-            )
-            
+            # Las instrucciones complejas van directamente al planner; el resto, primero al router
+            use_planner = _needs_planner(instruction)
+            inputs = {"input": instruction, "chat_history": self.chat_history}
+            if use_planner:
+                result = self.planner_executor.invoke(inputs)
+            else:
+                try:
+                    result = self.agent_executor.invoke(inputs)
+                except Exception as router_error:
+                    # Un fallo del router (p. ej. argumentos de herramienta mal formados) no es definitivo
+                    log.warning("[AGENT] El modelo router falló (%s). Reintentando con el modelo planner.", router_error)
+                    result = None
+
             # El output del agente puede estar en result["output"] o result["agent_outcome"].
             # Para AgentExecutor con create_tool_calling_agent, normalmente el resultado final está en "output".
-            final_output = result.get("output", "No se encontró salida final del agente.")
+            final_output = result.get("output", "No se encontró salida final del agente.") if result else None
+
+            if not use_planner and (final_output is None or _router_gave_up(final_output)):
+                log.info("[AGENT] Escalando la tarea al modelo planner.")
+                result = self.planner_executor.invoke(inputs)
+                final_output = result.get("output", "No se encontró salida final del agente.")
             
-            # Opcional: Actualizar el historial de chat si quieres mantener el contexto entre invocaciones
-            # self.chat_history.append(HumanMessage(content=instruction))
-            # self.chat_history.append(AIMessage(content=final_output)) # Asegúrate de que final_output sea una cadena
+            # Actualizar el historial de chat para mantener el contexto entre invocaciones (acotado)
+            self._record_turn(instruction, final_output)
             
-            print(f"\n[AGENT] Tarea completada. Output del Agente: {final_output}")
+            log.info("[AGENT] Tarea completada. Output del Agente: %s", final_output)
             return final_output
         except Exception as e:
-            print(f"ERROR: Falló la ejecución de la tarea compleja: {e}")
-            traceback.print_exc() # Imprime el stack trace completo
+            log.exception("Falló la ejecución de la tarea compleja") # Incluye el stack trace completo
             return f"ERROR: Falló la ejecución de la tarea compleja: {e}"
 
+    async def arun_task(self, instruction: str) -> str:
+        """
+        Versión asíncrona de run_task. Con ainvoke, cuando el LLM pide varias herramientas en un mismo
+        paso (p. ej. leer el PLC y hacer OCR), LangChain las ejecuta concurrentemente en lugar de una tras otra.
+        Las herramientas de ratón/teclado siguen serializándose entre sí mediante _ui_lock.
+        Desde código síncrono debe lanzarse con utils.http_utils.run_async, no con asyncio.run.
+        Args:
+            instruction (str): La instrucción del usuario.
+        Returns:
+            str: El resultado de la ejecución de la tarea.
+        """
+        log.info("[AGENT] Recibida instrucción para arun_task: '%s'", instruction)
+
+        # Vía rápida: los comandos estructurados de PLC no necesitan razonamiento del LLM
+        plc_command = _PLC_CMD_RE.match(instruction)
+        if plc_command:
+            final_output = await asyncio.to_thread(_run_plc_command, plc_command)
+            log.info("[AGENT] Comando de PLC ejecutado directamente. Resultado: %s", final_output)
+            await asyncio.to_thread(self._record_turn, instruction, final_output)
+            return final_output
+
+        try:
+            # Las instrucciones complejas van directamente al planner; el resto, primero al router
+            use_planner = _needs_planner(instruction)
+            inputs = {"input": instruction, "chat_history": self.chat_history}
+            if use_planner:
+                result = await self.planner_executor.ainvoke(inputs)
+            else:
+                try:
+                    result = await self.agent_executor.ainvoke(inputs)
+                except Exception as router_error:
+                    log.warning("[AGENT] El modelo router falló (%s). Reintentando con el modelo planner.", router_error)
+                    result = None
+            final_output = result.get("output", "No se encontró salida final del agente.") if result else None
+
+            if not use_planner and (final_output is None or _router_gave_up(final_output)):
+                log.info("[AGENT] Escalando la tarea al modelo planner.")
+                result = await self.planner_executor.ainvoke(inputs)
+                final_output = result.get("output", "No se encontró salida final del agente.")
+
+            # El resumen del historial (si toca) es una llamada bloqueante al LLM: fuera del event loop
+            await asyncio.to_thread(self._record_turn, instruction, final_output)
+
+            log.info("[AGENT] Tarea completada. Output del Agente: %s", final_output)
+            return final_output
+        except Exception as e:
+            log.exception("Falló la ejecución de la tarea compleja") # Incluye el stack trace completo
+            return f"ERROR: Falló la ejecución de la tarea compleja: {e}"
+
+@functools.lru_cache(maxsize=1)
+def _get_summary_llm() -> ChatOpenAI:
+    """Modelo pequeño usado solo para resumir el historial antiguo."""
+    return _chat_model(HISTORY_SUMMARY_MODEL, 0)
+
+
+def _estimate_tokens(messages: list) -> int:
+    """Estimación rápida (sin tokenizador) de los tokens de una lista de mensajes: ~4 caracteres por token."""
+    return sum(len(str(message.content)) for message in messages) // 4
+
+
+def _trim_scratchpad(steps: list) -> list:
+    """
+    Recorta las observaciones antiguas del scratchpad del agente (ver SCRATCHPAD_FULL_STEPS).
+    Args:
+        steps (list): Pasos intermedios (AgentAction, observación) del AgentExecutor.
+    Returns:
+        list: Los mismos pasos, con las observaciones antiguas truncadas.
+    """
+    cutoff = len(steps) - SCRATCHPAD_FULL_STEPS
+    trimmed = []
+    for i, (action, observation) in enumerate(steps):
+        if i < cutoff and isinstance(observation, str) and len(observation) > SCRATCHPAD_OBSERVATION_CHARS:
+            observation = observation[:SCRATCHPAD_OBSERVATION_CHARS] + "…"
+        trimmed.append((action, observation))
+    return trimmed
+
+
+def _summarize_messages(messages: list) -> str:
+    """
+    Resume una lista de mensajes del historial (incluido un resumen previo, si lo hay) en pocas frases.
+    """
+    transcript = "\n".join(
+        f"{'Usuario' if isinstance(m, HumanMessage) else 'Asistente' if isinstance(m, AIMessage) else 'Contexto'}: {m.content}"
+        for m in messages
+    )
+    response = _get_summary_llm().invoke(
+        "Resume en pocas frases la siguiente conversación entre un usuario y un agente de automatización "
+        "de UI y PLC. Conserva nombres de programas, elementos de UI, direcciones y valores del PLC "
+        "y el estado en que quedó cada tarea.\n\n" + transcript
+    )
+    return response.content.strip()
+
+
+@functools.lru_cache(maxsize=8)
+def _build_agent(model_name: str, temperature: float, allow_escalation: bool = False) -> tuple:
+    """
+    Construye (una sola vez por modelo/temperatura) el LLM, las herramientas, el prompt y el agente.
+    Generar los esquemas JSON de las herramientas y compilar el prompt es costoso, y el resultado
+    no depende de la instancia, así que todas las instancias de AutomationAgent lo comparten.
+    Args:
+        allow_escalation (bool): Si es True, el prompt indica al modelo que responda ESCALATE
+                                 cuando la tarea le supere (se usa para el modelo router).
+    Returns:
+        tuple: (llm, tools, prompt, agent)
+    """
+    llm = _chat_model(model_name, temperature)
+
+    # Definir las herramientas que el agente de LangChain puede usar
+    tools = AutomationAgent._define_tools()
+
+    # Definir el prompt del agente
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", 
+            "Eres un asistente experto en automatización de interfaces de usuario y control de PLCs Siemens S7-1200. "
+            "Tu objetivo es ayudar al usuario a realizar tareas complejas en Windows y en el PLC. "
+            "Utiliza las herramientas disponibles para lograr los objetivos. "
+            "Prioriza siempre el uso de las herramientas para interacciones con la UI y el PLC. "
+            "Sé **extremadamente preciso y descriptivo** con las 'description_or_instruction' que uses para la herramienta `search_and_click_ui_element`. "
+            "Incluye el tipo de elemento (ej. 'icono', 'botón'), el texto visible exacto y cualquier característica visual distintiva para asegurar que se encuentre el elemento correcto y no uno parecido. "
+            "Cuando el usuario te dé una instrucción compleja que involucre una secuencia de pasos en la UI (como abrir programas, navegar por menús, o escribir texto en campos), desglosa la tarea en pasos individuales y llama a las herramientas `search_and_click_ui_element` y `write_text_ui` para cada paso. "
+            "Por ejemplo, si el usuario dice 'abre el TIA Portal y crea un nuevo proyecto', tu primer paso debería ser `search_and_click_ui_element(description_or_instruction='icono de TIA Portal V15', double_click=True)` y luego continuar con los pasos para crear el proyecto. "
+            "Usa `double_click=True` solo para abrir programas, carpetas o archivos; para botones, menús, pestañas y campos basta el clic simple (por defecto). "
+            "Si conoces de antemano varios elementos que hay que clicar seguidos, prefiere `search_and_click_ui_elements` con la lista ordenada de descripciones: resuelve todas en una sola búsqueda. "
+            "Cuando el usuario te pida escribir código en un IDE, primero deberás usar las herramientas de UI para navegar hasta ese IDE y localizar el área donde se escribe el código. Una vez localizado, utiliza la herramienta `write_text_ui` para insertar el código proporcionado por ti o por el usuario. "
+            "Para la interacción con el PLC, puedes leer y escribir en Data Blocks (DBs) o en memoria Merker (M), y con tipos específicos (BOOL, INT, REAL)."
+            "Cuando interactúes con el PLC, el usuario puede darte comandos estructurados (ej. 'WRITE DB1.DBW10 INT 123') o lenguaje natural (ej. 'Arranca la secuencia de mezclado'). "
+            "Si es lenguaje natural para el PLC, tradúcelo a operaciones de lectura/escritura de bits/bytes/palabras en el PLC y usa la herramienta adecuada."
+            "Muestra el estado actual del PLC cuando se te pida o después de una operación de escritura relevante."
+            "Si necesitas leer varios valores del PLC a la vez, usa `read_plc_data_batch` en lugar de varias llamadas a `read_plc_data`; "
+            "del mismo modo, para dos o más escrituras usa `write_plc_data_batch` en lugar de varias llamadas a `write_plc_data`. "
+            "Utiliza la herramienta `perform_ocr_on_screen` cuando necesites leer texto directamente de la pantalla, como valores numéricos, etiquetas, o cualquier información textual que no pueda ser obtenida a través de la búsqueda de elementos UI o interacciones directas con el PLC. "
+            "Esta herramienta es útil para extraer datos de interfaces que no son fácilmente accesibles por otros medios, como HMI, aplicaciones legacy, o reportes visuales. "
+            "Especifica claramente la región de interés (x, y, width, height) o la descripción del elemento UI si la región es la de un recorte conocido. "
+            "Si necesitas leer dos o más regiones de la pantalla, usa `perform_ocr_batch` con la lista de regiones en lugar de varias llamadas a `perform_ocr_on_screen`."
+            + (
+                f" Si la tarea requiere una planificación de muchos pasos o no estás seguro de cómo resolverla, "
+                f"no ejecutes ninguna herramienta y responde únicamente con la palabra {ESCALATE_TOKEN}."
+                if allow_escalation else ""
+            )
+            ),
+            MessagesPlaceholder(variable_name="chat_history"),
+            ("user", "{input}"),
+            MessagesPlaceholder(variable_name="agent_scratchpad"),
+        ]
+    )
+
+    # Crear el agente que usa llamadas a herramientas
+    agent = create_tool_calling_agent(llm, tools, prompt)
+    return llm, tools, prompt, agent
+
+
 # Ejemplo de uso (para pruebas directas de este módulo)
 if __name__ == "__main__":
     print("--- Probando AutomationAgent (automation_agent.py) ---")
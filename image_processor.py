@@ -2,11 +2,65 @@ import os
 from PIL import Image
 from dotenv import load_dotenv
 from sentence_transformers import SentenceTransformer
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from openai import APIConnectionError, RateLimitError
+import asyncio
 import base64
-import traceback
+import hashlib
+import io
+import json
+import re
+import shutil
 import pytesseract # Importar pytesseract
+import numpy as np
+import atexit
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.cache_utils import QueryCache, DiskArrayCache, DiskJsonCache
+from utils.log_utils import get_logger
+from utils.http_utils import openai_http_client, openai_async_http_client
+
+log = get_logger(__name__)
+
+# Motor de OCR persistente (opcional): tesserocr mantiene Tesseract y los datos de idioma cargados en memoria,
+# mientras que pytesseract lanza un proceso 'tesseract' (y relee los datos de idioma) en cada llamada.
+# pip install tesserocr
+_tesserocr = None
+try:
+    import tesserocr as _tesserocr
+except ImportError:
+    log.debug("tesserocr no está instalado. El OCR usará pytesseract (un proceso por llamada).")
+
+# Parser JSON rápido (opcional) para las respuestas estructuradas de OpenAI; si no está, se usa el de la biblioteca estándar
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+# Codificación base64 acelerada con SIMD (opcional); misma API que el módulo base64 de la biblioteca estándar.
+# pip install pybase64
+try:
+    import pybase64 as _b64
+except ImportError:
+    _b64 = base64
+
+# Motor de OCR en GPU para lotes (opcional): EasyOCR procesa varias imágenes en una sola pasada del modelo.
+# Solo compensa con muchas imágenes; las llamadas sueltas siguen usando Tesseract.
+# pip install easyocr
+_easyocr = None
+try:
+    import easyocr as _easyocr
+except ImportError:
+    log.debug("easyocr no está instalado. El OCR por lotes usará Tesseract.")
+
+OCR_LANG = os.getenv("OCR_LANG", "spa") # Idioma de Tesseract (ej. 'spa', 'eng', 'eng+spa')
+EASYOCR_LANGS = os.getenv("EASYOCR_LANGS", "es").split(",") # Idiomas de EasyOCR (códigos ISO: 'es', 'en')
+EASYOCR_MIN_BATCH = int(os.getenv("EASYOCR_MIN_BATCH", 4)) # Imágenes a partir de las cuales el lote va a EasyOCR
+# Modo de segmentación de página de Tesseract. 6 = un bloque uniforme de texto: más rápido y preciso que el
+# análisis de página completa por defecto (3) para recortes de UI; 7 para una sola línea (etiquetas, valores).
+OCR_PSM = int(os.getenv("OCR_PSM", 6))
 
 # Configurar la ruta al ejecutable de Tesseract si no está en el PATH del sistema
 # Solo necesario en algunos sistemas operativos (ej. Windows) si la instalación no lo añadió al PATH.
@@ -18,57 +72,375 @@ load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+# Dimensión de los vectores de EMBEDDING_MODEL_NAME: permite validar la colección de Qdrant sin cargar el modelo
+EMBEDDING_DIMENSION = 384
+# Segundos de espera antes de reintentar la carga del modelo tras un fallo (p. ej. sin conexión para descargarlo)
+EMBEDDING_MODEL_RETRY_SECONDS = float(os.getenv("EMBEDDING_MODEL_RETRY_SECONDS", 30))
+# Caché de embeddings de texto: memoria (LRU) + disco (.npy por texto), compartida por todos los que llaman
+# a generate_embedding(s)_from_text(s) (agente, Streamlit, main.py). La clave es el texto normalizado con
+# strip/lower, sin pérdida para este modelo (su tokenizador no distingue mayúsculas); el namespace de la
+# caché en disco es el modelo, para no mezclar vectores de modelos distintos.
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 10000))
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", os.path.join("cache", "embeddings"))
+# Dispositivo del modelo de embeddings: 'auto' usa CUDA (en FP16) si está disponible y si no la CPU;
+# 'cpu' o 'cuda' lo fuerzan (p. ej. EMBED_DEVICE=cpu en máquinas de CI con GPU compartida)
+EMBED_DEVICE = os.getenv("EMBED_DEVICE", "auto").lower()
+# Motor de inferencia del modelo de embeddings: 'torch' (por defecto) o 'onnx' (ONNX Runtime, con fusión de
+# operadores; 2-4x más rápido en CPU). 'onnx' requiere sentence-transformers>=3.2 y
+# pip install "sentence-transformers[onnx]" (u "[onnx-gpu]"); el modelo se exporta a ONNX en la primera carga.
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch").lower()
+# Caché de las descripciones de GPT-4o Vision por contenido de la imagen (blake2b de los bytes) y modelo:
+# volver a ingresar el mismo recorte no repite la llamada a OpenAI ni el OCR.
+VISION_CACHE_DIR = os.getenv("VISION_CACHE_DIR", os.path.join("cache", "vision"))
+# Campos de la respuesta de describe_image_with_ai ("Campo: valor", uno por línea), reconocidos en una sola pasada
+_RESPONSE_FIELD_RE = re.compile(r"^(Descripción|Texto visible extraído por IA|Palabras clave|Tipo de elemento):[ \t]*(.*)$", re.M)
+_KEYWORD_SPLIT_RE = re.compile(r"\s*,\s*")
+
+
+def _vision_fields(data: dict) -> tuple:
+    """
+    Normaliza un objeto JSON de descripción ('description', 'ai_extracted_text', 'keywords', 'element_type')
+    devuelto por GPT-4o.
+    Returns:
+        tuple: (description, keywords, element_type, ai_extracted_text)
+    """
+    keywords = data.get("keywords") or []
+    if isinstance(keywords, str):
+        keywords = _KEYWORD_SPLIT_RE.split(keywords)
+    return (
+        str(data.get("description") or "").strip(),
+        [str(k).strip() for k in keywords if str(k).strip()],
+        str(data.get("element_type") or "otro").strip().lower(),
+        str(data.get("ai_extracted_text") or "Ninguno").strip(),
+    )
+
+
+def copy_clipping_file(source_path: str, destination_path: str):
+    """
+    Copia el recorte a la carpeta 'clippings'. Los PNG se copian byte a byte (sin decodificar ni
+    recomprimir); solo los demás formatos pasan por Pillow para convertirlos a PNG.
+    """
+    if os.path.splitext(source_path)[1].lower() == ".png":
+        shutil.copyfile(source_path, destination_path)
+    else:
+        with Image.open(source_path) as img:
+            img.save(destination_path, format="PNG")
+
+
+def embedding_text(description: str, ocr_text: str, ai_extracted_text: str) -> str:
+    """
+    Texto que se codifica como embedding de un recorte: la descripción de la IA seguida del texto visible (IA)
+    y del texto del OCR, si los hay, en un orden fijo (el mismo recorte da siempre el mismo texto, y por tanto
+    acierta en la caché de embeddings). El OCR se omite si repite el texto visible (sin distinguir mayúsculas
+    ni espacios), para no darle doble peso en el embedding.
+    """
+    parts = [description]
+    has_ai_text = bool(ai_extracted_text) and ai_extracted_text.lower() != "ninguno"
+    if has_ai_text:
+        parts.append(f"Texto visible: {ai_extracted_text}")
+    if ocr_text and "ERROR" not in ocr_text: # Asegurarse de que OCR no devolvió un error
+        if not has_ai_text or " ".join(ocr_text.split()).casefold() != " ".join(ai_extracted_text.split()).casefold():
+            parts.append(f"OCR: {ocr_text}")
+    return ". ".join(parts)
+
+# Lado máximo (px) de las imágenes enviadas a GPT-4o Vision: las mayores se reducen antes de codificarlas
+# (menos bytes que subir y menos tokens de imagen). Los recortes de UI normales no llegan a este tamaño.
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", 1024))
+# Prompt de describe_image_with_ai (una imagen, respuesta JSON)
+_VISION_PROMPT = (
+    "Eres un experto analista de interfaces de usuario (UI) y tu tarea es describir con máxima precisión "
+    "el elemento visual en la siguiente imagen. Tu objetivo es proporcionar una descripción exhaustiva "
+    "que permita identificar unívocamente el elemento y su función.\n\n"
+    
+    "Detalles a identificar y describir (en orden de prioridad):\n"
+    "1.  **Tipo de Elemento UI:** Clasifica el elemento en una de las siguientes categorías estrictas: 'icono', 'pestaña', 'campo_texto', 'boton', 'desplegable', 'enlace', 'barra_desplazamiento', 'menu', 'ventana', 'fondo', 'otro'. Selecciona la más específica posible.\n"
+    "2.  **Texto Visible Principal:** Identifica y transcribe textualmente cualquier texto visible directamente en el elemento (ej. 'Guardar', 'Cancelar', 'Inicio', 'Usuario', un número, etc.). Si no hay texto, indica 'Ninguno'.\n"
+    "3.  **Propósito/Función:** Describe brevemente la acción que realiza el elemento o su significado semántico en el contexto de una UI.\n"
+    "4.  **Características Visuales:** Colores predominantes, forma (rectangular, circular, etc.), tamaño relativo (si es posible inferirlo), bordes, sombreado, y otros detalles estéticos o de diseño relevantes.\n"
+    "5.  **Contenido de Icono/Gráfico:** Si es un icono o gráfico, describe claramente su representación visual (ej. 'un disquete', 'una lupa', 'tres líneas horizontales').\n\n"
+
+    "Genera también una lista de palabras clave relevantes para la búsqueda y clasificación. Estas deben incluir: "
+    "el texto visible, el tipo de elemento UI, y términos descriptivos de su función o apariencia.\n\n"
+
+    "Responde únicamente con un objeto JSON con este formato estricto. Si un campo no aplica (ej. el texto visible si no hay), indica 'Ninguno'.\n"
+    '{"description": "[Descripción detallada y concisa del elemento, incluyendo los puntos anteriores de forma narrativa.]", '
+    '"ai_extracted_text": "[Texto directo visible en el elemento, o \'Ninguno\']", '
+    '"keywords": ["palabra1", "palabra2", ...], '
+    '"element_type": "[Tipo de elemento de UI de la lista proporcionada]"}'
+)
+# Recortes por petición en describe_images_with_ai (varias imágenes en un solo mensaje a GPT-4o)
+VISION_BATCH_SIZE = int(os.getenv("VISION_BATCH_SIZE", 8))
+# Lotes de describe_images_with_ai que se envían a OpenAI a la vez (las peticiones esperan a la red, no a la CPU)
+VISION_CONCURRENCY = int(os.getenv("VISION_CONCURRENCY", 4))
+_BATCH_VISION_PROMPT = (
+    "Eres un experto analista de interfaces de usuario (UI). Recibirás {n} imágenes, numeradas de 0 a {last} en el orden "
+    "en que aparecen, cada una con un elemento de UI. Para cada imagen describe con máxima precisión el elemento, "
+    "de forma que se pueda identificar unívocamente: su tipo, el texto visible, su propósito o función, sus "
+    "características visuales (colores, forma, bordes) y, si es un icono o gráfico, lo que representa.\n\n"
+    "Responde únicamente con un objeto JSON con este formato:\n"
+    '{{"items": [{{"index": 0, "description": "...", "ai_extracted_text": "...", "keywords": ["...", "..."], "element_type": "..."}}, ...]}}\n'
+    "- description: descripción detallada y concisa, de forma narrativa.\n"
+    "- ai_extracted_text: texto visible directamente en el elemento, o 'Ninguno'.\n"
+    "- keywords: palabras clave para la búsqueda (texto visible, tipo de elemento, función, apariencia).\n"
+    "- element_type: una de 'icono', 'pestaña', 'campo_texto', 'boton', 'desplegable', 'enlace', "
+    "'barra_desplazamiento', 'menu', 'ventana', 'fondo', 'otro'.\n"
+    "Incluye exactamente un elemento en 'items' por cada imagen."
+)
+# Textos por pasada del modelo: acota la memoria al codificar muchos recortes de una vez
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 64))
+
 class ImageProcessor:
+    # Modelo de embeddings compartido por todas las instancias: se carga (~90 MB de pesos) la primera vez
+    # que se necesita, no en cada constructor
+    _shared_model = None
+    _model_loaded = False
+    _model_retry_at = 0.0 # Tras un fallo de carga, no reintentar antes de este instante (time.monotonic)
+    _model_lock = threading.Lock()
+
     def __init__(self):
         if not OPENAI_API_KEY:
             raise ValueError("OPENAI_API_KEY debe estar configurado en el archivo .env")
         
-        self.openai_client = OpenAI(api_key=OPENAI_API_KEY)
+        # Cliente HTTP persistente (keep-alive + HTTP/2) compartido con los modelos del agente
+        self.openai_client = OpenAI(api_key=OPENAI_API_KEY, http_client=openai_http_client)
+        self.async_openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=openai_async_http_client)
         self.vision_model = "gpt-4o" 
 
+        self._embedding_cache = QueryCache(maxsize=EMBEDDING_CACHE_SIZE, ttl=None)
+        self._embedding_disk_cache = DiskArrayCache(EMBEDDING_CACHE_DIR, namespace=EMBEDDING_MODEL_NAME)
+        self._vision_cache = DiskJsonCache(VISION_CACHE_DIR, namespace=self.vision_model)
+
+        # Instancia de tesserocr creada en el primer OCR y reutilizada; no es segura entre hilos
+        self._ocr_api = None
+        self._ocr_lock = threading.Lock()
+        # Lector de EasyOCR, creado en el primer lote que lo necesite (cargar sus modelos tarda segundos)
+        self._easyocr_reader = None
+        self._easyocr_lock = threading.Lock()
+
+    @property
+    def sentence_transformer_model(self):
+        """Modelo 'all-MiniLM-L6-v2' compartido (se carga en el primer acceso), o None si no se pudo cargar."""
+        return ImageProcessor._get_model()
+
+    @classmethod
+    def _get_model(cls):
+        """
+        Carga el modelo de embeddings una sola vez por proceso (seguro entre hilos). Si la carga falla,
+        devuelve None y se vuelve a intentar pasados EMBEDDING_MODEL_RETRY_SECONDS.
+        """
+        if cls._model_loaded:
+            return cls._shared_model
+        with cls._model_lock:
+            if not cls._model_loaded and time.monotonic() >= cls._model_retry_at:
+                try:
+                    log.debug("Cargando modelo 'all-MiniLM-L6-v2' para embeddings...")
+                    device = cls._embedding_device()
+                    model = cls._load_backend_model(device)
+                    if model is None:
+                        model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=device)
+                        if device.startswith("cuda"):
+                            # FP16 en GPU: la mitad de ancho de banda de memoria, pérdida de precisión despreciable para MiniLM
+                            model.half()
+                    dimension = model.get_sentence_embedding_dimension()
+                    if dimension != EMBEDDING_DIMENSION:
+                        raise ValueError(f"el modelo genera vectores de {dimension} dimensiones, se esperaban {EMBEDDING_DIMENSION}")
+                    log.info("Modelo 'all-MiniLM-L6-v2' cargado para embeddings (dispositivo: %s, motor: %s).",
+                             device, getattr(model, "backend", "torch"))
+                    cls._shared_model = model
+                    cls._model_loaded = True
+                except Exception as e:
+                    log.error("Error al cargar el modelo 'all-MiniLM-L6-v2': %s. "
+                              "Asegúrate de tener conexión a internet o de haber descargado el modelo previamente. "
+                              "Se reintentará en %s s.", e, EMBEDDING_MODEL_RETRY_SECONDS)
+                    cls._model_retry_at = time.monotonic() + EMBEDDING_MODEL_RETRY_SECONDS
+        return cls._shared_model
+
+    @staticmethod
+    def _load_backend_model(device: str):
+        """
+        Carga el modelo con el motor EMBED_BACKEND si no es 'torch'. Devuelve None (y se usa PyTorch)
+        si el motor es 'torch' o no está disponible.
+        """
+        if EMBED_BACKEND == "torch":
+            return None
         try:
-            print("DEBUG: Cargando modelo 'all-MiniLM-L6-v2' para embeddings...")
-            self.sentence_transformer_model = SentenceTransformer('all-MiniLM-L6-v2')
-            print("Modelo 'all-MiniLM-L6-v2' cargado para embeddings.")
+            # Los mismos pesos exportados a ONNX: mismos embeddings, sin el despacho capa a capa de PyTorch
+            return SentenceTransformer(EMBEDDING_MODEL_NAME, device=device, backend=EMBED_BACKEND)
         except Exception as e:
-            print(f"Error al cargar el modelo 'all-MiniLM-L6-v2': {e}")
-            print("Asegúrate de tener conexión a internet o de haber descargado el modelo previamente.")
-            self.sentence_transformer_model = None
+            log.warning("No se pudo cargar el modelo con el motor '%s' (%s). Se usará PyTorch.", EMBED_BACKEND, e)
+            return None
+
+    @staticmethod
+    def _embedding_device() -> str:
+        """Resuelve EMBED_DEVICE: con 'auto', 'cuda' si PyTorch detecta una GPU y 'cpu' en caso contrario."""
+        if EMBED_DEVICE != "auto":
+            return EMBED_DEVICE
+        try:
+            import torch # Dependencia de sentence-transformers
+            return "cuda" if torch.cuda.is_available() else "cpu"
+        except ImportError:
+            return "cpu"
+
+    def _get_ocr_api(self):
+        """Devuelve el motor tesserocr persistente (creándolo la primera vez), o None si no está disponible."""
+        if _tesserocr is None:
+            return None
+        if self._ocr_api is None:
+            try:
+                self._ocr_api = _tesserocr.PyTessBaseAPI(lang=OCR_LANG, psm=OCR_PSM)
+                atexit.register(self._ocr_api.End)
+                log.info("Motor tesserocr inicializado (idioma '%s').", OCR_LANG)
+            except Exception as e:
+                log.warning("No se pudo inicializar tesserocr (%s). Se usará pytesseract.", e)
+                return None
+        return self._ocr_api
+
+    def _get_easyocr_reader(self):
+        """Devuelve el lector de EasyOCR (creándolo la primera vez, en GPU si hay CUDA), o None si no está disponible."""
+        if _easyocr is None:
+            return None
+        with self._easyocr_lock:
+            if self._easyocr_reader is None:
+                try:
+                    gpu = self._embedding_device().startswith("cuda")
+                    self._easyocr_reader = _easyocr.Reader(EASYOCR_LANGS, gpu=gpu, cudnn_benchmark=gpu, verbose=False)
+                    log.info("Lector EasyOCR inicializado (idiomas %s, GPU: %s).", EASYOCR_LANGS, gpu)
+                except Exception as e:
+                    log.warning("No se pudo inicializar EasyOCR (%s). Se usará Tesseract.", e)
+                    return None
+            return self._easyocr_reader
 
     def _encode_image_to_base64(self, image_path: str) -> str:
         """
-        Codifica una imagen en formato base64.
+        Codifica una imagen en formato base64 (con pybase64 si está instalado).
+        Si algún lado supera VISION_MAX_SIDE píxeles, la imagen se reduce (manteniendo la proporción) y se
+        codifica como PNG; si no, se envían los bytes del archivo tal cual, sin decodificarlo.
         """
-        print(f"DEBUG: Codificando imagen {image_path} a base64...")
-        with open(image_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-        print("DEBUG: Imagen codificada a base64.")
+        log.debug("Codificando imagen %s a base64...", image_path)
+        data = None
+        with Image.open(image_path) as img: # Solo lee la cabecera hasta que se accede a los píxeles
+            if max(img.size) > VISION_MAX_SIDE:
+                original_size = img.size
+                img.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE), Image.LANCZOS)
+                buffer = io.BytesIO()
+                img.save(buffer, format="PNG")
+                data = buffer.getvalue()
+                log.debug("Imagen reducida de %s a %s para OpenAI.", original_size, img.size)
+        if data is None:
+            with open(image_path, "rb") as image_file:
+                data = image_file.read()
+        # La salida de base64 es ASCII puro: decodificar como ASCII es más rápido que como UTF-8
+        encoded_string = _b64.b64encode(data).decode("ascii")
+        log.debug("Imagen codificada a base64.")
         return encoded_string
 
     def perform_ocr_on_image(self, image_path: str) -> str: # Hacemos público el método OCR
         """
         Extrae texto de una imagen usando Tesseract OCR.
         Este método es el que se llamará desde streamlit_app.py para la pestaña de OCR.
+        La ruta se pasa directamente a Tesseract: sin decodificar la imagen con PIL ni volver a
+        codificarla en un archivo temporal (lo que hace pytesseract con las imágenes PIL).
+        """
+        log.debug("Ejecutando OCR en la imagen: %s...", image_path)
+        if not os.path.exists(image_path):
+            log.error("No se pudo abrir la imagen %s para OCR: el archivo no existe.", image_path)
+            return f"ERROR: No se pudo extraer texto con OCR. Detalles: el archivo '{image_path}' no existe."
+        return self._run_ocr(image_path)
+
+    def extract_text_from_image(self, image_path: str) -> str:
+        """Alias de perform_ocr_on_image (nombre usado por la herramienta de OCR del agente)."""
+        return self.perform_ocr_on_image(image_path)
+
+    def extract_text_from_pil(self, img: Image.Image) -> str:
+        """
+        Extrae texto de una imagen ya cargada en memoria (p. ej. un recorte de la captura de pantalla),
+        sin guardarla antes en disco.
+        Args:
+            img (PIL.Image.Image): Imagen sobre la que aplicar OCR.
+        Returns:
+            str: El texto extraído, o un mensaje 'ERROR: ...' si falla.
+        """
+        return self._run_ocr(img)
+
+    def _run_ocr(self, image) -> str:
+        """
+        OCR común a perform_ocr_on_image y extract_text_from_pil.
+        Args:
+            image: Imagen PIL o ruta a un archivo de imagen.
+        Returns:
+            str: El texto extraído, o un mensaje 'ERROR: ...' si falla.
         """
-        print(f"DEBUG: Ejecutando OCR en la imagen: {image_path}...")
         try:
-            img = Image.open(image_path)
             # Para español, puedes especificar el idioma: lang='spa'
             # Para inglés: lang='eng'
             # Puedes combinar: lang='eng+spa'
-            text = pytesseract.image_to_string(img, lang='spa') # Idioma español
+            with self._ocr_lock:
+                ocr_api = self._get_ocr_api()
+                if ocr_api is not None:
+                    if isinstance(image, str):
+                        ocr_api.SetImageFile(image)
+                    else:
+                        ocr_api.SetImage(image)
+                    text = ocr_api.GetUTF8Text()
+            if ocr_api is None:
+                text = pytesseract.image_to_string(image, lang=OCR_LANG, config=f"--psm {OCR_PSM}")
             text = text.strip() # Limpiar espacios en blanco al inicio/final
-            print(f"DEBUG: Texto extraído por OCR: '{text}'")
+            log.debug("Texto extraído por OCR: '%s'", text)
             return text
         except pytesseract.TesseractNotFoundError:
-            print("ERROR: Tesseract OCR no encontrado. Asegúrate de que esté instalado y en tu PATH.")
-            print("Para Windows, considera añadir: pytesseract.pytesseract.tesseract_cmd = r'RUTA/A/TESSERACT.EXE'")
+            log.error("Tesseract OCR no encontrado. Asegúrate de que esté instalado y en tu PATH. "
+                      "Para Windows, considera añadir: pytesseract.pytesseract.tesseract_cmd = r'RUTA/A/TESSERACT.EXE'")
             raise # Lanzar la excepción para que Streamlit la capture y la muestre al usuario
         except Exception as e:
-            print(f"ERROR al ejecutar OCR en la imagen {image_path}: {e}")
-            traceback.print_exc()
+            log.exception("Error al ejecutar OCR en la imagen: %s", e)
             return f"ERROR: No se pudo extraer texto con OCR. Detalles: {e}"
 
+    def extract_texts_batch(self, images: list) -> list:
+        """
+        Aplica OCR a varias imágenes en memoria (p. ej. varias regiones de una misma captura).
+        A partir de EASYOCR_MIN_BATCH imágenes, si EasyOCR está instalado, se procesan en un solo lote
+        (perform_ocr_on_images). Si no, con tesserocr se reutiliza el motor cargado para todas y con
+        pytesseract los procesos 'tesseract' se lanzan en paralelo.
+        Args:
+            images (list): Lista de PIL.Image.
+        Returns:
+            list: Texto extraído (o mensaje 'ERROR: ...') por cada imagen, en el mismo orden.
+        """
+        if not images:
+            return []
+        if len(images) >= EASYOCR_MIN_BATCH and self._get_easyocr_reader() is not None:
+            return self.perform_ocr_on_images([np.asarray(img.convert("RGB")) for img in images])
+        if _tesserocr is not None and self._get_ocr_api() is not None:
+            return [self.extract_text_from_pil(img) for img in images]
+        with ThreadPoolExecutor(max_workers=min(4, len(images)), thread_name_prefix="ocr") as executor:
+            return list(executor.map(self.extract_text_from_pil, images))
+
+    def perform_ocr_on_images(self, images: list, n_width: int = 800, n_height: int = 600) -> list:
+        """
+        OCR por lotes con EasyOCR (una sola pasada del modelo, en GPU si está disponible).
+        Si EasyOCR no está instalado, cada imagen se procesa con Tesseract.
+        Args:
+            images (list): Rutas de archivo o np.ndarray RGB.
+            n_width, n_height (int): Tamaño al que EasyOCR redimensiona las imágenes para agruparlas en un lote.
+        Returns:
+            list: Texto extraído (o mensaje 'ERROR: ...') por cada imagen, en el mismo orden.
+        """
+        if not images:
+            return []
+        reader = self._get_easyocr_reader()
+        if reader is None:
+            return [self.perform_ocr_on_image(img) if isinstance(img, str) else self._run_ocr(Image.fromarray(img))
+                    for img in images]
+        try:
+            log.debug("Ejecutando OCR por lotes con EasyOCR en %s imágenes...", len(images))
+            with self._easyocr_lock: # El lector no es seguro entre hilos
+                results = reader.readtext_batched(images, n_width=n_width, n_height=n_height, detail=0)
+            return [" ".join(texts).strip() for texts in results]
+        except Exception as e:
+            log.exception("Error al ejecutar OCR por lotes con EasyOCR: %s", e)
+            return [f"ERROR: No se pudo extraer texto con OCR. Detalles: {e}"] * len(images)
+
     def describe_image_with_ai(self, image_path: str) -> tuple[str, list, str, str, str]:
         """
         Genera una descripción detallada, palabras clave, clasificación de tipo de elemento,
@@ -77,125 +449,349 @@ class ImageProcessor:
             image_path (str): Ruta al archivo de imagen.
         Returns:
             tuple: (description: str, keywords: list, element_type: str, ocr_text: str, ai_extracted_text: str)
+            Las respuestas correctas se cachean en disco por contenido de la imagen (VISION_CACHE_DIR).
         """
+        ocr_text = ""
         try:
-            if not os.path.exists(image_path):
-                raise FileNotFoundError(f"La imagen no se encontró en: {image_path}")
+            image_hash, cached = self._cached_description(image_path)
+            if cached is not None:
+                return cached
             
             # --- Paso 1: Ejecutar OCR para obtener texto de forma programática ---
-            # Ahora llamamos al método público que también puede ser usado por la pestaña de OCR
-            ocr_text = self.perform_ocr_on_image(image_path) 
+            # Ahora llamamos al método público que también puede ser usado por la pestaña de OCR.
+            # El OCR no depende de la respuesta de OpenAI: se lanza en segundo plano y se solapa con la llamada
+            # a la API (Tesseract libera el GIL), de modo que la latencia total es la mayor de las dos, no la suma.
+            ocr_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ocr")
+            ocr_future = ocr_executor.submit(self.perform_ocr_on_image, image_path)
+            ocr_executor.shutdown(wait=False)
 
             # --- Paso 2: Preparar la imagen para la API de OpenAI ---
             base64_image = self._encode_image_to_base64(image_path)
             
-            prompt_content = (
-                "Eres un experto analista de interfaces de usuario (UI) y tu tarea es describir con máxima precisión "
-                "el elemento visual en la siguiente imagen. Tu objetivo es proporcionar una descripción exhaustiva "
-                "que permita identificar unívocamente el elemento y su función.\n\n"
-                
-                "Detalles a identificar y describir (en orden de prioridad):\n"
-                "1.  **Tipo de Elemento UI:** Clasifica el elemento en una de las siguientes categorías estrictas: 'icono', 'pestaña', 'campo_texto', 'boton', 'desplegable', 'enlace', 'barra_desplazamiento', 'menu', 'ventana', 'fondo', 'otro'. Selecciona la más específica posible.\n"
-                "2.  **Texto Visible Principal:** Identifica y transcribe textualmente cualquier texto visible directamente en el elemento (ej. 'Guardar', 'Cancelar', 'Inicio', 'Usuario', un número, etc.). Si no hay texto, indica 'Ninguno'.\n"
-                "3.  **Propósito/Función:** Describe brevemente la acción que realiza el elemento o su significado semántico en el contexto de una UI.\n"
-                "4.  **Características Visuales:** Colores predominantes, forma (rectangular, circular, etc.), tamaño relativo (si es posible inferirlo), bordes, sombreado, y otros detalles estéticos o de diseño relevantes.\n"
-                "5.  **Contenido de Icono/Gráfico:** Si es un icono o gráfico, describe claramente su representación visual (ej. 'un disquete', 'una lupa', 'tres líneas horizontales').\n\n"
-
-                "Genera también una lista de palabras clave relevantes para la búsqueda y clasificación. Estas deben incluir: "
-                "el texto visible, el tipo de elemento UI, y términos descriptivos de su función o apariencia.\n\n"
-
-                "Tu respuesta debe seguir este formato estricto. Si un campo no aplica (ej. 'Texto visible' si no hay), indica 'Ninguno'.\n"
-                "Descripción: [Descripción detallada y concisa del elemento, incluyendo los puntos anteriores de forma narrativa.]\n"
-                "Texto visible extraído por IA: [Texto directo visible en el elemento, o 'Ninguno']\n"
-                "Palabras clave: [palabra1, palabra2, ...]\n"
-                "Tipo de elemento: [Tipo de elemento de UI de la lista proporcionada]"
-            )
-            
-            print(f"DEBUG: Enviando solicitud a OpenAI con modelo {self.vision_model}...")
-            response = self.openai_client.chat.completions.create(
-                model=self.vision_model,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt_content},
-                            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64_image}"}},
-                        ],
-                    }
-                ],
-                max_tokens=500,
-            )
-            
-            text_response = response.choices[0].message.content.strip()
-            print(f"DEBUG: Respuesta cruda de OpenAI:\n{text_response}\n---")
-            
-            description = ""
-            keywords = []
-            element_type = "otro"
-            ai_extracted_text = "Ninguno" # Inicializar el nuevo campo
-
-            # Parsear la respuesta
-            lines = text_response.split('\n')
-            for line in lines:
-                if line.startswith("Descripción:"):
-                    description = line.replace("Descripción:", "").strip()
-                elif line.startswith("Texto visible extraído por IA:"): # Nuevo campo a parsear
-                    ai_extracted_text = line.replace("Texto visible extraído por IA:", "").strip()
-                elif line.startswith("Palabras clave:"):
-                    keywords_str = line.replace("Palabras clave:", "").strip()
-                    if keywords_str:
-                        keywords = [k.strip() for k in keywords_str.split(',') if k.strip()]
-                    else:
-                        keywords = []
-                elif line.startswith("Tipo de elemento:"):
-                    element_type = line.replace("Tipo de elemento:", "").strip().lower()
-            
-            print(f"DEBUG: Descripción extraída: {description}")
-            print(f"DEBUG: Texto visible extraído por IA: {ai_extracted_text}") # Debug del nuevo campo
-            print(f"DEBUG: Palabras clave extraídas: {keywords}")
-            print(f"DEBUG: Tipo de elemento extraído: {element_type}")
+            log.debug("Enviando solicitud a OpenAI con modelo %s...", self.vision_model)
+            try:
+                response = self.openai_client.chat.completions.create(**self._vision_request(base64_image))
+            finally:
+                # Recoger el OCR también si la llamada a OpenAI falla (los manejadores de error lo devuelven)
+                ocr_text = ocr_future.result()
             
-            # Devolver todos los valores, incluyendo el texto del OCR y el de la IA
-            return description, keywords, element_type, ocr_text, ai_extracted_text
-        except FileNotFoundError as fnfe:
-            print(f"Error: {fnfe}")
+            return self._finish_description(response.choices[0].message.content, ocr_text, image_hash)
+        except Exception as e:
+            return self._vision_error_result(e, ocr_text)
+
+    async def describe_image_with_ai_async(self, image_path: str) -> tuple[str, list, str, str, str]:
+        """
+        Versión asíncrona de describe_image_with_ai (mismo resultado, misma caché): la llamada a OpenAI usa
+        el cliente asíncrono y el OCR, la lectura y la codificación de la imagen se ejecutan en hilos, de modo
+        que un solo bucle de eventos puede describir muchas imágenes a la vez con asyncio.gather.
+        """
+        ocr_text = ""
+        try:
+            image_hash, cached = await asyncio.to_thread(self._cached_description, image_path)
+            if cached is not None:
+                return cached
+
+            ocr_task = asyncio.create_task(asyncio.to_thread(self.perform_ocr_on_image, image_path))
+            base64_image = await asyncio.to_thread(self._encode_image_to_base64, image_path)
+
+            log.debug("Enviando solicitud asíncrona a OpenAI con modelo %s...", self.vision_model)
+            try:
+                response = await self.async_openai_client.chat.completions.create(**self._vision_request(base64_image))
+            finally:
+                ocr_text = await ocr_task
+
+            return self._finish_description(response.choices[0].message.content, ocr_text, image_hash)
+        except Exception as e:
+            return self._vision_error_result(e, ocr_text)
+
+    def _cached_description(self, image_path: str) -> tuple:
+        """
+        Calcula el hash del contenido de la imagen y busca su descripción en la caché.
+        Returns:
+            tuple: (hash, descripción cacheada como tupla o None)
+        Raises:
+            FileNotFoundError: Si la imagen no existe.
+        """
+        if not os.path.exists(image_path):
+            raise FileNotFoundError(f"La imagen no se encontró en: {image_path}")
+
+        with open(image_path, "rb") as image_file:
+            image_hash = hashlib.blake2b(image_file.read(), digest_size=16).hexdigest()
+        cached = self._vision_cache.get(image_hash)
+        if cached is not None:
+            log.debug("Descripción recuperada de la caché para la imagen %s (%s).", image_path, image_hash)
+            return image_hash, tuple(cached)
+        return image_hash, None
+
+    def _vision_request(self, base64_image: str) -> dict:
+        """Argumentos de chat.completions.create para describir una imagen (comunes a las versiones síncrona y asíncrona)."""
+        return dict(
+            model=self.vision_model,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": _VISION_PROMPT},
+                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64_image}"}},
+                    ],
+                }
+            ],
+            max_tokens=500,
+            response_format={"type": "json_object"},
+        )
+
+    def _finish_description(self, text_response: str, ocr_text: str, image_hash: str) -> tuple:
+        """Interpreta la respuesta de OpenAI, guarda el resultado en la caché si está completo y lo devuelve."""
+        text_response = text_response.strip()
+        log.debug("Respuesta cruda de OpenAI:\n%s\n---", text_response)
+        
+        try:
+            description, keywords, element_type, ai_extracted_text = _vision_fields(_json_loads(text_response))
+        except (ValueError, TypeError, AttributeError):
+            # Respuesta que no es un objeto JSON: interpretar el formato de líneas "Campo: valor".
+            # Una sola pasada de la expresión regular (si un campo se repite, gana el último)
+            fields = {m.group(1): m.group(2).strip() for m in _RESPONSE_FIELD_RE.finditer(text_response)}
+            description = fields.get("Descripción", "")
+            ai_extracted_text = fields.get("Texto visible extraído por IA", "Ninguno")
+            keywords = [k for k in _KEYWORD_SPLIT_RE.split(fields.get("Palabras clave", "")) if k]
+            element_type = fields.get("Tipo de elemento", "otro").lower()
+        
+        log.debug("Descripción extraída: %s", description)
+        log.debug("Texto visible extraído por IA: %s", ai_extracted_text)
+        log.debug("Palabras clave extraídas: %s", keywords)
+        log.debug("Tipo de elemento extraído: %s", element_type)
+        
+        result = (description, keywords, element_type, ocr_text, ai_extracted_text)
+        if description and not ocr_text.startswith("ERROR"): # Solo se cachean las respuestas completas
+            self._vision_cache.put(image_hash, list(result))
+        # Devolver todos los valores, incluyendo el texto del OCR y el de la IA
+        return result
+
+    @staticmethod
+    def _vision_error_result(error: Exception, ocr_text: str) -> tuple:
+        """Registra el error de describe_image_with_ai(_async) y devuelve el resultado vacío correspondiente."""
+        if isinstance(error, FileNotFoundError):
+            log.error("%s", error)
             return "", [], "otro", "ERROR: Imagen no encontrada", "Ninguno"
-        except RateLimitError:
-            print("Error: Se ha alcanzado el límite de tasa de OpenAI. Por favor, espera y reintenta.")
+        if isinstance(error, RateLimitError):
+            log.error("Se ha alcanzado el límite de tasa de OpenAI. Por favor, espera y reintenta.")
             return "", [], "otro", ocr_text, "Ninguno" # Devolvemos ocr_text si se obtuvo
-        except APIConnectionError as ace:
-            print(f"Error de conexión a la API de OpenAI: {ace}. Verifica tu conexión a internet o la URL de la API.")
+        if isinstance(error, APIConnectionError):
+            log.error("Error de conexión a la API de OpenAI: %s. Verifica tu conexión a internet o la URL de la API.", error)
             return "", [], "otro", ocr_text, "Ninguno"
-        except pytesseract.TesseractNotFoundError:
-            # Captura aquí para un mensaje más amigable al usuario en la consola si este error ocurre
-            # dentro de describe_image_with_ai.
-            print("ERROR: Tesseract OCR no está instalado o no se encuentra en el PATH. "
-                  "Por favor, instálalo desde https://tesseract-ocr.github.io/tessdoc/Installation.html "
-                  "y asegúrate de que esté en tu PATH o configura pytesseract.pytesseract.tesseract_cmd.")
+        if isinstance(error, pytesseract.TesseractNotFoundError):
+            # Mensaje más amigable al usuario en la consola si este error ocurre al describir una imagen
+            log.error("Tesseract OCR no está instalado o no se encuentra en el PATH. "
+                      "Por favor, instálalo desde https://tesseract-ocr.github.io/tessdoc/Installation.html "
+                      "y asegúrate de que esté en tu PATH o configura pytesseract.pytesseract.tesseract_cmd.")
             return "", [], "otro", "ERROR: Tesseract OCR no encontrado", "Ninguno"
+        log.error("Error inesperado al describir la imagen con OpenAI: %s", error, exc_info=error)
+        return "", [], "otro", ocr_text, "Ninguno"
+
+    def describe_images_with_ai(self, image_paths: list) -> list:
+        """
+        Versión por lotes de describe_image_with_ai para ingerir muchos recortes: envía hasta VISION_BATCH_SIZE
+        imágenes en un solo mensaje a GPT-4o (respuesta JSON) en lugar de una petición por imagen.
+        Las imágenes ya descritas se sirven desde la caché; si la respuesta de un lote no se puede interpretar,
+        sus imágenes se describen una a una.
+        Args:
+            image_paths (list): Rutas a los archivos de imagen.
+        Returns:
+            list: Una tupla (description, keywords, element_type, ocr_text, ai_extracted_text) por imagen, en el mismo orden.
+        """
+        results = [None] * len(image_paths)
+        pending = [] # (posición, ruta, hash) de las imágenes no cacheadas
+        for i, image_path in enumerate(image_paths):
+            try:
+                with open(image_path, "rb") as image_file:
+                    image_hash = hashlib.blake2b(image_file.read(), digest_size=16).hexdigest()
+            except OSError as e:
+                log.error("No se pudo leer la imagen %s: %s", image_path, e)
+                results[i] = ("", [], "otro", "ERROR: Imagen no encontrada", "Ninguno")
+                continue
+            cached = self._vision_cache.get(image_hash)
+            if cached is not None:
+                results[i] = tuple(cached)
+            else:
+                pending.append((i, image_path, image_hash))
+
+        chunks = [pending[start:start + VISION_BATCH_SIZE] for start in range(0, len(pending), VISION_BATCH_SIZE)]
+        if len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=min(len(chunks), VISION_CONCURRENCY), thread_name_prefix="vision") as executor:
+                chunk_results = list(executor.map(self._describe_chunk, chunks))
+        else:
+            chunk_results = [self._describe_chunk(chunk) for chunk in chunks]
+        for chunk, described in zip(chunks, chunk_results):
+            for (i, _, _), result in zip(chunk, described):
+                results[i] = result
+        return results
+
+    def _describe_chunk(self, chunk: list) -> list:
+        """Describe un lote de imágenes (posición, ruta, hash) con una sola petición a OpenAI."""
+        paths = [image_path for _, image_path, _ in chunk]
+        # OCR de todas las imágenes en paralelo mientras se hace la petición a OpenAI
+        ocr_executor = ThreadPoolExecutor(max_workers=min(4, len(paths)), thread_name_prefix="ocr")
+        ocr_futures = [ocr_executor.submit(self.perform_ocr_on_image, image_path) for image_path in paths]
+        ocr_executor.shutdown(wait=False)
+
+        ocr_texts = None
+        try:
+            content = [{"type": "text", "text": _BATCH_VISION_PROMPT.format(n=len(paths), last=len(paths) - 1)}]
+            content += [
+                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{self._encode_image_to_base64(image_path)}"}}
+                for image_path in paths
+            ]
+            log.debug("Enviando %s imágenes en una sola solicitud a OpenAI con modelo %s...", len(paths), self.vision_model)
+            try:
+                response = self.openai_client.chat.completions.create(
+                    model=self.vision_model,
+                    messages=[{"role": "user", "content": content}],
+                    response_format={"type": "json_object"},
+                    max_tokens=400 * len(paths),
+                )
+            finally:
+                ocr_texts = [future.result() for future in ocr_futures]
         except Exception as e:
-            print(f"Error inesperado al describir la imagen con OpenAI: {e}")
-            traceback.print_exc()
-            return "", [], "otro", ocr_text, "Ninguno"
+            log.exception("Error al describir el lote de imágenes con OpenAI: %s", e)
+            # Mismo resultado que describe_image_with_ai ante un error de la API: sin descripción, con el OCR si se obtuvo
+            return [("", [], "otro", ocr_text, "Ninguno") for ocr_text in (ocr_texts or [""] * len(paths))]
+
+        try:
+            items = {int(item["index"]): item for item in _json_loads(response.choices[0].message.content)["items"]}
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning("Respuesta por lotes de OpenAI no válida (%s): se describen las imágenes una a una.", e)
+            items = {}
 
-    def generate_embedding_from_text(self, text: str) -> list[float]:
+        results = []
+        for index, ((_, image_path, image_hash), ocr_text) in enumerate(zip(chunk, ocr_texts)):
+            item = items.get(index)
+            if not item or not item.get("description"):
+                results.append(self.describe_image_with_ai(image_path)) # Respuesta ausente o incompleta para esta imagen
+                continue
+            description, keywords, element_type, ai_extracted_text = _vision_fields(item)
+            result = (description, keywords, element_type, ocr_text, ai_extracted_text)
+            if not ocr_text.startswith("ERROR"):
+                self._vision_cache.put(image_hash, list(result))
+            results.append(result)
+        return results
+
+    def process_clipping(self, image_path: str) -> dict:
+        """
+        Procesa un recorte en una sola llamada: descripción con IA y OCR (en paralelo, ver describe_image_with_ai),
+        texto para el embedding (embedding_text) y embedding.
+        Args:
+            image_path (str): Ruta al archivo de imagen.
+        Returns:
+            dict: {description, keywords, element_type, ocr_text, ai_extracted_text, text_for_embedding, embedding}.
+                  'embedding' (np.ndarray float32 de 384 valores) es None si no se obtuvo descripción.
+        """
+        description, keywords, element_type, ocr_text, ai_extracted_text = self.describe_image_with_ai(image_path)
+        text_for_embedding = embedding_text(description, ocr_text, ai_extracted_text) if description else ""
+        return {
+            "description": description,
+            "keywords": keywords,
+            "element_type": element_type,
+            "ocr_text": ocr_text,
+            "ai_extracted_text": ai_extracted_text,
+            "text_for_embedding": text_for_embedding,
+            "embedding": self.generate_embedding_from_text(text_for_embedding) if description else None,
+        }
+
+    async def process_clipping_async(self, image_path: str) -> dict:
+        """
+        Versión asíncrona de process_clipping: la descripción con IA y el OCR se solapan igual que en
+        describe_image_with_ai_async, y el embedding (que depende de la descripción) se genera en un hilo.
+        Permite procesar varios recortes a la vez con asyncio.gather (lanzado con utils.http_utils.run_async).
+        """
+        description, keywords, element_type, ocr_text, ai_extracted_text = await self.describe_image_with_ai_async(image_path)
+        text_for_embedding = embedding_text(description, ocr_text, ai_extracted_text) if description else ""
+        embedding = await asyncio.to_thread(self.generate_embedding_from_text, text_for_embedding) if description else None
+        return {
+            "description": description,
+            "keywords": keywords,
+            "element_type": element_type,
+            "ocr_text": ocr_text,
+            "ai_extracted_text": ai_extracted_text,
+            "text_for_embedding": text_for_embedding,
+            "embedding": embedding,
+        }
+
+    def generate_embedding_from_text(self, text: str) -> np.ndarray:
         """
         Genera un embedding de texto de 384 dimensiones utilizando 'all-MiniLM-L6-v2'.
+        Envoltorio de generate_embeddings_from_texts para un solo texto (misma caché y mismo criterio de error).
+        Returns:
+            np.ndarray: Vector float32 de 384 valores (ya normalizado por el modelo); Qdrant lo acepta directamente.
+        """
+        if not isinstance(text, str):
+            raise TypeError(f"Se esperaba un texto para generar el embedding, no {type(text).__name__}")
+        return self.generate_embeddings_from_texts([text])[0]
+
+    def generate_embedding_list(self, text: str) -> list[float]:
+        """Como generate_embedding_from_text, pero como lista de floats (para quien necesite serializarlo, p. ej. a JSON)."""
+        return self.generate_embedding_from_text(text).tolist()
+
+    def generate_embeddings_from_texts(self, texts: list[str]) -> np.ndarray:
         """
+        Genera los embeddings de varios textos en una sola pasada por lotes del modelo 'all-MiniLM-L6-v2'
+        (en lotes de EMBEDDING_BATCH_SIZE). Los textos ya codificados (misma cadena tras strip/lower) se sirven
+        desde la caché sin pasar por el modelo.
+        Args:
+            texts (list[str]): Textos a codificar.
+        Returns:
+            np.ndarray: Matriz float32 de forma (len(texts), 384), en el mismo orden que 'texts'.
+                        Las filas que no se pudieron generar son ceros.
+        """
+        if not texts:
+            return np.empty((0, EMBEDDING_DIMENSION), dtype=np.float32)
+
+        keys = [text.strip().lower() for text in texts]
+        embeddings = np.empty((len(texts), EMBEDDING_DIMENSION), dtype=np.float32)
+        missing = []
+        for i, key in enumerate(keys):
+            cached = self._cached_embedding(key)
+            if cached is None:
+                missing.append(i)
+            else:
+                embeddings[i] = cached
+        if not missing:
+            return embeddings # Todo en caché: ni siquiera hace falta cargar el modelo
+
         if self.sentence_transformer_model is None:
             raise RuntimeError("El modelo de Sentence Transformer no se cargó correctamente. No se pueden generar embeddings.")
-        
         try:
-            print(f"DEBUG: Generando embedding para el texto: '{text[:50]}...'")
-            embedding = self.sentence_transformer_model.encode(text).tolist()
-            if len(embedding) != 384:
-                raise ValueError(f"El embedding generado no tiene la dimensión esperada (384), sino {len(embedding)}")
-            print("DEBUG: Embedding generado exitosamente.")
-            return embedding
+            log.debug("Generando %s de %s embeddings por lotes...", len(missing), len(texts))
+            # encode ya ordena los textos por longitud dentro de cada llamada para minimizar el relleno
+            encoded = self.sentence_transformer_model.encode(
+                [texts[i] for i in missing], batch_size=min(len(missing), EMBEDDING_BATCH_SIZE), convert_to_numpy=True
+            )
+            encoded = np.ascontiguousarray(encoded, dtype=np.float32)
+            if encoded.shape != (len(missing), EMBEDDING_DIMENSION):
+                raise ValueError(f"Los embeddings generados no tienen la forma esperada ({len(missing)}, {EMBEDDING_DIMENSION}), sino {encoded.shape}")
+            for i, row in zip(missing, encoded):
+                embeddings[i] = row
+                self._store_embedding(keys[i], row.copy())
+            log.debug("Embeddings generados exitosamente.")
+            return embeddings
         except Exception as e:
-            print(f"Error al generar embedding de texto: {e}")
-            traceback.print_exc()
-            return [0.0] * 384 
+            log.exception("Error al generar embeddings de texto por lotes: %s", e)
+            embeddings[missing] = 0.0
+            return embeddings
+
+    def _cached_embedding(self, key: str):
+        """Busca el embedding del texto normalizado 'key' en memoria y, si no está, en disco."""
+        cached = self._embedding_cache.get(key)
+        if cached is None:
+            cached = self._embedding_disk_cache.get(key)
+            if cached is not None:
+                self._embedding_cache.put(key, cached)
+        return cached
+
+    def _store_embedding(self, key: str, embedding: np.ndarray) -> None:
+        """Guarda un embedding recién calculado en ambos niveles de la caché."""
+        embedding.setflags(write=False) # Se comparte entre llamadas: congelarlo
+        self._embedding_cache.put(key, embedding)
+        self._embedding_disk_cache.put(key, embedding)
 
 # Ejemplo de uso (para pruebas directas de este módulo)
 if __name__ == "__main__":
@@ -1,6 +1,5 @@
 import os
 import uuid
-from PIL import Image
 import pyautogui # Para hacer clic en las coordenadas encontradas
 import time # Para pausas entre acciones
 import traceback # Para depuración de errores
@@ -8,10 +7,10 @@ from typing import Optional # Importar Optional para las anotaciones de tipo
 
 # Importar las clases y funciones necesarias de nuestros módulos
 from qdrant_handler import QdrantHandler
-from image_processor import ImageProcessor
-# take_screenshot ahora devuelve un objeto PIL.Image
-# find_image_on_screen debe poder tomar un objeto PIL.Image para la 'screenshot_image'
-from utils.screen_utils import take_screenshot, find_image_on_screen, get_monitor_info 
+from image_processor import ImageProcessor, embedding_text, copy_clipping_file
+# take_screenshot_gray devuelve la captura ya en escala de grises (np.ndarray), el formato con el que
+# find_image_on_screen hace el matchTemplate de OpenCV
+from utils.screen_utils import take_screenshot_gray, find_image_on_screen, get_monitor_info 
 
 CLIPPINGS_DIR = "clippings"
 os.makedirs(CLIPPINGS_DIR, exist_ok=True) # Asegurarse de que la carpeta exista
@@ -20,6 +19,15 @@ os.makedirs(CLIPPINGS_DIR, exist_ok=True) # Asegurarse de que la carpeta exista
 qdrant_handler = QdrantHandler()
 image_processor = ImageProcessor()
 
+# Cargar y calentar el modelo de embeddings al importar, para que la primera instrucción no pague la carga de
+# los pesos ni la primera pasada (inicialización de CUDA, asignación de buffers). Se llama a encode directamente:
+# generate_embedding_from_text serviría "warmup" desde la caché sin pasar por el modelo.
+if os.getenv("WARM_EMBED", "1") == "1":
+    try:
+        image_processor.sentence_transformer_model.encode("warmup")
+    except Exception as e:
+        print(f"Advertencia: No se pudo calentar el modelo de embeddings: {e}")
+
 def process_and_store_clipping(clipping_image_path: str):
     """
     Procesa un recorte de imagen: obtiene descripción, palabras clave, tipo,
@@ -37,41 +45,21 @@ def process_and_store_clipping(clipping_image_path: str):
         return None
 
     try:
-        # 1. Obtener descripción, palabras clave, tipo de elemento, texto OCR y texto visible por IA
-        print(f"DEBUG: Generando descripción para '{clipping_image_path}' con IA y OCR...")
-        # CAMBIO CLAVE 1: describe_image_with_ai ahora devuelve ocr_text y ai_extracted_text
-        description, keywords, element_type, ocr_text, ai_extracted_text = image_processor.describe_image_with_ai(clipping_image_path)
+        # 1. Obtener descripción, palabras clave, tipo de elemento, texto OCR y texto visible por IA,
+        #    y el embedding de la descripción (combinada con el texto OCR o IA si son más descriptivos)
+        print(f"DEBUG: Generando descripción y embedding para '{clipping_image_path}' con IA y OCR...")
+        clipping = image_processor.process_clipping(clipping_image_path)
+        description, keywords, element_type = clipping["description"], clipping["keywords"], clipping["element_type"]
+        ocr_text, ai_extracted_text = clipping["ocr_text"], clipping["ai_extracted_text"]
         
         if not description:
             print("Error: No se pudo generar una descripción con IA. Abortando.")
             return None
         print(f"DEBUG: Descripción IA: '{description}' | Texto IA: '{ai_extracted_text}' | Texto OCR: '{ocr_text}' | Palabras clave: {keywords} | Tipo: {element_type}")
 
-        # 2. Generar embedding de la descripción (priorizando el texto OCR o IA si son más descriptivos)
-        print("DEBUG: Generando embedding de la descripción (combinando IA y OCR si es necesario)...")
-        
-        # Estrategia para combinar textos para el embedding:
-        # Priorizamos el texto visible de la IA si es significativo.
-        # Si el OCR detecta texto y el texto de la IA es "Ninguno" o menos completo, lo incorporamos.
-        text_for_embedding = description # La descripción base de la IA
-        
-        # Si la IA no extrajo texto visible pero el OCR sí, o si el OCR es más extenso
-        if (ai_extracted_text.lower() == "ninguno" or len(ocr_text) > len(ai_extracted_text)) and \
-           ocr_text and "ERROR" not in ocr_text: # Asegurarse de que OCR no devolvió un error
-            text_for_embedding = f"{description}. Texto detectado: {ocr_text}"
-        elif ai_extracted_text.lower() != "ninguno" and ai_extracted_text not in description:
-            # Si la IA extrajo texto visible y no está ya en la descripción, lo añadimos
-            text_for_embedding = f"{description}. Texto visible: {ai_extracted_text}"
-        
-        # Si ambos tienen texto y no están ya en la descripción, combinarlos
-        if ai_extracted_text.lower() != "ninguno" and ocr_text and "ERROR" not in ocr_text:
-            if ai_extracted_text not in text_for_embedding and ocr_text not in text_for_embedding:
-                text_for_embedding = f"{description}. Texto visible: {ai_extracted_text}. OCR: {ocr_text}"
-            elif ocr_text not in text_for_embedding:
-                 text_for_embedding = f"{text_for_embedding}. OCR: {ocr_text}"
-
-
-        embedding = image_processor.generate_embedding_from_text(text_for_embedding)
+        # 2. Comprobar el embedding generado
+        text_for_embedding = clipping["text_for_embedding"]
+        embedding = clipping["embedding"]
         
         if len(embedding) != qdrant_handler.VECTOR_DIMENSION:
             print(f"Error: El embedding generado tiene dimensión {len(embedding)}, se esperaba {qdrant_handler.VECTOR_DIMENSION}. Abortando.")
@@ -106,7 +94,7 @@ def process_and_store_clipping(clipping_image_path: str):
 
         # 7. Mover/Copiar el archivo de recorte a la carpeta 'clippings' con el ID como nombre
         print(f"DEBUG: Guardando recorte en: {final_clipping_path}...")
-        Image.open(clipping_image_path).save(final_clipping_path)
+        copy_clipping_file(clipping_image_path, final_clipping_path)
         print(f"Recorte guardado en: {final_clipping_path}")
 
         print(f"Proceso de almacenamiento de recorte completado con éxito. ID: {point_id}")
@@ -117,6 +105,82 @@ def process_and_store_clipping(clipping_image_path: str):
         traceback.print_exc() # Imprime el stack trace para depuración
         return None
 
+def ingest_clipping_batch(clipping_image_paths: list) -> list:
+    """
+    Versión por lotes de process_and_store_clipping para ingerir muchos recortes (p. ej. una carpeta):
+    las descripciones se piden a OpenAI en lotes concurrentes (describe_images_with_ai), los embeddings
+    se generan en una sola llamada al modelo y los puntos se almacenan en Qdrant en una sola petición.
+    Args:
+        clipping_image_paths (list[str]): Rutas a los recortes originales, o a una carpeta con ellos.
+    Returns:
+        list: El ID en Qdrant de cada recorte, en el mismo orden (None para los que fallaron).
+    """
+    if isinstance(clipping_image_paths, str) and os.path.isdir(clipping_image_paths):
+        folder = clipping_image_paths
+        clipping_image_paths = sorted(
+            os.path.join(folder, name) for name in os.listdir(folder)
+            if name.lower().endswith((".png", ".jpg", ".jpeg", ".bmp"))
+        )
+    print(f"\n--- Procesando y almacenando {len(clipping_image_paths)} recortes ---")
+    point_ids = [None] * len(clipping_image_paths)
+
+    try:
+        existing = [(i, path) for i, path in enumerate(clipping_image_paths) if os.path.exists(path)]
+        for path in set(clipping_image_paths) - {path for _, path in existing}:
+            print(f"Error: El archivo de recorte '{path}' no existe.")
+
+        # 1. Descripciones con IA y OCR de todos los recortes
+        descriptions = image_processor.describe_images_with_ai([path for _, path in existing])
+        described = []
+        for (i, path), (description, keywords, element_type, ocr_text, ai_extracted_text) in zip(existing, descriptions):
+            if not description:
+                print(f"Error: No se pudo generar una descripción con IA para '{path}'.")
+                continue
+            described.append((i, path, description, keywords, element_type, ocr_text, ai_extracted_text))
+        if not described:
+            return point_ids
+
+        # 2. Embeddings de todos los recortes en una sola llamada al modelo
+        texts = [embedding_text(description, ocr_text, ai_extracted_text)
+                 for _, _, description, _, _, ocr_text, ai_extracted_text in described]
+        embeddings = image_processor.generate_embeddings_from_texts(texts)
+
+        # 3. Puntos para Qdrant (mismo payload que process_and_store_clipping)
+        points = []
+        for (i, path, description, keywords, element_type, ocr_text, ai_extracted_text), embedding in zip(described, embeddings):
+            if not embedding.any():
+                print(f"Error: No se pudo generar el embedding para '{path}'.")
+                continue
+            point_id = str(uuid.uuid4())
+            payload = {
+                "image_id": point_id,
+                "image_path": os.path.join(CLIPPINGS_DIR, f"{point_id}.png"),
+                "description": description,
+                "keywords": keywords,
+                "type": element_type,
+                "ocr_text": ocr_text,
+                "ai_extracted_text": ai_extracted_text,
+                "original_file_name": os.path.basename(path)
+            }
+            points.append((i, path, point_id, embedding, payload))
+
+        # 4. Almacenar todos los puntos en Qdrant en una sola petición
+        if not qdrant_handler.upsert_batch([(point_id, embedding, payload) for _, _, point_id, embedding, payload in points]):
+            print("Falló el almacenamiento en Qdrant del lote de recortes. Abortando.")
+            return point_ids
+
+        # 5. Copiar los recortes a la carpeta 'clippings' con el ID como nombre
+        for i, path, point_id, _, payload in points:
+            copy_clipping_file(path, payload["image_path"])
+            point_ids[i] = point_id
+        print(f"Proceso de almacenamiento completado: {len(points)} de {len(clipping_image_paths)} recortes almacenados.")
+        return point_ids
+
+    except Exception as e:
+        print(f"Error general al procesar y almacenar el lote de recortes: {e}")
+        traceback.print_exc() # Imprime el stack trace para depuración
+        return point_ids
+
 # MODIFICACIÓN CLAVE AQUÍ: Usar Optional[int] para indicar que monitor_to_capture puede ser int o None
 def execute_action_from_text(instruction: str, monitor_to_capture: Optional[int] = None, confidence: float = 0.9):
     """
@@ -129,20 +193,57 @@ def execute_action_from_text(instruction: str, monitor_to_capture: Optional[int]
     Returns:
         bool: True si la acción se ejecutó, False en caso contrario.
     """
-    print(f"\n--- Ejecutando acción para la instrucción: '{instruction}' ---")
+    return execute_actions_from_texts([instruction], monitor_to_capture, confidence)[0]
+
+def execute_actions_from_texts(instructions: list, monitor_to_capture: Optional[int] = None, confidence: float = 0.9) -> list:
+    """
+    Versión por lotes de execute_action_from_text: los embeddings de todas las instrucciones se generan en una
+    sola llamada al modelo y los recortes se buscan en una sola petición a Qdrant (search_batch); después se
+    ejecuta la acción de cada instrucción, en orden.
+    Args:
+        instructions (list[str]): Instrucciones de texto del usuario.
+        monitor_to_capture (int, optional): El ID del monitor a capturar (None para todos).
+        confidence (float): Nivel de confianza para la detección de imagen.
+    Returns:
+        list[bool]: Para cada instrucción, True si la acción se ejecutó y False en caso contrario.
+    """
+    if not instructions:
+        return []
     try:
-        # 1. Generar embedding de la instrucción
-        print(f"DEBUG: Generando embedding de la instrucción: '{instruction}'...")
-        query_embedding = image_processor.generate_embedding_from_text(instruction)
-        if len(query_embedding) != qdrant_handler.VECTOR_DIMENSION:
-            print("Error: El embedding de la instrucción no tiene la dimensión esperada. Abortando búsqueda.")
-            return False
-        print("DEBUG: Embedding de la instrucción generado.")
+        # 1. Generar los embeddings de las instrucciones
+        print(f"DEBUG: Generando embeddings de {len(instructions)} instrucción(es)...")
+        query_embeddings = image_processor.generate_embeddings_from_texts(instructions)
+        # El modelo devuelve una fila de ceros por cada texto que no pudo procesar: esas no se buscan
+        valid = []
+        for i, embedding in enumerate(query_embeddings):
+            if embedding.any():
+                valid.append(i)
+            else:
+                print(f"Error: No se pudo generar el embedding para la instrucción '{instructions[i]}'.")
+        if not valid:
+            return [False] * len(instructions)
+        print("DEBUG: Embeddings de las instrucciones generados.")
 
-        # 2. Buscar recortes relevantes en Qdrant
-        print("DEBUG: Buscando el recorte más relevante en Qdrant...")
-        search_results = qdrant_handler.search_points(query_embedding, limit=1) # Buscar el más relevante
-        
+        # 2. Buscar el recorte más relevante de cada instrucción en Qdrant
+        print("DEBUG: Buscando los recortes más relevantes en Qdrant...")
+        found = qdrant_handler.search_batch([query_embeddings[i] for i in valid], limit=1)
+        all_search_results = [None] * len(instructions)
+        for i, search_results in zip(valid, found):
+            all_search_results[i] = search_results
+    except Exception as e:
+        print(f"Error general al buscar los recortes para {len(instructions)} instrucción(es): {e}")
+        traceback.print_exc() # Imprime el stack trace completo
+        return [False] * len(instructions)
+
+    return [
+        search_results is not None and _execute_best_match(instruction, search_results, monitor_to_capture, confidence)
+        for instruction, search_results in zip(instructions, all_search_results)
+    ]
+
+def _execute_best_match(instruction: str, search_results: list, monitor_to_capture: Optional[int], confidence: float) -> bool:
+    """Localiza en pantalla el mejor resultado de Qdrant para 'instruction' y hace clic en él."""
+    print(f"\n--- Ejecutando acción para la instrucción: '{instruction}' ---")
+    try:
         if not search_results:
             print(f"No se encontraron recortes relevantes en Qdrant para la instrucción: '{instruction}'.")
             return False
@@ -159,14 +260,17 @@ def execute_action_from_text(instruction: str, monitor_to_capture: Optional[int]
         print(f"   Texto OCR: {match_payload.get('ocr_text', 'N/A')}")       # Mostrar texto OCR
         print(f"   Ruta de imagen: {match_payload.get('image_path', 'N/A')}")
         
+        # La ruta la genera la ingesta (carpeta 'clippings'): no se comprueba en disco en cada ejecución,
+        # solo si el recorte no se localiza (ver más abajo)
         clipping_file_path = match_payload.get("image_path")
-        if not clipping_file_path or not os.path.exists(clipping_file_path):
-            print(f"Error: La ruta de imagen del recorte en Qdrant no es válida o no existe: {clipping_file_path}")
+        if not clipping_file_path:
+            print("Error: El recorte en Qdrant no tiene ruta de imagen.")
             return False
 
         # 3. Tomar captura de pantalla actual (del monitor/es deseado/s)
         print(f"DEBUG: Tomando captura de pantalla del monitor {monitor_to_capture if monitor_to_capture is not None else 'principal'}...")
-        current_screenshot_image = take_screenshot(monitor_to_capture) 
+        # Directamente en grises: sin pasar por PIL ni convertir la captura en cada búsqueda
+        current_screenshot_image = take_screenshot_gray(monitor_to_capture) 
         
         if current_screenshot_image is None:
             print(f"Error: No se pudo tomar una captura de pantalla del monitor {monitor_to_capture if monitor_to_capture is not None else 'principal'}.")
@@ -185,6 +289,9 @@ def execute_action_from_text(instruction: str, monitor_to_capture: Optional[int]
             pyautogui.doubleClick(center_x, center_y) # Realiza un doble clic
             print("Clic ejecutado.")
             return True
+        elif not os.path.exists(clipping_file_path):
+            print(f"Error: La ruta de imagen del recorte en Qdrant no es válida o no existe: {clipping_file_path}")
+            return False
         else:
             print(f"No se pudo localizar el recorte '{clipping_file_path}' en la pantalla actual con la confianza {confidence}.")
             return False
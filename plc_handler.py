@@ -1,8 +1,12 @@
 import os
 from dotenv import load_dotenv
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Union
 import time # Añadir import de time para las pausas en el ejemplo
 import sys # Para manejar la salida de errores de importación
+import ctypes # Para construir los S7DataItem de las lecturas múltiples
+import threading
+
+from utils.batching import MicroBatcher
 
 # Importar la librería Snap7. Si aún no la tienes instalada:
 # pip install python-snap7
@@ -28,6 +32,15 @@ except Exception as e:
     print(f"DEBUG: Detalle del error de importación: {sys.exc_info()[0].__name__}: {sys.exc_info()[1]}")
     # Si hay un error al importar, _S7Client_actual y _S7Util_actual se mantienen None
 
+_S7DataItem_actual = None # Estructura de snap7 para read_multi_vars (None si no está disponible)
+try:
+    from snap7.types import S7DataItem as _S7DataItem_actual
+except Exception:
+    try:
+        from snap7.type import S7DataItem as _S7DataItem_actual # python-snap7 >= 2.0
+    except Exception:
+        pass
+
 
 load_dotenv()
 
@@ -35,6 +48,40 @@ load_dotenv()
 PLC_IP_ADDRESS = os.getenv("PLC_IP_ADDRESS")
 PLC_RACK = int(os.getenv("PLC_RACK", 0)) # Rack suele ser 0 para S7-1200/1500
 PLC_SLOT = int(os.getenv("PLC_SLOT", 1)) # Slot suele ser 1 para S7-1200/1500
+PLC_KEEPALIVE_INTERVAL = float(os.getenv("PLC_KEEPALIVE_INTERVAL", 5)) # Segundos entre comprobaciones de la conexión
+
+# Esperas (segundos) entre reintentos de conexión fallidos consecutivos; se mantiene la última
+RECONNECT_BACKOFF = (1, 2, 4, 8)
+
+# Códigos de área y longitud de palabra de S7 usados en las lecturas múltiples
+S7_AREA_DB = 0x84
+S7_AREA_M = 0x83
+S7_WORDLEN_BIT = 0x01
+S7_WORDLEN_BYTE = 0x02
+MAX_VARS_PER_REQUEST = 20 # Límite de variables por petición read_multi_vars de Snap7
+# Zonas del mismo DB separadas por menos de MERGE_GAP bytes se leen como una sola (hasta MAX_MERGED_BYTES,
+# para que la respuesta quepa en la PDU de 240 bytes de un S7-1200)
+MERGE_GAP = 16
+MAX_MERGED_BYTES = 200
+
+# Tamaño en bytes de cada tipo de dato soportado
+DATA_TYPE_SIZES = {"BOOL": 1, "INT": 2, "REAL": 4}
+
+
+class S7Item(NamedTuple):
+    """Zona de memoria a leer en una lectura múltiple (read_many)."""
+    area: int                 # S7_AREA_DB o S7_AREA_M
+    db_number: int            # Número de DB (0 para la memoria M)
+    start: int                # Byte inicial
+    size: int                 # Cantidad de bytes
+
+class S7Write(NamedTuple):
+    """Zona o bit a escribir en una escritura múltiple (write_many)."""
+    area: int                 # S7_AREA_DB o S7_AREA_M
+    db_number: int            # Número de DB (0 para la memoria M)
+    start: int                # Byte inicial
+    data: bytearray           # Bytes a escribir (para un bit: un byte con 0 o 1)
+    bit_offset: Optional[int] = None # Si se indica, se escribe solo ese bit (sin leer-modificar-escribir el byte)
 
 class PLCConnectionError(Exception):
     """Excepción personalizada para errores de conexión al PLC."""
@@ -48,56 +95,161 @@ class PLCHandler:
     def __init__(self):
         self.client = None
         self.is_connected = False
+        # Snap7 no es seguro entre hilos: todas las operaciones con el cliente (incluido el keepalive) usan este lock
+        self._lock = threading.RLock()
+        self._last_ok_ts = 0.0 # Última vez que el PLC respondió correctamente
+        self._failed_attempts = 0 # Intentos de conexión fallidos consecutivos (para el backoff)
+        self._next_retry_ts = 0.0 # No reintentar la conexión antes de este instante
+        self._keepalive_stop = threading.Event()
+        self._keepalive_thread = None
+        # Las lecturas sueltas que llegan a la vez desde varias herramientas se agrupan en una sola read_many
+        # Cada lectura del lote recibe su propio resultado: una zona inválida de una herramienta no hace fallar
+        # las lecturas de las demás
+        self._reader = MicroBatcher(self._read_results, lambda item: self.read_many([item])[0], window=0.005)
         
         if not PLC_IP_ADDRESS:
             print("Advertencia: PLC_IP_ADDRESS no está configurado en .env. La conexión al PLC será simulada.")
         
-        # Intentar conectar. Si falla, el estado de is_connected se mantendrá False
-        # y las operaciones futuras usarán la simulación.
-        try:
-            self.connect()
-        except PLCConnectionError as e:
-            print(f"Error inicial de conexión al PLC: {e}. Las operaciones de PLC serán simuladas.")
-            self.is_connected = False # Asegurar que esté en False si la conexión inicial falla
+        # La conexión es perezosa: se establece en la primera operación (ver _ensure_connection),
+        # así la carga del módulo no se bloquea si el PLC no está accesible.
 
     def connect(self):
-        """Intenta conectar al PLC."""
-        if self.is_connected:
-            print("Ya conectado al PLC.")
-            return True
-        
-        # Si _S7Client_actual es None, significa que python-snap7 no se importó correctamente,
-        # así que simulamos la conexión.
-        if _S7Client_actual is None or not PLC_IP_ADDRESS:
-            print("Simulando conexión al PLC (python-snap7 no disponible o IP no configurada)...")
-            self.is_connected = True # Simular conexión exitosa
-            return True
+        """
+        Intenta conectar al PLC. La conexión TCP (que puede tardar segundos si el PLC no responde) se abre
+        sin _lock con un cliente nuevo, que luego se instala bajo el lock: las demás operaciones y el keepalive
+        no quedan bloqueados mientras tanto.
+        """
+        with self._lock:
+            if self.is_connected:
+                print("Ya conectado al PLC.")
+                return True
+            
+            # Si _S7Client_actual es None, significa que python-snap7 no se importó correctamente,
+            # así que simulamos la conexión.
+            if _S7Client_actual is None or not PLC_IP_ADDRESS:
+                print("Simulando conexión al PLC (python-snap7 no disponible o IP no configurada)...")
+                self.is_connected = True # Simular conexión exitosa
+                return True
 
         try:
-            self.client = _S7Client_actual.Client() # Usar la referencia real al cliente
-            self.client.connect(PLC_IP_ADDRESS, PLC_RACK, PLC_SLOT)
-            self.is_connected = self.client.get_connected()
-            if self.is_connected:
-                print(f"Conectado al PLC en {PLC_IP_ADDRESS} (Rack: {PLC_RACK}, Slot: {PLC_SLOT})")
-            else:
-                print(f"No se pudo conectar al PLC en {PLC_IP_ADDRESS}. Verifique la configuración y la red.")
-                self.client.destroy()
-                self.client = None
-                raise PLCConnectionError(f"No se pudo establecer conexión con el PLC en {PLC_IP_ADDRESS}.")
-            return self.is_connected
+            client = self._open_client()
+        except PLCConnectionError:
+            with self._lock:
+                self._on_connection_failed()
+            raise
+
+        with self._lock:
+            if self.is_connected: # Otro hilo conectó mientras tanto: se conserva su cliente
+                self._destroy_client(client)
+                return True
+            self.client = client
+            self.is_connected = True
+            self._on_connection_ok()
+        print(f"Conectado al PLC en {PLC_IP_ADDRESS} (Rack: {PLC_RACK}, Slot: {PLC_SLOT})")
+        self._start_keepalive()
+        return True
+
+    @staticmethod
+    def _open_client():
+        """
+        Crea un cliente Snap7 y lo conecta al PLC (sin _lock).
+        Lanza PLCConnectionError, tras destruir el cliente, si la conexión falla.
+        """
+        client = None
+        try:
+            client = _S7Client_actual.Client() # Usar la referencia real al cliente
+            client.connect(PLC_IP_ADDRESS, PLC_RACK, PLC_SLOT)
+            if client.get_connected():
+                return client
+            print(f"No se pudo conectar al PLC en {PLC_IP_ADDRESS}. Verifique la configuración y la red.")
+            raise PLCConnectionError(f"No se pudo establecer conexión con el PLC en {PLC_IP_ADDRESS}.")
+        except PLCConnectionError:
+            PLCHandler._destroy_client(client)
+            raise
         except Snap7Exception as e: # Ahora Snap7Exception será una clase de excepción válida
             print(f"Error de conexión con Snap7: {e}")
-            self.client = None
-            self.is_connected = False
+            PLCHandler._destroy_client(client)
             raise PLCConnectionError(f"Error de Snap7 al conectar: {e}")
         except Exception as e:
             print(f"Error inesperado al conectar al PLC: {e}")
+            PLCHandler._destroy_client(client)
+            raise PLCConnectionError(f"Error inesperado al conectar: {e}")
+
+    @staticmethod
+    def _destroy_client(client):
+        """Cierra y libera un cliente Snap7, ignorando errores (p. ej. si nunca llegó a conectar)."""
+        if client is None:
+            return
+        try:
+            client.disconnect()
+            client.destroy()
+        except Exception:
+            pass
+
+    def _on_connection_ok(self):
+        """Registra una respuesta correcta del PLC y reinicia el backoff."""
+        self._last_ok_ts = time.monotonic()
+        self._failed_attempts = 0
+        self._next_retry_ts = 0.0
+
+    def _on_connection_failed(self):
+        """Programa el siguiente reintento de conexión con backoff exponencial (1s, 2s, 4s, 8s...)."""
+        delay = RECONNECT_BACKOFF[min(self._failed_attempts, len(RECONNECT_BACKOFF) - 1)]
+        self._failed_attempts += 1
+        self._next_retry_ts = time.monotonic() + delay
+        print(f"DEBUG: Próximo intento de conexión al PLC en {delay}s.")
+
+    def _mark_connection_lost(self):
+        """Descarta el cliente actual tras un fallo de comunicación para que el siguiente acceso reconecte."""
+        with self._lock:
+            self._destroy_client(self.client)
             self.client = None
             self.is_connected = False
-            raise PLCConnectionError(f"Error inesperado al conectar: {e}")
+
+    def _start_keepalive(self):
+        """Arranca (una vez) el hilo que comprueba periódicamente la conexión y reconecta con backoff."""
+        with self._lock:
+            if self._keepalive_thread is not None and self._keepalive_thread.is_alive():
+                return
+            self._keepalive_stop.clear()
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, name="plc-keepalive", daemon=True)
+            self._keepalive_thread.start()
+
+    def _keepalive_loop(self):
+        """
+        Cada PLC_KEEPALIVE_INTERVAL segundos consulta el estado de la CPU (salvo que otra operación haya
+        respondido correctamente en ese intervalo). Si no hay respuesta, marca la
+        conexión como perdida y reconecta en segundo plano respetando el backoff, de modo que la siguiente
+        herramienta que use el PLC no pague el coste de la reconexión.
+        """
+        while not self._keepalive_stop.wait(PLC_KEEPALIVE_INTERVAL):
+            reconnect = False
+            with self._lock:
+                if self.is_connected and self.client is not None:
+                    if time.monotonic() - self._last_ok_ts < PLC_KEEPALIVE_INTERVAL:
+                        continue # Una operación reciente ya confirmó la conexión: no hace falta el ping
+                    try:
+                        self.client.get_cpu_state()
+                        self._on_connection_ok()
+                    except Exception as e:
+                        print(f"Advertencia: El PLC no responde al keepalive ({e}). Se reconectará.")
+                        self._mark_connection_lost()
+                        self._on_connection_failed()
+                elif not self.is_connected and time.monotonic() >= self._next_retry_ts:
+                    reconnect = True
+            if reconnect: # Fuera del lock: connect() solo lo toma para instalar el cliente nuevo
+                try:
+                    self.connect()
+                except PLCConnectionError as e:
+                    print(f"Advertencia: Reconexión en segundo plano al PLC fallida: {e}")
 
     def disconnect(self):
         """Desconecta del PLC."""
+        self._keepalive_stop.set()
+        with self._lock:
+            self._disconnect()
+
+    def _disconnect(self):
         if self.is_connected and self.client:
             if _S7Client_actual is None: # Si estamos en modo simulación
                 print("Simulando desconexión del PLC...")
@@ -119,13 +271,21 @@ class PLCHandler:
 
     def _ensure_connection(self):
         """
-        Garantiza que haya una conexión activa con el PLC. Intenta reconectar si es necesario.
+        Garantiza que haya una conexión activa con el PLC. Intenta reconectar si es necesario,
+        respetando el backoff tras fallos consecutivos.
         Lanza PLCConnectionError si no se puede establecer la conexión.
         """
+        # El keepalive arranca con el primer uso, no solo tras una conexión correcta: si el PLC aún no
+        # responde, es él quien sigue reintentando en segundo plano.
+        if _S7Client_actual is not None and PLC_IP_ADDRESS:
+            self._start_keepalive()
         # Si no estamos conectados, intentar conectar.
         # connect() devuelve True si logra conectar (real o simulado).
         # Si devuelve False (falla la conexión real y no hay simulación), entonces lanzamos error.
         if not self.is_connected:
+            wait = self._next_retry_ts - time.monotonic()
+            if wait > 0:
+                raise PLCConnectionError(f"No hay conexión con el PLC. Próximo reintento de conexión en {wait:.1f}s.")
             print("DEBUG: Intentando asegurar conexión al PLC...")
             if not self.connect():
                 raise PLCConnectionError("No hay conexión con el PLC. Falló el intento de reconexión.")
@@ -142,20 +302,23 @@ class PLCHandler:
         Returns:
             bytearray: Los datos leídos.
         """
-        self._ensure_connection() # Esto ahora maneja la conexión/reconexión
-        if _S7Client_actual is None or not self.client or not self.is_connected:
-            print(f"Simulando lectura de DB{db_number}, StartByte: {start_byte}, Size: {size}")
-            # Retorna un bytearray simulado (ej. todos ceros)
-            return bytearray([0] * size)
+        with self._lock:
+            self._ensure_connection() # Esto ahora maneja la conexión/reconexión
+            if _S7Client_actual is None or not self.client or not self.is_connected:
+                print(f"Simulando lectura de DB{db_number}, StartByte: {start_byte}, Size: {size}")
+                # Retorna un bytearray simulado (ej. todos ceros)
+                return bytearray([0] * size)
         
-        try:
-            data = self.client.db_read(db_number, start_byte, size)
-            print(f"Lectura exitosa de DB{db_number} desde byte {start_byte}, {size} bytes.")
-            return data
-        except Snap7Exception as e:
-            raise PLCReadWriteError(f"Error de Snap7 al leer DB{db_number}: {e}")
-        except Exception as e:
-            raise PLCReadWriteError(f"Error inesperado al leer DB{db_number}: {e}")
+            try:
+                data = self.client.db_read(db_number, start_byte, size)
+                self._on_connection_ok()
+                print(f"Lectura exitosa de DB{db_number} desde byte {start_byte}, {size} bytes.")
+                return data
+            except Snap7Exception as e:
+                self._mark_connection_lost() # El siguiente acceso (o el keepalive) reconectará
+                raise PLCReadWriteError(f"Error de Snap7 al leer DB{db_number}: {e}")
+            except Exception as e:
+                raise PLCReadWriteError(f"Error inesperado al leer DB{db_number}: {e}")
 
     def write_db(self, db_number: int, start_byte: int, data: bytearray) -> bool:
         """
@@ -167,47 +330,312 @@ class PLCHandler:
         Returns:
             bool: True si la escritura fue exitosa, False en caso contrario.
         """
-        self._ensure_connection() # Esto ahora maneja la conexión/reconexión
-        if _S7Client_actual is None or not self.client or not self.is_connected:
-            print(f"Simulando escritura en DB{db_number}, StartByte: {start_byte}, Data: {data.hex()}")
-            return True # Simular escritura exitosa
+        with self._lock:
+            self._ensure_connection() # Esto ahora maneja la conexión/reconexión
+            if _S7Client_actual is None or not self.client or not self.is_connected:
+                print(f"Simulando escritura en DB{db_number}, StartByte: {start_byte}, Data: {data.hex()}")
+                return True # Simular escritura exitosa
         
-        try:
-            self.client.db_write(db_number, start_byte, data)
-            print(f"Escritura exitosa en DB{db_number} en byte {start_byte}, {len(data)} bytes.")
-            return True
-        except Snap7Exception as e:
-            raise PLCReadWriteError(f"Error de Snap7 al escribir en DB{db_number}: {e}")
-        except Exception as e:
-            raise PLCReadWriteError(f"Error inesperado al escribir en DB{db_number}: {e}")
+            try:
+                self.client.db_write(db_number, start_byte, data)
+                self._on_connection_ok()
+                print(f"Escritura exitosa en DB{db_number} en byte {start_byte}, {len(data)} bytes.")
+                return True
+            except Snap7Exception as e:
+                self._mark_connection_lost() # El siguiente acceso (o el keepalive) reconectará
+                raise PLCReadWriteError(f"Error de Snap7 al escribir en DB{db_number}: {e}")
+            except Exception as e:
+                raise PLCReadWriteError(f"Error inesperado al escribir en DB{db_number}: {e}")
 
     def read_m(self, start_byte: int, size: int) -> bytearray:
         """Lee datos de la memoria M (Merker) del PLC."""
-        self._ensure_connection()
-        if _S7Client_actual is None or not self.client or not self.is_connected:
-            print(f"Simulando lectura de M, StartByte: {start_byte}, Size: {size}")
-            return bytearray([0] * size) # Simulado
+        with self._lock:
+            self._ensure_connection()
+            if _S7Client_actual is None or not self.client or not self.is_connected:
+                print(f"Simulando lectura de M, StartByte: {start_byte}, Size: {size}")
+                return bytearray([0] * size) # Simulado
+            try:
+                data = self.client.read_area(0x83, 0, start_byte, size) # Area ID for Merker (M) is 0x83
+                self._on_connection_ok()
+                return data
+            except Snap7Exception as e:
+                self._mark_connection_lost() # El siguiente acceso (o el keepalive) reconectará
+                raise PLCReadWriteError(f"Error de Snap7 al leer M{start_byte}: {e}")
+            except Exception as e:
+                raise PLCReadWriteError(f"Error inesperado al leer M{start_byte}: {e}")
+
+    def write_m(self, start_byte: int, data: bytearray) -> bool:
+        """Escribe datos en la memoria M (Merker) del PLC."""
+        with self._lock:
+            self._ensure_connection()
+            if _S7Client_actual is None or not self.client or not self.is_connected:
+                print(f"Simulando escritura en M, StartByte: {start_byte}, Data: {data.hex()}")
+                return True # Simulado
+            try:
+                self.client.write_area(0x83, 0, start_byte, data)
+                self._on_connection_ok()
+                return True
+            except Snap7Exception as e:
+                self._mark_connection_lost() # El siguiente acceso (o el keepalive) reconectará
+                raise PLCReadWriteError(f"Error de Snap7 al escribir en M{start_byte}: {e}")
+            except Exception as e:
+                raise PLCReadWriteError(f"Error inesperado al escribir en M{start_byte}: {e}")
+
+    def read_item(self, item: S7Item) -> bytearray:
+        """
+        Lee una zona de memoria. Si otras herramientas leen a la vez, las lecturas se agrupan
+        en una única read_many (un solo viaje de ida y vuelta al PLC).
+        """
+        return self._reader.submit(item)
+
+    @staticmethod
+    def _coalesce(items: List[S7Item]) -> tuple:
+        """
+        Fusiona las zonas solapadas o cercanas del mismo área/DB.
+        Returns:
+            tuple: (zonas fusionadas, lista de (índice de zona fusionada, desplazamiento) por cada item)
+        """
+        merged: List[S7Item] = []
+        placement = [None] * len(items)
+        order = sorted(range(len(items)), key=lambda i: (items[i].area, items[i].db_number, items[i].start))
+        for i in order:
+            item = items[i]
+            if merged:
+                last = merged[-1]
+                end = max(last.start + last.size, item.start + item.size)
+                if (last.area == item.area and last.db_number == item.db_number
+                        and item.start <= last.start + last.size + MERGE_GAP
+                        and end - last.start <= MAX_MERGED_BYTES):
+                    merged[-1] = last._replace(size=end - last.start)
+                    placement[i] = (len(merged) - 1, item.start - last.start)
+                    continue
+            merged.append(item)
+            placement[i] = (len(merged) - 1, 0)
+        return merged, placement
+
+    def read_many(self, items: List[S7Item]) -> List[bytearray]:
+        """
+        Lee varias zonas de memoria (DB o M) con peticiones read_multi_vars de Snap7:
+        una PDU por cada MAX_VARS_PER_REQUEST zonas en lugar de una por zona.
+        Las zonas contiguas o cercanas del mismo DB se leen como un único bloque y se trocean en local.
+        Args:
+            items (List[S7Item]): Zonas a leer.
+        Returns:
+            List[bytearray]: Los datos leídos, en el mismo orden que 'items'.
+        """
+        results = self._read_results(items)
+        for result in results:
+            if isinstance(result, PLCReadWriteError):
+                raise result
+        return results
+
+    def _read_results(self, items: List[S7Item]) -> list:
+        """
+        Como read_many, pero con un resultado por zona: los datos leídos o la PLCReadWriteError de esa zona.
+        Si falla un bloque fusionado, sus zonas se vuelven a leer por separado, para que el error quede
+        solo en la zona que lo provoca. Los errores de conexión siguen lanzándose para todo el lote.
+        """
+        merged, placement = self._coalesce(items)
+        blocks = self._read_blocks(merged)
+        results = [
+            blocks[block] if isinstance(blocks[block], PLCReadWriteError) else blocks[block][offset:offset + item.size]
+            for item, (block, offset) in zip(items, placement)
+        ]
+        retry = [i for i, (block, _) in enumerate(placement)
+                 if isinstance(blocks[block], PLCReadWriteError) and merged[block] != items[i]]
+        if retry:
+            for i, result in zip(retry, self._read_blocks([items[i] for i in retry])):
+                results[i] = result
+        return results
+
+    def _read_blocks(self, items: List[S7Item]) -> list:
+        """
+        Cuerpo de read_many: una entrada de read_multi_vars por zona.
+        Returns:
+            list: Por cada zona, los datos (bytearray) o la PLCReadWriteError si el PLC rechazó esa zona.
+        """
+        with self._lock:
+            self._ensure_connection()
+            if _S7Client_actual is None or not self.client or not self.is_connected:
+                print(f"Simulando lectura múltiple de {len(items)} zonas.")
+                return [bytearray([0] * item.size) for item in items]
+            if _S7DataItem_actual is None:
+                # Sin read_multi_vars: una lectura por bloque (ya fusionados por _coalesce)
+                results = []
+                for item in items:
+                    try:
+                        results.append(self._read_area(item))
+                    except PLCReadWriteError as e:
+                        results.append(e)
+                return results
+
+            results = []
+            try:
+                for chunk_start in range(0, len(items), MAX_VARS_PER_REQUEST):
+                    chunk = items[chunk_start:chunk_start + MAX_VARS_PER_REQUEST]
+                    data_items = (_S7DataItem_actual * len(chunk))()
+                    buffers = [] # Mantener vivos los buffers mientras Snap7 escribe en ellos
+                    for data_item, item in zip(data_items, chunk):
+                        buffer = ctypes.create_string_buffer(item.size)
+                        buffers.append(buffer)
+                        data_item.Area = ctypes.c_int32(item.area)
+                        data_item.WordLen = ctypes.c_int32(S7_WORDLEN_BYTE)
+                        data_item.Result = ctypes.c_int32(0)
+                        data_item.DBNumber = ctypes.c_int32(item.db_number)
+                        data_item.Start = ctypes.c_int32(item.start)
+                        data_item.Amount = ctypes.c_int32(item.size)
+                        data_item.pData = ctypes.cast(ctypes.pointer(buffer), ctypes.POINTER(ctypes.c_uint8))
+
+                    self.client.read_multi_vars(data_items)
+                    for data_item, item, buffer in zip(data_items, chunk, buffers):
+                        if data_item.Result != 0:
+                            results.append(PLCReadWriteError(f"Error {data_item.Result} al leer {item}."))
+                        else:
+                            results.append(bytearray(buffer.raw[:item.size]))
+                self._on_connection_ok()
+                print(f"Lectura múltiple de {len(items)} zonas completada.")
+                return results
+            except Snap7Exception as e:
+                self._mark_connection_lost() # El siguiente acceso (o el keepalive) reconectará
+                raise PLCReadWriteError(f"Error de Snap7 en la lectura múltiple: {e}")
+            except Exception as e:
+                raise PLCReadWriteError(f"Error inesperado en la lectura múltiple: {e}")
+
+    def _read_area(self, item: S7Item) -> bytearray:
+        """Lee un único bloque con db_read / read_area (se llama con _lock adquirido)."""
         try:
-            data = self.client.read_area(0x83, 0, start_byte, size) # Area ID for Merker (M) is 0x83
-            return data
+            if item.area == S7_AREA_DB:
+                data = self.client.db_read(item.db_number, item.start, item.size)
+            else:
+                data = self.client.read_area(item.area, item.db_number, item.start, item.size)
+            self._on_connection_ok()
+            return bytearray(data)
         except Snap7Exception as e:
-            raise PLCReadWriteError(f"Error de Snap7 al leer M{start_byte}: {e}")
+            self._mark_connection_lost() # El siguiente acceso (o el keepalive) reconectará
+            raise PLCReadWriteError(f"Error de Snap7 al leer {item}: {e}")
         except Exception as e:
-            raise PLCReadWriteError(f"Error inesperado al leer M{start_byte}: {e}")
+            raise PLCReadWriteError(f"Error inesperado al leer {item}: {e}")
 
-    def write_m(self, start_byte: int, data: bytearray) -> bool:
-        """Escribe datos en la memoria M (Merker) del PLC."""
-        self._ensure_connection()
-        if _S7Client_actual is None or not self.client or not self.is_connected:
-            print(f"Simulando escritura en M, StartByte: {start_byte}, Data: {data.hex()}")
-            return True # Simulado
+    def write_many(self, writes: List[S7Write]) -> bool:
+        """
+        Escribe varias zonas/bits con peticiones write_multi_vars de Snap7: una PDU por cada
+        MAX_VARS_PER_REQUEST escrituras. Los bits se escriben con longitud de palabra 'bit',
+        así que no hace falta leer antes el byte que los contiene.
+        Args:
+            writes (List[S7Write]): Escrituras a realizar, en orden.
+        Returns:
+            bool: True si todas las escrituras fueron correctas.
+        """
+        with self._lock:
+            self._ensure_connection()
+            if _S7Client_actual is None or not self.client or not self.is_connected:
+                print(f"Simulando escritura múltiple de {len(writes)} zonas.")
+                return True
+            if _S7DataItem_actual is None:
+                # Sin write_multi_vars: una escritura por zona (los bits con lectura-modificación-escritura)
+                for write in writes:
+                    if write.bit_offset is None:
+                        self._write_area(write.area, write.db_number, write.start, write.data)
+                    else:
+                        current = self._read_area(S7Item(write.area, write.db_number, write.start, 1))
+                        if _S7Util_actual:
+                            _S7Util_actual.set_bool(current, 0, write.bit_offset, bool(write.data[0]))
+                        self._write_area(write.area, write.db_number, write.start, current)
+                return True
+
+            try:
+                for chunk_start in range(0, len(writes), MAX_VARS_PER_REQUEST):
+                    chunk = writes[chunk_start:chunk_start + MAX_VARS_PER_REQUEST]
+                    data_items = (_S7DataItem_actual * len(chunk))()
+                    buffers = [] # Mantener vivos los buffers mientras Snap7 los lee
+                    for data_item, write in zip(data_items, chunk):
+                        buffer = ctypes.create_string_buffer(bytes(write.data), len(write.data))
+                        buffers.append(buffer)
+                        data_item.Area = ctypes.c_int32(write.area)
+                        data_item.Result = ctypes.c_int32(0)
+                        data_item.DBNumber = ctypes.c_int32(write.db_number)
+                        if write.bit_offset is None:
+                            data_item.WordLen = ctypes.c_int32(S7_WORDLEN_BYTE)
+                            data_item.Start = ctypes.c_int32(write.start)
+                            data_item.Amount = ctypes.c_int32(len(write.data))
+                        else:
+                            # Con longitud 'bit', Start es la dirección del bit: byte * 8 + bit
+                            data_item.WordLen = ctypes.c_int32(S7_WORDLEN_BIT)
+                            data_item.Start = ctypes.c_int32(write.start * 8 + write.bit_offset)
+                            data_item.Amount = ctypes.c_int32(1)
+                        data_item.pData = ctypes.cast(ctypes.pointer(buffer), ctypes.POINTER(ctypes.c_uint8))
+
+                    self._write_multi_vars(data_items)
+                    for data_item, write in zip(data_items, chunk):
+                        if data_item.Result != 0:
+                            raise PLCReadWriteError(f"Error {data_item.Result} al escribir {write}.")
+                self._on_connection_ok()
+                print(f"Escritura múltiple exitosa de {len(writes)} zonas.")
+                return True
+            except PLCReadWriteError:
+                raise
+            except Snap7Exception as e:
+                self._mark_connection_lost() # El siguiente acceso (o el keepalive) reconectará
+                raise PLCReadWriteError(f"Error de Snap7 en la escritura múltiple: {e}")
+            except Exception as e:
+                raise PLCReadWriteError(f"Error inesperado en la escritura múltiple: {e}")
+
+    def _write_multi_vars(self, data_items) -> None:
+        """
+        Llama a Cli_WriteMultiVars sobre el propio array 'data_items' (se llama con _lock adquirido).
+        Client.write_multi_vars de python-snap7 1.0 envía una copia del array (from_buffer_copy), así que el
+        Result de cada zona nunca llegaría a 'data_items' y una escritura rechazada pasaría por correcta.
+        """
+        library = getattr(self.client, "_library", None)
+        if library is None:
+            raise PLCReadWriteError("El cliente de Snap7 no expone Cli_WriteMultiVars.")
+        result = library.Cli_WriteMultiVars(self.client._pointer, ctypes.byref(data_items), ctypes.c_int32(len(data_items)))
+        if result != 0:
+            raise Snap7Exception(f"Cli_WriteMultiVars devolvió el código {result:#x}.")
+
+    def _write_area(self, area: int, db_number: int, start: int, data: bytearray) -> None:
+        """Escribe un único bloque con db_write / write_area (se llama con _lock adquirido)."""
         try:
-            self.client.write_area(0x83, 0, start_byte, data)
-            return True
+            if area == S7_AREA_DB:
+                self.client.db_write(db_number, start, data)
+            else:
+                self.client.write_area(area, db_number, start, data)
+            self._on_connection_ok()
         except Snap7Exception as e:
-            raise PLCReadWriteError(f"Error de Snap7 al escribir en M{start_byte}: {e}")
+            self._mark_connection_lost() # El siguiente acceso (o el keepalive) reconectará
+            raise PLCReadWriteError(f"Error de Snap7 al escribir en el área {area:#x}, DB{db_number}, byte {start}: {e}")
         except Exception as e:
-            raise PLCReadWriteError(f"Error inesperado al escribir en M{start_byte}: {e}")
+            raise PLCReadWriteError(f"Error inesperado al escribir en el área {area:#x}, DB{db_number}, byte {start}: {e}")
+
+    @staticmethod
+    def encode(data_type: str, value: Union[bool, int, float]) -> bytearray:
+        """Convierte un valor 'BOOL', 'INT' o 'REAL' a los bytes que se escriben en el PLC (para BOOL, un byte 0/1)."""
+        data_type = data_type.upper()
+        if data_type not in DATA_TYPE_SIZES:
+            raise ValueError(f"Tipo de dato no soportado: {data_type}")
+        buffer = bytearray(DATA_TYPE_SIZES[data_type])
+        if data_type == "BOOL":
+            buffer[0] = 1 if value else 0
+        elif _S7Util_actual is not None:
+            if data_type == "INT":
+                _S7Util_actual.set_int(buffer, 0, int(value))
+            else:
+                _S7Util_actual.set_real(buffer, 0, float(value))
+        return buffer
+
+    @staticmethod
+    def decode(data_type: str, data: bytearray, bit_offset: Optional[int] = None) -> Union[bool, int, float]:
+        """Interpreta los bytes leídos como 'BOOL', 'INT' o 'REAL'."""
+        data_type = data_type.upper()
+        if _S7Util_actual is None:
+            return {"BOOL": False, "INT": 0, "REAL": 0.0}[data_type]
+        if data_type == "BOOL":
+            return _S7Util_actual.get_bool(data, 0, bit_offset or 0)
+        if data_type == "INT":
+            return _S7Util_actual.get_int(data, 0)
+        if data_type == "REAL":
+            return _S7Util_actual.get_real(data, 0)
+        raise ValueError(f"Tipo de dato no soportado: {data_type}")
 
     # --- Funciones para leer/escribir tipos de datos específicos (usando snap7.util) ---
     def read_real(self, db_number: int, byte_offset: int) -> float:
@@ -238,19 +666,20 @@ class PLCHandler:
         return _S7Util_actual.get_bool(data, 0, bit_offset) if _S7Util_actual else False
 
     def write_bool(self, db_number: int, byte_offset: int, bit_offset: int, value: bool) -> bool:
-        # Para escribir un booleano, primero leemos el byte, modificamos el bit y luego escribimos el byte modificado
-        current_byte_data = self.read_db(db_number, byte_offset, 1)
+        with self._lock: # Lectura-modificación-escritura atómica respecto a otros hilos
+            # Para escribir un booleano, primero leemos el byte, modificamos el bit y luego escribimos el byte modificado
+            current_byte_data = self.read_db(db_number, byte_offset, 1)
         
-        # Asegurarse de que el bytearray tenga al menos 1 byte.
-        # Si la lectura simulada o fallida devuelve un bytearray vacío, inicializarlo a [0].
-        if len(current_byte_data) == 0:
-            print(f"DEBUG: read_db para DB{db_number}, byte {byte_offset} devolvió un bytearray vacío. Inicializando a [0] para write_bool.")
-            current_byte_data = bytearray([0])
+            # Asegurarse de que el bytearray tenga al menos 1 byte.
+            # Si la lectura simulada o fallida devuelve un bytearray vacío, inicializarlo a [0].
+            if len(current_byte_data) == 0:
+                print(f"DEBUG: read_db para DB{db_number}, byte {byte_offset} devolvió un bytearray vacío. Inicializando a [0] para write_bool.")
+                current_byte_data = bytearray([0])
         
-        if _S7Util_actual: # Solo intentar set_bool si S7Util está disponible
-            _S7Util_actual.set_bool(current_byte_data, 0, bit_offset, value)
+            if _S7Util_actual: # Solo intentar set_bool si S7Util está disponible
+                _S7Util_actual.set_bool(current_byte_data, 0, bit_offset, value)
         
-        return self.write_db(db_number, byte_offset, current_byte_data)
+            return self.write_db(db_number, byte_offset, current_byte_data)
 
     # Añadir más funciones para otros tipos de datos (DINT, WORD, DWORD, etc.) según sea necesario.
 
@@ -264,6 +693,10 @@ if __name__ == "__main__":
 
     try:
         plc = PLCHandler()
+        try:
+            plc.connect() # La conexión es perezosa: forzarla aquí para la prueba
+        except PLCConnectionError as ce:
+            print(f"Error de conexión inicial al PLC: {ce}")
 
         if plc.is_connected:
             print("\nPLC conectado. Realizando operaciones de prueba...")
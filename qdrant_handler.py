@@ -1,18 +1,125 @@
 import os
+import atexit
+import hashlib
+import numpy as np
 from qdrant_client import QdrantClient, models
 from dotenv import load_dotenv
 
+from utils.cache_utils import QueryCache, SemanticCache
+from utils.batching import MicroBatcher
+
 load_dotenv()
 
 # Variables de entorno directamente usadas para inicializar la clase
 QDRANT_HOST = os.getenv("QDRANT_HOST")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
+# gRPC mantiene una conexión HTTP/2 persistente; se puede desactivar si el puerto gRPC no es accesible
+QDRANT_PORT = int(os.getenv("QDRANT_PORT", 6333))
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", 6334))
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "true").lower() in ("1", "true", "yes")
+QDRANT_TIMEOUT = int(os.getenv("QDRANT_TIMEOUT", 10))
 
 # Definición de la constante para el nombre de la colección y la dimensión
 # Es mejor definirlas aquí como constantes de módulo, ya que son fijas para la aplicación
 DEFAULT_COLLECTION_NAME = "windows_ui_elements"
 DEFAULT_VECTOR_DIMENSION = 384
 
+# Cuantización escalar int8 en RAM: reduce 4x los bytes por vector que recorre la búsqueda.
+# (La binaria pierde demasiada precisión con embeddings de 384 dimensiones.)
+QUANTIZATION_CONFIG = models.ScalarQuantization(
+    scalar=models.ScalarQuantizationConfig(
+        type=models.ScalarType.INT8,
+        quantile=0.99,
+        always_ram=True,
+    )
+)
+# Los vectores originales (solo se leen al reordenar) y los payloads van a disco mediante memmap;
+# en RAM quedan el grafo HNSW y los vectores cuantizados, que son los que recorre la búsqueda.
+VECTORS_ON_DISK = os.getenv("QDRANT_VECTORS_ON_DISK", "true").lower() in ("1", "true", "yes")
+OPTIMIZERS_CONFIG = models.OptimizersConfigDiff(memmap_threshold=20000) # KB por segmento
+
+# En la consulta: buscar sobre los vectores cuantizados con sobremuestreo y reordenar los candidatos
+# con los vectores originales, de modo que el resultado final no pierde precisión.
+# hnsw_ef=40 basta para limit=1 en un índice pequeño de recortes y recorre menos nodos que el valor por defecto.
+HNSW_EF_SEARCH = int(os.getenv("QDRANT_HNSW_EF", 40))
+SEARCH_PARAMS = models.SearchParams(
+    hnsw_ef=HNSW_EF_SEARCH,
+    quantization=models.QuantizationSearchParams(ignore=False, rescore=True, oversampling=2.0),
+)
+
+
+def configure_hnsw_params(point_count: int) -> models.HnswConfigDiff:
+    """
+    Parámetros de construcción del grafo HNSW según el tamaño de la colección:
+    grafos más conectados (m) y construcciones más cuidadosas (ef_construct) solo cuando el volumen lo justifica.
+    El escalón más bajo (m=16, ef_construct=100) es el mínimo por debajo del cual el recall cae de forma apreciable.
+    Args:
+        point_count (int): Número de puntos de la colección.
+    Returns:
+        models.HnswConfigDiff: Configuración HNSW recomendada.
+    """
+    if point_count < 100_000:
+        return models.HnswConfigDiff(m=16, ef_construct=100)
+    if point_count < 1_000_000:
+        return models.HnswConfigDiff(m=24, ef_construct=200)
+    return models.HnswConfigDiff(m=32, ef_construct=256)
+
+# Caché de resultados de búsqueda compartida por todas las instancias del proceso.
+# Se invalida en cada upsert o recreación de la colección para no devolver resultados obsoletos; el TTL acota
+# lo obsoletos que pueden estar si la colección cambia desde otro proceso (p. ej. una ingesta desde Streamlit).
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 300))
+_search_cache = QueryCache(maxsize=512, ttl=SEARCH_CACHE_TTL)
+# Segundo nivel por similitud, desactivado por defecto: con all-MiniLM-L6-v2, órdenes opuestas sobre el mismo
+# elemento ("arrancar la bomba" / "parar la bomba") pueden quedar por encima de 0.95 de similitud coseno y el
+# agente pulsaría el botón equivocado. Si se activa, solo reutiliza el resultado de vectores prácticamente
+# idénticos; se invalida junto con _search_cache y caduca con el mismo TTL.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.995))
+_semantic_cache = (
+    SemanticCache(maxlen=128, threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEARCH_CACHE_TTL)
+    if SEMANTIC_CACHE_ENABLED else None
+)
+
+
+def _search_cache_key(query_vector, limit: int) -> tuple:
+    """
+    Clave de caché para una búsqueda: hash del vector cuantizado (redondeado a 1e-4)
+    más el límite de resultados.
+    """
+    quantized = np.round(np.asarray(query_vector, dtype=np.float32) * 1e4).astype(np.int32)
+    digest = hashlib.blake2b(quantized.tobytes(), digest_size=16).hexdigest()
+    return (digest, limit)
+
+
+def _cached_search(cache_key: tuple, query_vector, limit: int):
+    """
+    Busca el resultado en la caché exacta y, si no está, en la semántica. Un acierto semántico se copia
+    a la caché exacta con su instante original, de modo que no prolonga la validez del resultado.
+    """
+    cached = _search_cache.get(cache_key)
+    if cached is not None or _semantic_cache is None:
+        return cached
+    entry = _semantic_cache.get_entry(query_vector, tag=limit)
+    if entry is None:
+        return None
+    stored_at, cached = entry
+    _search_cache.put(cache_key, cached, stored_at=stored_at)
+    return cached
+
+
+def _store_search(cache_key: tuple, query_vector, limit: int, points) -> None:
+    """Guarda el resultado en la caché exacta y, si está activada y hubo resultados, en la semántica."""
+    _search_cache.put(cache_key, points)
+    if points and _semantic_cache is not None: # No recordar "sin resultados" para consultas parecidas
+        _semantic_cache.put(query_vector, points, tag=limit)
+
+
+def _clear_search_caches() -> None:
+    """Invalida las búsquedas cacheadas: la colección ha cambiado."""
+    _search_cache.clear()
+    if _semantic_cache is not None:
+        _semantic_cache.clear()
+
 class QdrantHandler:
     def __init__(self):
         if not QDRANT_HOST or not QDRANT_API_KEY:
@@ -23,60 +130,259 @@ class QdrantHandler:
         self.COLLECTION_NAME = DEFAULT_COLLECTION_NAME
         self.VECTOR_DIMENSION = DEFAULT_VECTOR_DIMENSION 
         
+        # Un único cliente de larga vida por handler: la conexión (gRPC con keepalive) se reutiliza
+        # en todas las búsquedas en lugar de negociar TCP/TLS en cada llamada.
         self.client = QdrantClient(
             host=QDRANT_HOST,
+            port=QDRANT_PORT,
+            grpc_port=QDRANT_GRPC_PORT,
             api_key=QDRANT_API_KEY,
+            prefer_grpc=QDRANT_PREFER_GRPC,
+            timeout=QDRANT_TIMEOUT,
+            grpc_options={
+                "grpc.keepalive_time_ms": 30000,
+                "grpc.keepalive_timeout_ms": 10000,
+                "grpc.keepalive_permit_without_calls": 1,
+            },
         )
+        atexit.register(self.close) # Cerrar el canal limpiamente al terminar el proceso
         self._ensure_collection_exists()
         print(f"QdrantHandler inicializado para la colección: {self.COLLECTION_NAME}")
 
-    def _ensure_collection_exists(self):
+    def close(self):
+        """Cierra la conexión con Qdrant."""
         try:
-            # Usa los atributos de instancia self.COLLECTION_NAME y self.VECTOR_DIMENSION aquí
-            self.client.get_collection(collection_name=self.COLLECTION_NAME)
-            print(f"Colección '{self.COLLECTION_NAME}' ya existe.") # Mensaje informativo
-        except Exception: # Captura cualquier excepción si la colección no existe
+            self.client.close()
+        except Exception as e:
+            print(f"Advertencia: Error al cerrar el cliente de Qdrant: {e}")
+
+    def _ensure_collection_exists(self):
+        # Solo se crea la colección si Qdrant confirma que no existe: cualquier otro error se propaga
+        # en lugar de acabar en recreate_collection, que vaciaría una colección con datos.
+        if not self.client.collection_exists(collection_name=self.COLLECTION_NAME):
             print(f"Colección '{self.COLLECTION_NAME}' no existe. Creándola...")
-            self.client.recreate_collection(
+            self.recreate_collection()
+            print(f"Colección '{self.COLLECTION_NAME}' creada con éxito.")
+            return
+
+        print(f"Colección '{self.COLLECTION_NAME}' ya existe.") # Mensaje informativo
+        # Ajustes opcionales de una colección existente: un fallo solo se avisa
+        try:
+            collection_info = self.client.get_collection(collection_name=self.COLLECTION_NAME)
+        except Exception as e:
+            print(f"Advertencia: No se pudo leer la configuración de '{self.COLLECTION_NAME}': {e}")
+            return
+        if getattr(collection_info.config, "quantization_config", None) is None:
+            self._enable_quantization()
+        self._tune_hnsw(collection_info)
+
+    def _enable_quantization(self):
+        """Activa la cuantización en una colección creada antes de que se configurara."""
+        try:
+            self.client.update_collection(
                 collection_name=self.COLLECTION_NAME,
-                vectors_config=models.VectorParams(size=self.VECTOR_DIMENSION, distance=models.Distance.COSINE),
+                quantization_config=QUANTIZATION_CONFIG,
             )
-            print(f"Colección '{self.COLLECTION_NAME}' creada con éxito.")
+            print(f"Cuantización escalar activada en la colección '{self.COLLECTION_NAME}'.")
+        except Exception as e:
+            print(f"Advertencia: No se pudo activar la cuantización en '{self.COLLECTION_NAME}': {e}")
+
+    def _tune_hnsw(self, collection_info):
+        """
+        Ajusta m/ef_construct al tamaño actual de la colección. Qdrant reconstruye el índice
+        en segundo plano con los vectores ya almacenados: no hace falta volver a subir datos.
+        Solo sube parámetros: si la colección ya está configurada igual o por encima (p. ej. a mano),
+        no se toca, porque cada cambio dispara una reconstrucción completa del índice.
+        """
+        try:
+            # Dentro del try también la lectura de la configuración (su forma puede variar entre REST y gRPC)
+            target = configure_hnsw_params(collection_info.points_count or 0)
+            current = collection_info.config.hnsw_config
+            if current.m >= target.m and current.ef_construct >= target.ef_construct:
+                return
+            wanted = models.HnswConfigDiff(m=max(current.m, target.m), ef_construct=max(current.ef_construct, target.ef_construct))
+            self.client.update_collection(collection_name=self.COLLECTION_NAME, hnsw_config=wanted)
+            print(f"HNSW de '{self.COLLECTION_NAME}' ajustado a m={wanted.m}, ef_construct={wanted.ef_construct}.")
+        except Exception as e:
+            print(f"Advertencia: No se pudieron ajustar los parámetros HNSW de '{self.COLLECTION_NAME}': {e}")
+
+    def recreate_collection(self):
+        """
+        Crea (o vacía, si ya existe) la colección y descarta los resultados de búsqueda cacheados.
+        """
+        self.client.recreate_collection(
+            collection_name=self.COLLECTION_NAME,
+            vectors_config=models.VectorParams(
+                size=self.VECTOR_DIMENSION,
+                distance=models.Distance.COSINE,
+                on_disk=VECTORS_ON_DISK,
+            ),
+            hnsw_config=configure_hnsw_params(0), # Colección vacía: parámetros para índices pequeños
+            quantization_config=QUANTIZATION_CONFIG,
+            optimizers_config=OPTIMIZERS_CONFIG,
+            on_disk_payload=VECTORS_ON_DISK,
+        )
+        _clear_search_caches()
 
-    def upsert_point(self, point_id: str, vector: list, payload: dict):
+    def upsert_point(self, point_id: str, vector, payload: dict):
+        # vector puede ser una lista o un np.ndarray (PointStruct solo valida listas de floats)
         try:
             self.client.upsert(
                 collection_name=self.COLLECTION_NAME, # Usa self.COLLECTION_NAME
                 points=[
                     models.PointStruct(
                         id=point_id,
-                        vector=vector,
+                        vector=np.asarray(vector, dtype=np.float32).tolist(),
                         payload=payload,
                     )
                 ],
                 wait=True
             )
+            # La colección ha cambiado: las búsquedas cacheadas ya no son válidas
+            _clear_search_caches()
             print(f"Punto ID '{point_id}' insertado/actualizado en Qdrant.")
             return True
         except Exception as e:
             print(f"Error al insertar punto '{point_id}' en Qdrant: {e}")
             return False
 
-    def search_points(self, query_vector: list, limit: int = 5):
+    def upsert_batch(self, points: list) -> bool:
+        """
+        Inserta/actualiza varios puntos en una sola petición a Qdrant.
+        Args:
+            points (list): Tuplas (point_id, vector, payload); vector puede ser una lista o un np.ndarray.
+        Returns:
+            bool: True si se almacenaron todos los puntos.
+        """
+        if not points:
+            return True
+        try:
+            self.client.upsert(
+                collection_name=self.COLLECTION_NAME,
+                points=[
+                    models.PointStruct(
+                        id=point_id,
+                        vector=np.asarray(vector, dtype=np.float32).tolist(),
+                        payload=payload,
+                    )
+                    for point_id, vector, payload in points
+                ],
+                wait=True
+            )
+            _clear_search_caches()
+            print(f"{len(points)} puntos insertados/actualizados en Qdrant.")
+            return True
+        except Exception as e:
+            print(f"Error al insertar {len(points)} puntos en Qdrant: {e}")
+            return False
+
+    def search_points(self, query_vector, limit: int = 5):
+        # query_vector puede ser una lista o un np.ndarray float32 (qdrant-client acepta ambos)
+        cache_key = _search_cache_key(query_vector, limit)
+        cached = _cached_search(cache_key, query_vector, limit)
+        if cached is not None:
+            print(f"Búsqueda en Qdrant servida desde caché. Resultados: {len(cached)}")
+            return cached
         try:
             search_result = self.client.search(
                 collection_name=self.COLLECTION_NAME, # Usa self.COLLECTION_NAME
                 query_vector=query_vector,
                 limit=limit,
+                search_params=SEARCH_PARAMS,
                 with_payload=True,
                 with_vectors=False
             )
             print(f"Búsqueda en Qdrant completada. Resultados encontrados: {len(search_result)}")
+            _store_search(cache_key, query_vector, limit, search_result)
             return search_result
         except Exception as e:
             print(f"Error al buscar en Qdrant: {e}")
             return []
 
+    def search_batch(self, query_vectors: list, limit: int = 1) -> list:
+        """
+        Ejecuta varias búsquedas en una sola petición a Qdrant (query_batch_points).
+        Las consultas ya cacheadas no se reenvían.
+        Args:
+            query_vectors (list): Lista de vectores de consulta.
+            limit (int): Resultados por consulta.
+        Returns:
+            list: Una lista de resultados (lista de ScoredPoint) por cada vector, en el mismo orden.
+        """
+        results = [None] * len(query_vectors)
+        pending = [] # (índice, clave de caché, vector) de las consultas no cacheadas
+        for i, vector in enumerate(query_vectors):
+            cache_key = _search_cache_key(vector, limit)
+            cached = _cached_search(cache_key, vector, limit)
+            if cached is not None:
+                results[i] = cached
+            else:
+                pending.append((i, cache_key, vector))
+
+        if pending:
+            try:
+                responses = self.client.query_batch_points(
+                    collection_name=self.COLLECTION_NAME,
+                    requests=[
+                        models.QueryRequest(
+                            query=np.asarray(vector, dtype=np.float32).tolist(),
+                            limit=limit,
+                            params=SEARCH_PARAMS,
+                            with_payload=True,
+                            with_vector=False,
+                        )
+                        for _, _, vector in pending
+                    ],
+                )
+                for (i, cache_key, vector), response in zip(pending, responses):
+                    results[i] = response.points
+                    _store_search(cache_key, vector, limit, response.points)
+            except Exception as e:
+                print(f"Error en la búsqueda por lotes en Qdrant: {e}")
+                for i, _, _ in pending:
+                    results[i] = []
+
+        print(f"Búsqueda por lotes en Qdrant completada: {len(query_vectors)} consultas ({len(pending)} enviadas a Qdrant).")
+        return results
+
+class BatchedSearcher:
+    """
+    Agrupa las búsquedas de un solo vector que llegan casi a la vez desde varios hilos (p. ej. herramientas
+    ejecutadas en paralelo por el agente) en una única llamada a search_batch (ver utils/batching.py).
+    Si solo hay un llamante activo, la búsqueda va directa a search_points sin esperar.
+    """
+
+    def __init__(self, handler: "QdrantHandler", window: float = 0.008, max_batch: int = 32):
+        """
+        Args:
+            handler (QdrantHandler): Handler sobre el que se lanzan las búsquedas.
+            window (float): Segundos que se espera a que se acumulen consultas.
+            max_batch (int): Máximo de consultas por petición a Qdrant.
+        """
+        self.handler = handler
+        self._batcher = MicroBatcher(self._search_many, self._search_one, window=window, max_batch=max_batch)
+
+    def search(self, query_vector, limit: int = 1) -> list:
+        """Equivalente a QdrantHandler.search_points, pero agrupable con búsquedas concurrentes."""
+        return self._batcher.submit((query_vector, limit))
+
+    def _search_one(self, request: tuple) -> list:
+        query_vector, limit = request
+        return self.handler.search_points(query_vector, limit=limit)
+
+    def _search_many(self, requests: list) -> list:
+        # search_batch usa un único 'limit' por petición: agrupar por límite
+        results = [None] * len(requests)
+        by_limit = {}
+        for i, (_, limit) in enumerate(requests):
+            by_limit.setdefault(limit, []).append(i)
+        for limit, indices in by_limit.items():
+            batch_results = self.handler.search_batch([requests[i][0] for i in indices], limit=limit)
+            for i, result in zip(indices, batch_results):
+                results[i] = result
+        return results
+
+
 # Ejemplo de uso (solo para pruebas directas de este módulo)
 if __name__ == "__main__":
     print("--- Probando QdrantHandler ---")
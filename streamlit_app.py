@@ -1,7 +1,6 @@
 import streamlit as st
 import os
 import uuid
-from PIL import Image
 import time
 import pyautogui
 import io # Para manejar la imagen cargada en memoria
@@ -9,28 +8,26 @@ import pytesseract # Importar pytesseract
 import cv2 # Importar OpenCV
 
 # Importar los módulos que hemos creado
-from qdrant_handler import QdrantHandler
-from image_processor import ImageProcessor
-from utils.screen_utils import take_screenshot, find_image_on_screen, get_monitor_info
-from qdrant_client import models # Necesario para models.VectorParams en la función de limpieza de Qdrant
+from utils.screen_utils import take_screenshot, take_screenshot_array, find_image_on_screen, get_monitor_info
 
 # ### CAMBIO NUEVO ###
-# Importar el AutomationAgent
+# Importar el AutomationAgent y los handlers que crea al cargar su módulo
+import automation_agent as automation_agent_module
 from automation_agent import AutomationAgent
 from utils.audio_utils import record_audio, transcribe_audio
+from image_processor import copy_clipping_file
+from utils.http_utils import run_async # Para ejecutar la versión asíncrona del agente
 
 # --- Inicializar handlers usando st.session_state para evitar re-inicializaciones ---
 # Esto asegura que los objetos se inicialicen solo una vez por sesión de usuario de Streamlit.
+# Se reutilizan las instancias globales de automation_agent: así toda la aplicación comparte
+# una sola conexión persistente con Qdrant y un solo modelo de embeddings cargado.
 if 'qdrant_handler' not in st.session_state:
-    st.session_state.qdrant_handler = QdrantHandler()
+    st.session_state.qdrant_handler = automation_agent_module.qdrant_handler
     # st.write("DEBUG: QdrantHandler inicializado.") # Mensaje de depuración
 
-# La inicialización de ImageProcessor ahora depende de qdrant_handler para obtener VECTOR_DIMENSION
-# Aseguramos que qdrant_handler esté inicializado primero.
 if 'image_processor' not in st.session_state:
-    # Asegúrate de que ImageProcessor no intente cargar el modelo si no puede obtener la dimensión
-    # Aunque tu ImageProcessor ya maneja la carga del modelo internamente.
-    st.session_state.image_processor = ImageProcessor()
+    st.session_state.image_processor = automation_agent_module.image_processor
     # st.write("DEBUG: ImageProcessor inicializado.") # Mensaje de depuración
 
 if 'automation_agent' not in st.session_state:
@@ -88,11 +85,11 @@ with tab_ingesta:
         st.info("Archivo subido con éxito. Procesando y generando descripción...")
 
         try:
-            # === CÓDIGO CORREGIDO AQUÍ ===
-            # La función describe_image_with_ai ahora devuelve 5 valores:
-            # description, keywords, element_type, ocr_text, ai_extracted_text
-            description, keywords, element_type, ocr_text, ai_extracted_text = image_processor.describe_image_with_ai(temp_clipping_path)
-            # =============================
+            # Descripción (IA + OCR), texto para el embedding y embedding en una sola llamada: el mismo
+            # recorte obtiene el mismo vector tanto si se ingiere desde aquí como desde main.py
+            clipping = image_processor.process_clipping(temp_clipping_path)
+            description, keywords, element_type = clipping["description"], clipping["keywords"], clipping["element_type"]
+            ocr_text, ai_extracted_text = clipping["ocr_text"], clipping["ai_extracted_text"]
 
             if description:
                 st.subheader("Descripción generada por Open AI:")
@@ -102,20 +99,14 @@ with tab_ingesta:
                 st.write(f"**Palabras clave:** {', '.join(keywords)}")
                 st.write(f"**Tipo de Elemento:** {element_type}")
 
-                # Decidir qué texto usar para el embedding: descripción combinada con el mejor texto visible
-                text_for_embedding = description
-                if ai_extracted_text and ai_extracted_text.lower() != "ninguno":
-                    text_for_embedding += f". Texto visible: {ai_extracted_text}"
-                elif ocr_text and ocr_text.strip() != "":
-                    text_for_embedding += f". Texto OCR: {ocr_text}"
-
-                embedding = image_processor.generate_embedding_from_text(text_for_embedding)
+                embedding = clipping["embedding"]
                 if len(embedding) == qdrant_handler.VECTOR_DIMENSION:
                     point_id = str(uuid.uuid4())
                     final_clipping_path = os.path.join(CLIPPINGS_DIR, f"{point_id}.png")
 
                     # Copiar el archivo subido a la carpeta de clippings con el nuevo ID
-                    Image.open(temp_clipping_path).save(final_clipping_path)
+                    # (los PNG byte a byte; los demás formatos se convierten a PNG)
+                    copy_clipping_file(temp_clipping_path, final_clipping_path)
 
                     payload = {
                         "image_id": point_id,
@@ -141,12 +132,14 @@ with tab_ingesta:
             st.error(f"Ocurrió un error durante el procesamiento del recorte: {e}")
         finally:
             # Asegurarse de que el archivo temporal se elimine siempre, incluso si hay un error
-            if os.path.exists(temp_clipping_path):
-                try:
-                    os.remove(temp_clipping_path)
-                    st.info(f"Archivo temporal '{temp_clipping_path}' eliminado.")
-                except Exception as e_del:
-                    st.error(f"ERROR: No se pudo eliminar el archivo temporal '{temp_clipping_path}': {e_del}. Por favor, verifica permisos o si el archivo está en uso.")
+            # (unlink directo: si ya no existe no hay nada que hacer, sin un stat previo)
+            try:
+                os.unlink(temp_clipping_path)
+                st.info(f"Archivo temporal '{temp_clipping_path}' eliminado.")
+            except FileNotFoundError:
+                pass
+            except Exception as e_del:
+                st.error(f"ERROR: No se pudo eliminar el archivo temporal '{temp_clipping_path}': {e_del}. Por favor, verifica permisos o si el archivo está en uso.")
 
 
 # --- Tab 2: Ejecutar Acciones UI ---
@@ -171,9 +164,6 @@ with tab_acciones:
         if instruction_text:
             st.info(f"Buscando elementos relacionados con: '{instruction_text}'...")
             
-            # Inicializar screenshot_temp_path aquí para que esté disponible en el finally
-            screenshot_temp_path = None 
-
             try:
                 query_embedding = image_processor.generate_embedding_from_text(instruction_text)
 
@@ -199,13 +189,11 @@ with tab_acciones:
 
                             st.write("Tomando captura de pantalla y buscando el elemento...")
                             current_screenshot_image = None
-                            
-                            # Genera un nombre de archivo temporal para la captura de pantalla
-                            screenshot_temp_path = os.path.join(TEMP_DIR, f"screenshot_{uuid.uuid4()}.png")
 
                             try:
-                                current_screenshot_image = take_screenshot(monitor_number=monitor_to_capture_id_actions) # Usar la variable de esta pestaña
-                                current_screenshot_image.save(screenshot_temp_path) # Guarda la captura temporalmente
+                                # Captura en memoria (np.ndarray BGRA): find_image_on_screen la usa directamente,
+                                # sin codificarla a PNG en disco y volver a leerla
+                                current_screenshot_image = take_screenshot_array(monitor_number=monitor_to_capture_id_actions) # Usar la variable de esta pestaña
                             except ValueError as ve:
                                 st.error(f"Error de monitor al tomar captura: {ve}")
                                 current_screenshot_image = None
@@ -213,11 +201,8 @@ with tab_acciones:
                                 st.error(f"Error general al tomar captura de pantalla: {e}")
                                 current_screenshot_image = None
                             
-                            # La limpieza de la captura temporal se hará en el finally principal
-                            if current_screenshot_image:
-                                # Aquí pasamos la ruta de la captura temporal a find_image_on_screen
-                                # que es lo que espera PyAutoGUI para el segundo argumento.
-                                location = find_image_on_screen(clipping_file_path, screenshot_temp_path, confidence=confidence_level)
+                            if current_screenshot_image is not None:
+                                location = find_image_on_screen(clipping_file_path, current_screenshot_image, confidence=confidence_level)
 
                                 if location:
                                     center_x = location.left + location.width / 2
@@ -236,13 +221,6 @@ with tab_acciones:
                         st.info("No se encontraron coincidencias suficientes en Qdrant para tu instrucción.")
             except Exception as e:
                 st.error(f"Ocurrió un error al procesar la instrucción: {e}")
-            finally: # Asegura que la captura de pantalla temporal siempre se elimine
-                if screenshot_temp_path and os.path.exists(screenshot_temp_path):
-                    try:
-                        os.remove(screenshot_temp_path)
-                        st.info(f"Archivo temporal de captura '{screenshot_temp_path}' eliminado.")
-                    except Exception as e_del:
-                        st.error(f"ERROR: No se pudo eliminar la captura temporal '{screenshot_temp_path}': {e_del}. Por favor, verifica permisos o si el archivo está en uso.")
         else:
             st.warning("Por favor, introduce una instrucción de texto.")
 
@@ -263,24 +241,15 @@ with tab_ocr:
     st.info("Para capturar una región específica, puedes usar la herramienta de recorte de tu sistema operativo (ej. Recortes y anotación en Windows) y luego subir la imagen en la pestaña de 'Ingesta de Recortes'. Aquí se capturará toda la pantalla seleccionada.")
 
     if st.button("Realizar OCR de Pantalla"):
-        ocr_screenshot_path = None
         try:
             st.info("Tomando captura de pantalla para OCR...")
             ocr_screenshot_image = take_screenshot(monitor_number=monitor_to_capture_id_ocr)
-            
-            ocr_screenshot_path = os.path.join(TEMP_DIR, f"ocr_screenshot_{uuid.uuid4()}.png")
-            ocr_screenshot_image.save(ocr_screenshot_path)
 
             st.image(ocr_screenshot_image, caption="Captura de Pantalla para OCR", use_container_width=True)
 
             with st.spinner("Realizando OCR..."):
-                # Aquí se invoca la funcionalidad de OCR.
-                # Asegúrate de que ImageProcessor tenga el método perform_ocr_on_image.
-                # O si no, puedes realizar el OCR directamente aquí si es una función simple.
-                # Por ahora, asumiremos que ImageProcessor puede hacerlo.
-                # Si no existe, tendrías que añadirlo en image_processor.py.
-                # Ejemplo de cómo se llamaría:
-                recognized_text = image_processor.perform_ocr_on_image(ocr_screenshot_path) 
+                # OCR directamente sobre la captura en memoria (sin archivo temporal)
+                recognized_text = image_processor.extract_text_from_pil(ocr_screenshot_image)
                 
                 if recognized_text:
                     st.subheader("Texto Reconocido (OCR):")
@@ -291,13 +260,6 @@ with tab_ocr:
             st.error("Error: Tesseract OCR no está instalado o no se encuentra en el PATH. Por favor, instálalo desde https://tesseract-ocr.github.io/tessdoc/Installation.html y asegúrate de que esté en tu PATH o configura pytesseract.pytesseract.tesseract_cmd.")
         except Exception as e:
             st.error(f"Ocurrió un error al realizar OCR: {e}")
-        finally:
-            if ocr_screenshot_path and os.path.exists(ocr_screenshot_path):
-                try:
-                    os.remove(ocr_screenshot_path)
-                    st.info(f"Archivo temporal de OCR '{ocr_screenshot_path}' eliminado.")
-                except Exception as e_del:
-                    st.error(f"ERROR: No se pudo eliminar el archivo temporal de OCR '{ocr_screenshot_path}': {e_del}. Por favor, verifica permisos o si el archivo está en uso.")
 
 # --- Tab 4: Automatización de Tareas Complejas (Agente IA) --- (Ahora es la 4ª pestaña)
 with tab_complex_automation:
@@ -361,10 +323,12 @@ with tab_complex_automation:
             except Exception as e:
                 st.error(f"Error en la grabación/transcripción de voz: {e}")
             finally: # Asegura que el archivo de audio temporal siempre se elimine
-                if recorded_path and os.path.exists(recorded_path): # Usar recorded_path para la limpieza
+                if recorded_path: # Usar recorded_path para la limpieza
                     try:
-                        os.remove(recorded_path)
+                        os.unlink(recorded_path)
                         st.info(f"Archivo de audio temporal '{recorded_path}' eliminado.")
+                    except FileNotFoundError:
+                        pass
                     except Exception as e_del:
                         st.error(f"ERROR: No se pudo eliminar el archivo de audio temporal '{recorded_path}': {e_del}. Por favor, verifica permisos o si el archivo está en uso.")
 
@@ -374,7 +338,7 @@ with tab_complex_automation:
             with st.spinner("El Agente está procesando la tarea... Esto puede tomar un tiempo y mostrará los pasos en la consola."):
                 try:
                     # Pasar la instrucción desde st.session_state al agente
-                    st_response = automation_agent.run_task(st.session_state.complex_instruction_text)
+                    st_response = run_async(automation_agent.arun_task(st.session_state.complex_instruction_text))
                     st.subheader("Resultado del Agente:")
                     st.success(st_response)
                 except Exception as e:
@@ -428,8 +392,6 @@ with tab_config:
         except Exception as e:
             st.error(f"Error al vaciar carpeta '{TEMP_DIR}': {e}")
 
-    # Asegúrate de importar `models` de `qdrant_client` al inicio del archivo si no lo está.
-    # from qdrant_client import models
     if st.button("Vaciar carpeta 'clippings' y colección Qdrant (¡CUIDADO!)", key="clear_clippings_qdrant_button"):
         st.warning("Esta acción borrará PERMANENTEMENTE todos los recortes de UI guardados y la colección en Qdrant.")
         confirm = st.checkbox("Estoy seguro de que quiero borrar TODOS los recortes de UI y vaciar Qdrant.", key="confirm_delete_clippings_qdrant")
@@ -443,12 +405,8 @@ with tab_config:
                 else:
                     st.info(f"La carpeta '{CLIPPINGS_DIR}' no existe o ya está vacía.")
                 
-                # Recrear la colección Qdrant (esto la vacía)
-                # Asegúrate de que qdrant_handler.COLLECTION_NAME y qdrant_handler.VECTOR_DIMENSION están bien inicializados
-                qdrant_handler.client.recreate_collection(
-                    collection_name=qdrant_handler.COLLECTION_NAME,
-                    vectors_config=models.VectorParams(size=qdrant_handler.VECTOR_DIMENSION, distance=models.Distance.COSINE),
-                )
+                # Recrear la colección Qdrant (esto la vacía y descarta las búsquedas cacheadas)
+                qdrant_handler.recreate_collection()
                 st.success(f"Colección Qdrant '{qdrant_handler.COLLECTION_NAME}' recreada (vaciada).")
                 st.rerun() # Recargar la página para reflejar los cambios
             except Exception as e:
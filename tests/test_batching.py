@@ -0,0 +1,86 @@
+import threading
+import time
+
+from utils.batching import MicroBatcher
+
+
+def _wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("La condición no se cumplió a tiempo.")
+        time.sleep(0.001)
+
+
+def _submit_concurrently(batcher, requests):
+    """
+    Envía 'requests' desde hilos distintos, en ese orden, mientras un primer llamante ocupa el camino directo
+    (single_fn): así ninguna va sola y todas entran en el mismo lote. Devuelve el resultado o la excepción
+    de cada petición.
+    """
+    release = threading.Event()
+    single_fn = batcher.single_fn
+    batcher.single_fn = lambda request: release.wait(5) and single_fn(request)
+    blocker = threading.Thread(target=batcher.submit, args=("blocker",))
+    blocker.start()
+    _wait_until(lambda: batcher._active == 1)
+
+    outcomes = [None] * len(requests)
+
+    def call(i):
+        try:
+            outcomes[i] = batcher.submit(requests[i])
+        except Exception as e:
+            outcomes[i] = e
+
+    threads = []
+    for i in range(len(requests)):
+        threads.append(threading.Thread(target=call, args=(i,)))
+        threads[-1].start()
+        _wait_until(lambda: len(batcher._pending) == i + 1) # Encolar en orden conocido
+    for t in threads:
+        t.join(5)
+    release.set()
+    blocker.join(5)
+    return outcomes
+
+
+def test_lone_caller_uses_single_fn():
+    batches = []
+    batcher = MicroBatcher(lambda reqs: batches.append(reqs) or reqs, lambda r: ("single", r))
+    assert batcher.submit(7) == ("single", 7)
+    assert batches == []
+
+
+def test_concurrent_callers_share_one_batch_in_order():
+    batches = []
+    batcher = MicroBatcher(lambda reqs: batches.append(list(reqs)) or [r * 10 for r in reqs],
+                           lambda r: r * 10, window=0.3)
+    outcomes = _submit_concurrently(batcher, [1, 2, 3, 4])
+    assert batches == [[1, 2, 3, 4]]
+    assert outcomes == [10, 20, 30, 40]
+    assert batcher._leader_running is False and batcher._pending == []
+
+
+def test_exception_result_only_fails_its_own_caller():
+    def batch_fn(reqs):
+        return [ValueError(f"zona {r} inválida") if r == 2 else r for r in reqs]
+
+    batcher = MicroBatcher(batch_fn, lambda r: r, window=0.3)
+    outcomes = _submit_concurrently(batcher, [1, 2, 3])
+    assert outcomes[0] == 1 and outcomes[2] == 3
+    assert isinstance(outcomes[1], ValueError)
+
+
+def test_result_count_mismatch_fails_whole_batch():
+    batcher = MicroBatcher(lambda reqs: reqs[:-1], lambda r: r, window=0.3)
+    outcomes = _submit_concurrently(batcher, [1, 2, 3])
+    assert all(isinstance(o, RuntimeError) for o in outcomes)
+
+
+def test_max_batch_splits_queue():
+    batches = []
+    batcher = MicroBatcher(lambda reqs: batches.append(list(reqs)) or reqs, lambda r: r, window=0.3, max_batch=2)
+    outcomes = _submit_concurrently(batcher, [1, 2, 3])
+    assert batches == [[1, 2], [3]]
+    assert outcomes == [1, 2, 3]
@@ -0,0 +1,34 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from utils.cache_utils import SemanticCache
+
+
+def _vector_with_similarity(base, similarity):
+    """Vector unitario cuya similitud coseno con 'base' (unitario) es exactamente 'similarity'."""
+    orthogonal = np.zeros_like(base)
+    orthogonal[1] = 1.0
+    return similarity * base + np.sqrt(1.0 - similarity ** 2) * orthogonal
+
+
+def test_semantic_cache_rejects_close_paraphrase():
+    base = np.zeros(384, dtype=np.float32)
+    base[0] = 1.0
+    cache = SemanticCache(maxlen=4)
+    cache.put(base, "arrancar")
+
+    # Similitud típica entre órdenes opuestas sobre el mismo elemento: no debe reutilizarse
+    assert cache.get(_vector_with_similarity(base, 0.97)) is None
+    assert cache.get(_vector_with_similarity(base, 0.999)) == "arrancar"
+
+
+def test_semantic_cache_separates_tags_and_clear():
+    base = np.ones(8, dtype=np.float32)
+    cache = SemanticCache(maxlen=4)
+    cache.put(base, "limit-1", tag=1)
+
+    assert cache.get(base, tag=5) is None
+    assert cache.get(base, tag=1) == "limit-1"
+    cache.clear()
+    assert cache.get(base, tag=1) is None
@@ -0,0 +1,211 @@
+import threading
+
+import pytest
+
+import plc_handler
+from plc_handler import (
+    MAX_MERGED_BYTES, MERGE_GAP, PLCConnectionError, PLCHandler, PLCReadWriteError, S7Item, S7Write,
+    S7_AREA_DB, S7_AREA_M,
+)
+
+
+class FakeLibrary:
+    """Imita la DLL de Snap7: escribe el Result de cada zona en el array que recibe."""
+
+    def __init__(self, rejected_starts=()):
+        self.rejected_starts = set(rejected_starts)
+        self.calls = 0
+
+    def Cli_WriteMultiVars(self, pointer, items_ref, count):
+        self.calls += 1
+        items = items_ref._obj
+        for i in range(count.value):
+            items[i].Result = 0x00A00000 if items[i].Start in self.rejected_starts else 0
+        return 0
+
+
+class FakeClient:
+    def __init__(self, library):
+        self._library = library
+        self._pointer = object()
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    if plc_handler._S7DataItem_actual is None:
+        pytest.skip("python-snap7 no está instalado")
+    monkeypatch.setattr(plc_handler, "_S7Client_actual", object()) # Cualquier valor: "snap7 disponible"
+    h = PLCHandler()
+    h.is_connected = True
+    return h
+
+
+def test_write_many_reports_rejected_item(handler):
+    handler.client = FakeClient(FakeLibrary(rejected_starts={4}))
+    writes = [
+        S7Write(S7_AREA_DB, 1, 0, bytearray(b"\x00\x01")),
+        S7Write(S7_AREA_DB, 1, 4, bytearray(b"\x00\x02")),
+    ]
+    with pytest.raises(PLCReadWriteError, match="start=4"):
+        handler.write_many(writes)
+
+
+def test_write_many_succeeds_when_all_items_accepted(handler):
+    library = FakeLibrary()
+    handler.client = FakeClient(library)
+    writes = [S7Write(S7_AREA_DB, 1, i * 2, bytearray(b"\x00\x01")) for i in range(3)]
+    assert handler.write_many(writes) is True
+    assert library.calls == 1
+
+
+class _FakeS7Module:
+    """Sustituye a snap7.client: cada Client() llama a 'on_connect' y queda conectado o no según 'ok'."""
+
+    def __init__(self, on_connect=lambda: None, ok=True):
+        module = self
+
+        class Client:
+            def connect(self, ip, rack, slot):
+                module.on_connect()
+
+            def get_connected(self):
+                return module.ok
+
+            def get_cpu_state(self):
+                return "S7CpuStatusRun"
+
+            def disconnect(self):
+                pass
+
+            def destroy(self):
+                pass
+
+        self.Client = Client
+        self.on_connect = on_connect
+        self.ok = ok
+
+
+@pytest.fixture
+def real_plc(monkeypatch):
+    monkeypatch.setattr(plc_handler, "PLC_IP_ADDRESS", "192.0.2.1")
+    monkeypatch.setattr(plc_handler, "PLC_KEEPALIVE_INTERVAL", 3600)
+    handlers = []
+    yield lambda: handlers.append(PLCHandler()) or handlers[-1]
+    for h in handlers:
+        h._keepalive_stop.set()
+
+
+def test_connect_does_not_hold_lock_while_connecting(monkeypatch, real_plc):
+    handler = real_plc()
+    lock_was_free = []
+
+    def on_connect():
+        # Otro hilo debe poder tomar el lock mientras se abre la conexión TCP
+        result = []
+        t = threading.Thread(target=lambda: result.append(handler._lock.acquire(timeout=1) and handler._lock.release() is None))
+        t.start()
+        t.join()
+        lock_was_free.append(result == [True])
+
+    monkeypatch.setattr(plc_handler, "_S7Client_actual", _FakeS7Module(on_connect))
+    assert handler.connect() is True
+    assert lock_was_free == [True]
+    assert handler.is_connected and handler.client is not None
+
+
+def test_first_use_starts_keepalive_even_if_connect_fails(monkeypatch, real_plc):
+    monkeypatch.setattr(plc_handler, "_S7Client_actual", _FakeS7Module(ok=False))
+    handler = real_plc()
+    with pytest.raises(PLCConnectionError):
+        handler.read_db(1, 0, 2)
+    assert handler._keepalive_thread is not None and handler._keepalive_thread.is_alive()
+    assert not handler.is_connected and handler._next_retry_ts > 0
+
+
+def test_coalesce_merges_overlapping_and_adjacent_ranges():
+    items = [
+        S7Item(S7_AREA_DB, 1, 10, 2),  # Adyacente a la siguiente (10-11, 12-15)
+        S7Item(S7_AREA_DB, 1, 12, 4),
+        S7Item(S7_AREA_DB, 1, 0, 4),   # Llega desordenada: se fusiona con 2-5 y luego con 10
+        S7Item(S7_AREA_DB, 1, 2, 4),   # Solapada con 0-3
+    ]
+    merged, placement = PLCHandler._coalesce(items)
+    assert merged == [S7Item(S7_AREA_DB, 1, 0, 16)]
+    assert placement == [(0, 10), (0, 12), (0, 0), (0, 2)]
+
+
+def test_coalesce_respects_gap_area_and_db():
+    items = [
+        S7Item(S7_AREA_DB, 1, 0, 2),
+        S7Item(S7_AREA_DB, 1, 2 + MERGE_GAP, 2),      # Justo dentro del hueco permitido
+        S7Item(S7_AREA_DB, 1, 4 + 2 * MERGE_GAP + 1, 2), # Un byte más allá: bloque nuevo
+        S7Item(S7_AREA_DB, 2, 0, 2),                   # Otro DB
+        S7Item(S7_AREA_M, 0, 0, 2),                    # Otra área
+    ]
+    merged, placement = PLCHandler._coalesce(items)
+    # Orden de los bloques: (área, DB, byte inicial); la memoria M (0x83) va antes que los DB (0x84)
+    assert merged == [
+        S7Item(S7_AREA_M, 0, 0, 2),
+        S7Item(S7_AREA_DB, 1, 0, 4 + MERGE_GAP),
+        S7Item(S7_AREA_DB, 1, 4 + 2 * MERGE_GAP + 1, 2),
+        S7Item(S7_AREA_DB, 2, 0, 2),
+    ]
+    assert placement == [(1, 0), (1, 2 + MERGE_GAP), (2, 0), (3, 0), (0, 0)]
+
+
+def test_coalesce_does_not_exceed_max_merged_bytes():
+    first = MAX_MERGED_BYTES - 50
+    items = [S7Item(S7_AREA_DB, 1, 0, first), S7Item(S7_AREA_DB, 1, first, 100)]
+    merged, placement = PLCHandler._coalesce(items)
+    assert merged == items
+    assert placement == [(0, 0), (1, 0)]
+    assert all(block.size <= MAX_MERGED_BYTES for block in merged)
+
+
+def _fake_memory_reader(memory, bad_bytes):
+    """_read_blocks de prueba: lee de 'memory' y rechaza cualquier zona que incluya un byte de 'bad_bytes'."""
+    calls = []
+
+    def read_blocks(items):
+        calls.append(list(items))
+        return [
+            PLCReadWriteError(f"Error al leer {item}.")
+            if any(item.start <= b < item.start + item.size for b in bad_bytes)
+            else bytearray(memory[item.start:item.start + item.size])
+            for item in items
+        ]
+
+    return read_blocks, calls
+
+
+def test_read_results_slices_merged_block():
+    h = PLCHandler()
+    memory = bytes(range(64))
+    h._read_blocks, calls = _fake_memory_reader(memory, bad_bytes=())
+    items = [S7Item(S7_AREA_DB, 1, 8, 2), S7Item(S7_AREA_DB, 1, 0, 4)]
+    assert h._read_results(items) == [bytearray(memory[8:10]), bytearray(memory[0:4])]
+    assert calls == [[S7Item(S7_AREA_DB, 1, 0, 10)]]
+
+
+def test_read_results_retries_failed_merged_block_per_item():
+    h = PLCHandler()
+    memory = bytes(range(64))
+    # El byte 6 no existe en el PLC: el bloque fusionado 0-9 falla, pero 0-3 y 8-9 se pueden leer
+    h._read_blocks, calls = _fake_memory_reader(memory, bad_bytes={6})
+    items = [S7Item(S7_AREA_DB, 1, 0, 4), S7Item(S7_AREA_DB, 1, 5, 2), S7Item(S7_AREA_DB, 1, 8, 2)]
+    results = h._read_results(items)
+    assert results[0] == bytearray(memory[0:4])
+    assert isinstance(results[1], PLCReadWriteError)
+    assert results[2] == bytearray(memory[8:10])
+    assert calls == [[S7Item(S7_AREA_DB, 1, 0, 10)], items]
+    with pytest.raises(PLCReadWriteError):
+        h.read_many(items)
+
+
+def test_read_results_does_not_retry_unmerged_item():
+    h = PLCHandler()
+    h._read_blocks, calls = _fake_memory_reader(bytes(64), bad_bytes={40})
+    items = [S7Item(S7_AREA_DB, 1, 0, 2), S7Item(S7_AREA_DB, 1, 40, 2)]
+    results = h._read_results(items)
+    assert results[0] == bytearray(2) and isinstance(results[1], PLCReadWriteError)
+    assert len(calls) == 1 # La zona que falla ya se leyó sola: no hay reintento
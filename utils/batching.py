@@ -0,0 +1,95 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+
+class MicroBatcher:
+    """
+    Agrupa las peticiones individuales que llegan casi a la vez desde varios hilos (p. ej. herramientas
+    que el agente ejecuta en paralelo) en una sola llamada por lotes.
+    No usa hilo propio: el primer llamante de cada ventana actúa como "líder", espera 'window' segundos
+    a que lleguen más peticiones, ejecuta el lote y reparte los resultados. Si solo hay un llamante
+    activo, la petición va directa a 'single_fn' sin esperar.
+    """
+
+    def __init__(self, batch_fn: Callable[[List[Any]], List[Any]], single_fn: Callable[[Any], Any],
+                 window: float = 0.008, max_batch: int = 32):
+        """
+        Args:
+            batch_fn (callable): Recibe una lista de peticiones y devuelve sus resultados en el mismo orden.
+                                 Un resultado que sea una excepción se lanza solo en el llamante de esa petición.
+            single_fn (callable): Atiende una petición suelta (camino sin espera).
+            window (float): Segundos que el líder espera a que se acumulen peticiones.
+            max_batch (int): Máximo de peticiones por llamada a 'batch_fn'.
+        """
+        self.batch_fn = batch_fn
+        self.single_fn = single_fn
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pending = [] # (petición, Future)
+        self._active = 0 # Llamantes dentro de submit() en este momento
+        self._leader_running = False
+
+    def submit(self, request: Any) -> Any:
+        """Atiende 'request', agrupándola con las peticiones concurrentes si las hay."""
+        with self._lock:
+            self._active += 1
+            alone = self._active == 1 and not self._leader_running
+        try:
+            if alone:
+                return self.single_fn(request)
+
+            future = Future()
+            with self._lock:
+                self._pending.append((request, future))
+                lead = not self._leader_running
+                if lead:
+                    self._leader_running = True
+            if lead:
+                self._run_batches()
+            return future.result()
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def _run_batches(self):
+        """Bucle del líder: vacía la cola por lotes hasta que no queden peticiones pendientes."""
+        finished = False
+        try:
+            time.sleep(self.window)
+            while True:
+                with self._lock:
+                    batch = self._pending[:self.max_batch]
+                    del self._pending[:self.max_batch]
+                    if not batch:
+                        self._leader_running = False
+                        finished = True
+                        return
+                self._run_batch(batch)
+        finally:
+            if not finished:
+                # El líder sale por un error inesperado: liberar el liderazgo y no dejar peticiones
+                # encoladas sin nadie que las atienda
+                with self._lock:
+                    self._leader_running = False
+                    orphans, self._pending = self._pending, []
+                for _, future in orphans:
+                    future.set_exception(RuntimeError("El lote se interrumpió antes de atender esta petición."))
+
+    def _run_batch(self, batch: list):
+        """Ejecuta un lote y resuelve cada Future con su resultado o su excepción."""
+        try:
+            results = list(self.batch_fn([request for request, _ in batch]))
+            if len(results) != len(batch):
+                raise RuntimeError(f"batch_fn devolvió {len(results)} resultados para {len(batch)} peticiones.")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
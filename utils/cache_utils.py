@@ -0,0 +1,251 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import numpy as np
+
+
+class QueryCache:
+    """
+    Caché LRU acotada con expiración (TTL), segura para hilos.
+    Se usa para memorizar resultados costosos (embeddings, búsquedas) que se repiten
+    entre pasos del agente con las mismas entradas.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = 300.0):
+        """
+        Args:
+            maxsize (int): Número máximo de entradas antes de expulsar la menos usada.
+            ttl (float, optional): Segundos de validez de cada entrada. None = sin expiración.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Devuelve el valor cacheado para 'key' o None si no existe o ha expirado."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, value = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any, stored_at: Optional[float] = None) -> None:
+        """
+        Inserta o actualiza una entrada, expulsando la menos usada si se supera 'maxsize'.
+        'stored_at' (time.monotonic) permite conservar la antigüedad de un valor que viene de otra caché.
+        """
+        with self._lock:
+            self._data[key] = (time.monotonic() if stored_at is None else stored_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Vacía la caché (p. ej. cuando cambia la colección de Qdrant)."""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """Devuelve contadores de aciertos, fallos, expulsiones y tamaño actual."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._data),
+            }
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+class DiskArrayCache:
+    """
+    Caché persistente de vectores (np.ndarray) en disco, un archivo .npy por clave.
+    Complementa a QueryCache para que los embeddings sobrevivan a los reinicios del proceso.
+    El nombre de archivo es el sha256 de 'namespace' + clave, de modo que cambiar de modelo
+    (namespace) no reutiliza vectores incompatibles.
+    """
+
+    def __init__(self, directory: str, namespace: str):
+        """
+        Args:
+            directory (str): Carpeta donde se guardan los vectores (se crea si no existe).
+            namespace (str): Identificador del modelo/origen de los vectores.
+        """
+        self.directory = directory
+        self.namespace = namespace
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha256(f"{self.namespace}\0{key}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.npy")
+
+    def get(self, key: str, mmap_mode: Optional[str] = None) -> Optional[np.ndarray]:
+        """
+        Devuelve el vector guardado para 'key' o None si no existe o el archivo está dañado.
+        Con mmap_mode='r' el archivo se proyecta en memoria en lugar de leerse: las páginas se cargan
+        bajo demanda y el sistema las comparte entre procesos.
+        """
+        try:
+            return np.load(self._path(key), mmap_mode=mmap_mode, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, value: np.ndarray) -> None:
+        """Guarda el vector de forma atómica (archivo temporal + rename); los errores de E/S se ignoran."""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, value, allow_pickle=False)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+class DiskJsonCache:
+    """
+    Variante de DiskArrayCache para resultados serializables a JSON (listas, diccionarios, textos),
+    un archivo .json por clave. Misma convención de nombres (sha256 de 'namespace' + clave) y de escritura atómica.
+    """
+
+    def __init__(self, directory: str, namespace: str):
+        """
+        Args:
+            directory (str): Carpeta donde se guardan los resultados (se crea si no existe).
+            namespace (str): Identificador del modelo/origen de los resultados.
+        """
+        self.directory = directory
+        self.namespace = namespace
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha256(f"{self.namespace}\0{key}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def get(self, key: str) -> Optional[Any]:
+        """Devuelve el resultado guardado para 'key' o None si no existe o el archivo está dañado."""
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, value: Any) -> None:
+        """Guarda el resultado de forma atómica (archivo temporal + rename); los errores de E/S se ignoran."""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+class SemanticCache:
+    """
+    Caché por similitud: devuelve el resultado guardado para una consulta anterior cuyo vector
+    tenga similitud coseno >= 'threshold' con el de la consulta actual. El umbral debe ser muy estricto:
+    frases que solo difieren en el verbo ("arrancar"/"parar") pueden tener similitudes por encima de 0.95.
+    Los vectores normalizados se guardan en una matriz circular preasignada, de modo que cada consulta
+    es un único producto matriz-vector.
+    """
+
+    def __init__(self, maxlen: int = 128, threshold: float = 0.995, ttl: Optional[float] = 300.0):
+        """
+        Args:
+            maxlen (int): Número máximo de consultas recordadas (se sobrescriben las más antiguas).
+            threshold (float): Similitud coseno mínima para considerar dos consultas equivalentes.
+            ttl (float, optional): Segundos de validez de cada consulta. None = sin expiración.
+        """
+        self.maxlen = maxlen
+        self.threshold = threshold
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._matrix: Optional[np.ndarray] = None # (maxlen, dim), se crea con la primera inserción
+        self._tags = np.full(maxlen, -1, dtype=np.int64) # Etiqueta de cada fila (p. ej. el 'limit'); -1 = vacía
+        self._values: list = [None] * maxlen
+        self._stored_at = np.zeros(maxlen, dtype=np.float64) # time.monotonic() de cada fila
+        self._next = 0 # Siguiente fila a sobrescribir
+        self.hits = 0
+
+    @staticmethod
+    def _normalize(vector) -> Optional[np.ndarray]:
+        v = np.asarray(vector, dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(v))
+        return v / norm if norm > 0 else None
+
+    def get(self, vector, tag: int = 0) -> Optional[Any]:
+        """Devuelve el valor de la consulta más parecida con la misma etiqueta, o None si ninguna supera el umbral."""
+        entry = self.get_entry(vector, tag)
+        return None if entry is None else entry[1]
+
+    def get_entry(self, vector, tag: int = 0) -> Optional[tuple]:
+        """
+        Como get, pero devuelve (stored_at, valor): el instante (time.monotonic) en que se guardó la consulta,
+        para que quien lo copie a otra caché conserve su antigüedad. Las filas expiradas no cuentan.
+        """
+        q = self._normalize(vector)
+        with self._lock:
+            if q is None or self._matrix is None or self._matrix.shape[1] != q.shape[0]:
+                return None
+            sims = self._matrix @ q
+            invalid = self._tags != tag
+            if self.ttl is not None:
+                invalid |= (time.monotonic() - self._stored_at) > self.ttl
+            sims[invalid] = -1.0
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            self.hits += 1
+            return float(self._stored_at[best]), self._values[best]
+
+    def put(self, vector, value: Any, tag: int = 0) -> None:
+        """Recuerda 'value' como resultado de la consulta 'vector'."""
+        q = self._normalize(vector)
+        if q is None:
+            return
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != q.shape[0]:
+                self._matrix = np.zeros((self.maxlen, q.shape[0]), dtype=np.float32)
+                self._tags[:] = -1
+            row = self._next
+            self._matrix[row] = q
+            self._tags[row] = tag
+            self._values[row] = value
+            self._stored_at[row] = time.monotonic()
+            self._next = (row + 1) % self.maxlen
+
+    def clear(self) -> None:
+        """Olvida todas las consultas (p. ej. cuando cambia la colección de Qdrant)."""
+        with self._lock:
+            self._tags[:] = -1
+            self._values = [None] * self.maxlen
+            self._next = 0
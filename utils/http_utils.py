@@ -0,0 +1,53 @@
+import asyncio
+import atexit
+import os
+import threading
+
+import httpx
+
+# Clientes HTTP compartidos por todo el proceso para hablar con la API de OpenAI (ChatOpenAI del agente,
+# cliente de visión de ImageProcessor): reutilizan las conexiones TLS y, con HTTP/2 (paquete 'h2'),
+# multiplexan peticiones concurrentes en una sola conexión.
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "true").lower() in ("1", "true", "yes")
+OPENAI_HTTP_TIMEOUT = float(os.getenv("OPENAI_HTTP_TIMEOUT", 60.0)) # segundos
+_OPENAI_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=10, max_connections=20)
+
+openai_http_client = httpx.Client(http2=OPENAI_HTTP2, timeout=OPENAI_HTTP_TIMEOUT, limits=_OPENAI_HTTP_LIMITS)
+openai_async_http_client = httpx.AsyncClient(http2=OPENAI_HTTP2, timeout=OPENAI_HTTP_TIMEOUT, limits=_OPENAI_HTTP_LIMITS)
+atexit.register(openai_http_client.close)
+
+# El AsyncClient queda ligado al bucle de eventos en el que abre sus conexiones: si cada petición hiciera
+# asyncio.run (un bucle nuevo que se cierra al terminar), la segunda reutilizaría conexiones de un bucle ya
+# cerrado ("Event loop is closed"). Por eso todo el código asíncrono que lo use debe lanzarse con run_async,
+# que lo ejecuta en un único bucle de larga duración en un hilo propio.
+_async_loop = None
+_async_loop_lock = threading.Lock()
+
+
+def _get_async_loop() -> asyncio.AbstractEventLoop:
+    """Devuelve el bucle de eventos compartido, arrancando su hilo la primera vez."""
+    global _async_loop
+    with _async_loop_lock:
+        if _async_loop is None:
+            _async_loop = asyncio.new_event_loop()
+            threading.Thread(target=_async_loop.run_forever, name="openai-async-loop", daemon=True).start()
+        return _async_loop
+
+
+def run_async(coro):
+    """
+    Ejecuta la corrutina en el bucle de eventos compartido y espera su resultado (sustituye a asyncio.run
+    para el código que usa openai_async_http_client).
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_async_loop()).result()
+
+
+def _close_async_http_client():
+    if _async_loop is not None and _async_loop.is_running():
+        try:
+            asyncio.run_coroutine_threadsafe(openai_async_http_client.aclose(), _async_loop).result(timeout=5)
+        except Exception:
+            pass
+
+
+atexit.register(_close_async_http_client)
@@ -0,0 +1,47 @@
+import atexit
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler que no formatea el registro en el hilo que lo emite: el mensaje y el traceback
+    (si lo hay) se formatean en el hilo del QueueListener. La cola es en memoria, así que no hace
+    falta convertir el registro a algo serializable.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler(sys.stderr)
+_stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+_listener = QueueListener(_queue, _stream_handler, respect_handler_level=False)
+_listener.start()
+atexit.register(_listener.stop) # Vaciar la cola antes de terminar el proceso
+
+_queue_handler = _DeferredQueueHandler(_queue)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Devuelve un logger que escribe a través de la cola compartida: la llamada solo encola el registro
+    y la escritura en stderr ocurre en un hilo en segundo plano.
+    Args:
+        name (str): Nombre del logger (normalmente el del módulo).
+    Returns:
+        logging.Logger: Logger con nivel LOG_LEVEL (variable de entorno, INFO por defecto).
+    """
+    logger = logging.getLogger(name)
+    if _queue_handler not in logger.handlers:
+        logger.addHandler(_queue_handler)
+        logger.setLevel(LOG_LEVEL)
+        logger.propagate = False # Evitar que el root logger lo escriba de nuevo de forma síncrona
+    return logger
@@ -1,109 +1,355 @@
-from typing import Optional
-import pyscreeze
+from typing import NamedTuple, Optional, Union
+import cv2
+import numpy as np
 from PIL import Image
 from mss import mss
 import screeninfo # Para obtener información detallada de los monitores
 import os # Para verificar si los archivos existen
 import traceback # Para depuración de errores
 import sys # Para un manejo más limpio de la salida en la función main
+import threading
+import time
 
-def take_screenshot(monitor_number: Optional[int] = None) -> Optional[Image.Image]:
+from utils.template_cache import load_template, load_scaled_template
+from utils.log_utils import get_logger
+
+log = get_logger(__name__)
+
+# Instancia de mss por hilo: crearla (y liberar sus contextos de dispositivo) en cada captura cuesta
+# más que la propia captura. Se usa una por hilo porque los handles de mss no se comparten entre hilos.
+_thread_local = threading.local()
+
+
+def _get_sct():
+    """Devuelve la instancia de mss del hilo actual, creándola la primera vez."""
+    sct = getattr(_thread_local, "sct", None)
+    if sct is None:
+        sct = mss()
+        _thread_local.sct = sct
+    return sct
+
+
+def _grab(monitor_number: Optional[int] = None, region: Optional[tuple] = None):
+    """
+    Captura el monitor indicado con la instancia de mss del hilo.
+    Args:
+        monitor_number (int, optional): Índice del monitor físico (ver take_screenshot).
+        region (tuple, optional): (x, y, ancho, alto) relativos al monitor. Si se indica, mss solo copia
+                                  esos píxeles; la región se recorta a los límites del monitor.
+    Returns:
+        mss.screenshot.ScreenShot: Captura en bruto (BGRA).
+    Raises:
+        ValueError: Si el número de monitor o la región son inválidos.
+    """
+    sct = _get_sct()
+    # monitors[0] es la pantalla combinada de todos los monitores.
+    # monitors[1], monitors[2], etc., son los monitores individuales físicos.
+    # Por lo tanto, el monitor_number proporcionado por el usuario (0-indexed para monitores físicos)
+    # debe mapearse a mss_monitor_index = monitor_number + 1.
+    
+    # Si solo hay un monitor físico (monitors[0] y monitors[1] disponibles), len(monitors) será 2.
+    # Los IDs de monitor físico utilizables serán del 0 al len(monitors) - 2.
+    num_physical_monitors = len(sct.monitors) - 1 # Excluye el monitor[0] que es el área combinada
+
+    if monitor_number is not None:
+        if not (0 <= monitor_number < num_physical_monitors):
+            log.error("Número de monitor inválido: %s. Monitores físicos disponibles: 0 a %s.", monitor_number, num_physical_monitors - 1)
+            log.debug("'monitors' de mss contiene %s elementos (monitors[0] es el área combinada de todos los monitores físicos).", len(sct.monitors))
+            raise ValueError(
+                f"Número de monitor inválido: {monitor_number}. Monitores físicos disponibles: 0 a {num_physical_monitors - 1}."
+                " (0 es el primer monitor físico, 1 el segundo, etc.)"
+            )
+        # Mapear el índice proporcionado (0-indexed físico) al índice de mss (1-indexed físico)
+        mss_monitor_index = monitor_number + 1
+        monitor_region = sct.monitors[mss_monitor_index]
+        log.debug("Capturando el monitor %s (región: %s)...", monitor_number, monitor_region)
+    else:
+        # Capturar todos los monitores (monitors[0] es la región de todos los monitores combinados)
+        monitor_region = sct.monitors[0]
+        log.debug("Capturando todos los monitores (área combinada)...")
+
+    if region is not None:
+        x, y, width, height = region
+        right = min(x + width, monitor_region["width"])
+        bottom = min(y + height, monitor_region["height"])
+        if x < 0 or y < 0 or right <= x or bottom <= y:
+            raise ValueError(f"Región ({x},{y},{width},{height}) fuera de los límites del monitor o inválida.")
+        monitor_region = {
+            "left": monitor_region["left"] + x,
+            "top": monitor_region["top"] + y,
+            "width": right - x,
+            "height": bottom - y,
+        }
+
+    return sct.grab(monitor_region)
+
+
+def take_screenshot(monitor_number: Optional[int] = None, region: Optional[tuple] = None) -> Optional[Image.Image]:
     """
     Toma una captura de pantalla.
     Args:
         monitor_number (int, optional): Índice del monitor a capturar (0 para el primer monitor físico, 1 para el segundo, etc.).
                                         Si es None, captura todos los monitores como una sola imagen (combinada por MSS).
+        region (tuple, optional): (x, y, ancho, alto) relativos al monitor: solo se captura esa zona.
     Returns:
         PIL.Image.Image: La imagen de la captura de pantalla, o None si falla.
-    Raises:
-        ValueError: Si el número de monitor es inválido.
     """
     try:
-        with mss() as sct:
-            # monitors[0] es la pantalla combinada de todos los monitores.
-            # monitors[1], monitors[2], etc., son los monitores individuales físicos.
-            # Por lo tanto, el monitor_number proporcionado por el usuario (0-indexed para monitores físicos)
-            # debe mapearse a mss_monitor_index = monitor_number + 1.
-            
-            # Si solo hay un monitor físico (monitors[0] y monitors[1] disponibles), len(monitors) será 2.
-            # Los IDs de monitor físico utilizables serán del 0 al len(monitors) - 2.
-            num_physical_monitors = len(sct.monitors) - 1 # Excluye el monitor[0] que es el área combinada
-
-            if monitor_number is not None:
-                if not (0 <= monitor_number < num_physical_monitors):
-                    print(f"ERROR: Número de monitor inválido: {monitor_number}. Monitores físicos disponibles: 0 a {num_physical_monitors - 1}.")
-                    print(f"DEBUG: 'monitors' de mss contiene {len(sct.monitors)} elementos (monitors[0] es el área combinada de todos los monitores físicos).")
-                    raise ValueError(
-                        f"Número de monitor inválido: {monitor_number}. Monitores físicos disponibles: 0 a {num_physical_monitors - 1}."
-                        " (0 es el primer monitor físico, 1 el segundo, etc.)"
-                    )
-                # Mapear el índice proporcionado (0-indexed físico) al índice de mss (1-indexed físico)
-                mss_monitor_index = monitor_number + 1
-                monitor_region = sct.monitors[mss_monitor_index]
-                print(f"DEBUG: Capturando el monitor {monitor_number} (región: {monitor_region})...")
-            else:
-                # Capturar todos los monitores (monitors[0] es la región de todos los monitores combinados)
-                monitor_region = sct.monitors[0]
-                print("DEBUG: Capturando todos los monitores (área combinada)...")
-
-            sct_img = sct.grab(monitor_region)
-            # Convertir la imagen de mss a un objeto PIL.Image
-            img = Image.frombytes("RGB", sct_img.size, sct_img.bgra, "raw", "BGRX")
-            print("DEBUG: Captura de pantalla realizada con éxito.")
-            return img
+        sct_img = _grab(monitor_number, region)
+        # Convertir la imagen de mss a un objeto PIL.Image
+        img = Image.frombytes("RGB", sct_img.size, sct_img.bgra, "raw", "BGRX")
+        log.debug("Captura de pantalla realizada con éxito.")
+        return img
     except ValueError as ve:
-        print(f"ERROR al tomar captura de pantalla: {ve}", file=sys.stderr)
+        log.error("Error al tomar captura de pantalla: %s", ve)
         return None
     except Exception as e:
-        print(f"ERROR inesperado al tomar captura de pantalla: {e}", file=sys.stderr)
-        traceback.print_exc() # Imprime el stack trace para depuración
+        log.exception("Error inesperado al tomar captura de pantalla: %s", e)
+        return None
+
+
+def take_screenshot_array(monitor_number: Optional[int] = None) -> Optional[np.ndarray]:
+    """
+    Igual que take_screenshot, pero devuelve la captura como np.ndarray BGRA (alto, ancho, 4)
+    que comparte memoria con el buffer de mss: sin conversión a RGB ni objeto PIL intermedio.
+    Es el formato que find_image_on_screen consume directamente.
+    Args:
+        monitor_number (int, optional): Índice del monitor a capturar (ver take_screenshot).
+    Returns:
+        np.ndarray: La captura en BGRA (uint8), o None si falla.
+    """
+    try:
+        sct_img = _grab(monitor_number)
+        # Vista directa sobre los bytes BGRA de mss (contigua: OpenCV la usa sin copiar)
+        img = np.frombuffer(sct_img.raw, dtype=np.uint8).reshape(sct_img.height, sct_img.width, 4)
+        log.debug("Captura de pantalla realizada con éxito.")
+        return img
+    except ValueError as ve:
+        log.error("Error al tomar captura de pantalla: %s", ve)
+        return None
+    except Exception as e:
+        log.exception("Error inesperado al tomar captura de pantalla: %s", e)
+        return None
+
+def take_screenshot_gray(monitor_number: Optional[int] = None) -> Optional[np.ndarray]:
+    """
+    Captura el monitor y la devuelve ya en escala de grises (uint8, alto x ancho), el formato con el que
+    trabaja find_image_on_screen: quien reutiliza la misma captura en varias búsquedas convierte una sola vez.
+    Args:
+        monitor_number (int, optional): Índice del monitor a capturar (ver take_screenshot).
+    Returns:
+        np.ndarray: La captura en grises, o None si falla.
+    """
+    image = take_screenshot_array(monitor_number)
+    return None if image is None else cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+
+class Box(NamedTuple):
+    """Región encontrada en la captura (mismos campos que el 'Box' de PyAutoGUI, más right/bottom)."""
+    left: int
+    top: int
+    width: int
+    height: int
+
+    @property
+    def right(self) -> int:
+        return self.left + self.width
+
+    @property
+    def bottom(self) -> int:
+        return self.top + self.height
+
+
+# Parámetros de la búsqueda piramidal
+MAX_PYRAMID_LEVELS = 2    # Dos pyrDown: la búsqueda gruesa procesa 16 veces menos píxeles
+MIN_TEMPLATE_SIDE = 12    # No reducir el template por debajo de este lado (px) o la búsqueda gruesa pierde detalle
+COARSE_TOP_K = 5          # Candidatos de la etapa gruesa que se refinan a resolución completa
+COARSE_THRESHOLD_FACTOR = 0.7  # Umbral de la etapa gruesa relativo a 'confidence'
+REFINE_MARGIN = 16        # Margen (px a resolución completa) alrededor de cada candidato al refinar
+# Escalas alternativas del template que se prueban solo si no se encuentra a tamaño original
+# (p. ej. recortes tomados con otro escalado de pantalla/DPI)
+FALLBACK_SCALES = (0.9, 1.1)
+
+
+def _to_gray(image: Union[str, Image.Image, np.ndarray]) -> Optional[np.ndarray]:
+    """
+    Convierte la captura a escala de grises (uint8).
+    Acepta una ruta de archivo, un PIL.Image o un np.ndarray (BGR, BGRA o ya en grises).
+    """
+    if isinstance(image, str):
+        return cv2.imread(image, cv2.IMREAD_GRAYSCALE)
+    if isinstance(image, Image.Image):
+        return np.asarray(image.convert("L"))
+    if image.ndim == 2:
+        return image
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def _pyramid_levels(template_shape: tuple) -> int:
+    """Número de niveles de pirámide que admite el template sin quedar por debajo de MIN_TEMPLATE_SIDE."""
+    levels = 0
+    min_side = min(template_shape[:2])
+    while levels < MAX_PYRAMID_LEVELS and (min_side >> (levels + 1)) >= MIN_TEMPLATE_SIDE:
+        levels += 1
+    return levels
+
+
+def _top_peaks(result: np.ndarray, k: int, threshold: float, suppress_shape: tuple) -> list:
+    """
+    Devuelve hasta 'k' máximos (x, y, score) de un mapa de matchTemplate por encima de 'threshold',
+    suprimiendo el vecindario de cada máximo para no devolver el mismo objeto varias veces.
+    """
+    peaks = []
+    half_h, half_w = suppress_shape[0] // 2 + 1, suppress_shape[1] // 2 + 1
+    for _ in range(k):
+        _, max_val, _, (x, y) = cv2.minMaxLoc(result)
+        if max_val < threshold:
+            break
+        peaks.append((x, y, max_val))
+        result[max(0, y - half_h):y + half_h, max(0, x - half_w):x + half_w] = -1.0
+    return peaks
+
+
+def _match_template(screenshot_gray: np.ndarray, template_gray: np.ndarray, confidence: float) -> Optional[Box]:
+    """
+    Búsqueda gruesa-fina: matchTemplate (TM_CCOEFF_NORMED) sobre la pirámide reducida para obtener
+    candidatos, y refinado a resolución completa solo en una ventana pequeña alrededor de cada uno.
+    """
+    shot_h, shot_w = screenshot_gray.shape[:2]
+    tpl_h, tpl_w = template_gray.shape[:2]
+    if tpl_h > shot_h or tpl_w > shot_w:
         return None
 
-def find_image_on_screen(template_image_path: str, screenshot_image: Image.Image, confidence: float = 0.9):
+    levels = _pyramid_levels(template_gray.shape)
+    if levels == 0:
+        # Template demasiado pequeño para reducirlo: búsqueda directa a resolución completa
+        result = cv2.matchTemplate(screenshot_gray, template_gray, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, (x, y) = cv2.minMaxLoc(result)
+        return Box(x, y, tpl_w, tpl_h) if max_val >= confidence else None
+
+    # Etapa gruesa
+    small_shot, small_tpl = screenshot_gray, template_gray
+    for _ in range(levels):
+        small_shot = cv2.pyrDown(small_shot)
+        small_tpl = cv2.pyrDown(small_tpl)
+    if small_tpl.shape[0] > small_shot.shape[0] or small_tpl.shape[1] > small_shot.shape[1]:
+        return None
+    coarse = cv2.matchTemplate(small_shot, small_tpl, cv2.TM_CCOEFF_NORMED)
+    np.nan_to_num(coarse, copy=False, nan=-1.0, posinf=-1.0, neginf=-1.0) # Zonas planas pueden dar NaN
+    candidates = _top_peaks(coarse, COARSE_TOP_K, COARSE_THRESHOLD_FACTOR * confidence, small_tpl.shape)
+
+    # Etapa fina: solo en una ventana alrededor de cada candidato
+    scale = 1 << levels
+    margin = max(REFINE_MARGIN, scale * 2)
+    best = None
+    for cx, cy, _ in candidates:
+        x0, y0 = max(0, cx * scale - margin), max(0, cy * scale - margin)
+        x1, y1 = min(shot_w, cx * scale + tpl_w + margin), min(shot_h, cy * scale + tpl_h + margin)
+        roi = screenshot_gray[y0:y1, x0:x1]
+        if roi.shape[0] < tpl_h or roi.shape[1] < tpl_w:
+            continue
+        fine = cv2.matchTemplate(roi, template_gray, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, (x, y) = cv2.minMaxLoc(fine)
+        if best is None or max_val > best[0]:
+            best = (max_val, x0 + x, y0 + y)
+
+    if best is not None and best[0] >= confidence:
+        return Box(best[1], best[2], tpl_w, tpl_h)
+    return None
+
+
+def find_image_on_screen(template_image_path: str, screenshot_image: Union[str, Image.Image, np.ndarray], confidence: float = 0.9) -> Optional[Box]:
     """
     Busca una imagen (template) dentro de una imagen de captura de pantalla.
+    Usa OpenCV matchTemplate sobre una pirámide en escala de grises (búsqueda gruesa + refinado local).
     Args:
         template_image_path (str): Ruta al archivo de imagen del recorte (template a buscar).
-        screenshot_image (PIL.Image.Image): El objeto PIL.Image de la captura de pantalla completa o del monitor.
+        screenshot_image: La captura de pantalla completa o del monitor: PIL.Image, np.ndarray (BGR/BGRA/grises)
+                          o ruta a un archivo de imagen.
         confidence (float): Nivel de confianza para la detección de la imagen (0.0 a 1.0).
     Returns:
-        tuple: Coordenadas (left, top, width, height) de la imagen encontrada, o None si no se encuentra.
-               Es el mismo formato de 'Box' que usa PyAutoGUI.
+        Box: Coordenadas (left, top, width, height) de la imagen encontrada, o None si no se encuentra.
+             Mismos campos que el 'Box' de PyAutoGUI, con 'right' y 'bottom' adicionales.
     """
     try:
-        if not os.path.exists(template_image_path):
-            print(f"ERROR: El archivo de imagen template '{template_image_path}' no existe.", file=sys.stderr)
+        # El recorte se decodifica una sola vez y se reutiliza mientras el archivo no cambie
+        # (load_template ya consulta el mtime del archivo: no hace falta otro os.path.exists)
+        template = load_template(template_image_path)
+        if template is None:
+            log.error("El archivo de imagen template '%s' no existe o no se pudo leer.", template_image_path)
             return None
 
-        print(f"DEBUG: Buscando '{os.path.basename(template_image_path)}' en la captura con confianza {confidence}...")
-        
-        # pyscreeze.locate puede tomar un objeto PIL.Image como 'haystackImage'
-        # El primer argumento es siempre la ruta del template.
-        location = pyscreeze.locate(template_image_path, screenshot_image, confidence=confidence)
+        screenshot_gray = _to_gray(screenshot_image)
+        if screenshot_gray is None:
+            log.error("No se pudo leer la captura de pantalla '%s'.", screenshot_image)
+            return None
+
+        log.debug("Buscando '%s' en la captura con confianza %s...", os.path.basename(template_image_path), confidence)
+        location = _match_template(screenshot_gray, template.gray, confidence)
+        for scale in FALLBACK_SCALES:
+            if location:
+                break
+            scaled_gray = load_scaled_template(template_image_path, scale)
+            if scaled_gray is not None:
+                location = _match_template(screenshot_gray, scaled_gray, confidence)
+                if location:
+                    log.debug("Recorte encontrado reescalado a %sx.", scale)
         
         if location:
-            print(f"DEBUG: Recorte '{os.path.basename(template_image_path)}' encontrado en la pantalla en: {location}")
-            return location # Retorna un objeto Box de PyAutoGUI
+            log.debug("Recorte '%s' encontrado en la pantalla en: %s", os.path.basename(template_image_path), location)
+            return location
         else:
-            print(f"DEBUG: Recorte '{os.path.basename(template_image_path)}' NO encontrado en la pantalla con confianza {confidence}.")
+            log.debug("Recorte '%s' NO encontrado en la pantalla con confianza %s.", os.path.basename(template_image_path), confidence)
             return None
-    except pyscreeze.PyScreezeException as e:
-        print(f"ERROR al buscar imagen '{template_image_path}' con pyscreeze: {e}.", file=sys.stderr)
-        print("Asegúrate de que los archivos de imagen existan y sean válidos.", file=sys.stderr)
-        traceback.print_exc() # Imprime el stack trace para depuración
-        return None
     except Exception as e:
-        print(f"ERROR inesperado en find_image_on_screen: {e}", file=sys.stderr)
-        traceback.print_exc() # Imprime el stack trace para depuración
+        log.exception("Error inesperado en find_image_on_screen: %s", e)
         return None
 
+def find_image_near(template_image_path: str, screenshot_image: Union[Image.Image, np.ndarray], box: Box,
+                    confidence: float = 0.9, margin: int = 8) -> Optional[Box]:
+    """
+    Comprueba si el recorte sigue en (o muy cerca de) una posición conocida: matchTemplate solo sobre
+    'box' ampliada 'margin' píxeles, en lugar de sobre la captura completa.
+    Args:
+        template_image_path (str): Ruta al archivo de imagen del recorte.
+        screenshot_image: Captura del monitor (PIL.Image o np.ndarray BGR/BGRA/grises).
+        box (Box): Posición donde se encontró el recorte la última vez.
+        confidence (float): Nivel de confianza mínimo (0.0 a 1.0).
+        margin (int): Píxeles de holgura alrededor de 'box' (pequeños desplazamientos de la ventana).
+    Returns:
+        Box: Posición actual del recorte, o None si ya no está ahí.
+    """
+    template = load_template(template_image_path)
+    screenshot_gray = _to_gray(screenshot_image)
+    if template is None or screenshot_gray is None:
+        return None
+    tpl_h, tpl_w = template.gray.shape[:2]
+    x0, y0 = max(0, box.left - margin), max(0, box.top - margin)
+    roi = screenshot_gray[y0:box.top + tpl_h + margin, x0:box.left + tpl_w + margin]
+    if roi.shape[0] < tpl_h or roi.shape[1] < tpl_w:
+        return None
+    result = cv2.matchTemplate(roi, template.gray, cv2.TM_CCOEFF_NORMED)
+    _, max_val, _, (x, y) = cv2.minMaxLoc(result)
+    return Box(x0 + x, y0 + y, tpl_w, tpl_h) if max_val >= confidence else None
+
+# La topología de monitores casi nunca cambia, pero Streamlit la consulta varias veces en cada rerun:
+# se cachea unos segundos (lo bastante pocos como para detectar un monitor conectado en caliente)
+MONITOR_INFO_TTL = 30.0
+_monitor_info_cache = (0.0, None) # (instante de la consulta, lista de monitores)
+
+
 def get_monitor_info() -> list:
     """
-    Obtiene información sobre los monitores conectados.
+    Obtiene información sobre los monitores conectados (cacheada MONITOR_INFO_TTL segundos).
     Returns:
         list: Una lista de diccionarios, cada uno con información de un monitor.
               El índice 'id' corresponde al primer monitor físico (0, 1, etc.).
     """
+    global _monitor_info_cache
+    queried_at, cached = _monitor_info_cache
+    if cached is not None and time.monotonic() - queried_at < MONITOR_INFO_TTL:
+        return [dict(m) for m in cached] # Copias: quien llama puede modificarlas sin tocar la caché
     try:
         monitors_info = []
         monitors = screeninfo.get_monitors()
@@ -118,11 +364,11 @@ def get_monitor_info() -> list:
                 "is_primary": m.is_primary,
                 "name": m.name if hasattr(m, 'name') else f"Monitor {i}"
             })
-        print("DEBUG: Información de monitores obtenida.")
-        return monitors_info
+        log.debug("Información de monitores obtenida.")
+        _monitor_info_cache = (time.monotonic(), monitors_info)
+        return [dict(m) for m in monitors_info]
     except Exception as e:
-        print(f"ERROR al obtener información de los monitores: {e}", file=sys.stderr)
-        traceback.print_exc() # Imprime el stack trace para depuración
+        log.exception("Error al obtener información de los monitores: %s", e)
         return []
 
 # Ejemplo de uso (para pruebas directas de este módulo)
@@ -0,0 +1,98 @@
+import functools
+import os
+from typing import NamedTuple, Optional
+
+import cv2
+import numpy as np
+
+from utils.cache_utils import DiskArrayCache
+
+# Recortes ya decodificados en disco (.npy): en un proceso nuevo se proyectan en memoria en lugar de volver
+# a descomprimir el PNG. La clave incluye la ruta y el mtime, así que un recorte sobrescrito no reutiliza
+# la versión anterior.
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", os.path.join("cache", "templates"))
+_disk_cache = DiskArrayCache(TEMPLATE_CACHE_DIR, namespace="template")
+
+
+class Template(NamedTuple):
+    """Recorte (template) decodificado y listo para la búsqueda en pantalla."""
+    bgr: np.ndarray   # Imagen en color (BGR, formato nativo de OpenCV)
+    gray: np.ndarray  # Versión en escala de grises precalculada
+
+
+@functools.lru_cache(maxsize=256)
+def _load(path: str, mtime: float) -> Optional[Template]:
+    """
+    Decodifica el recorte desde disco. 'mtime' forma parte de la clave de la caché,
+    de modo que si el archivo se sobrescribe se vuelve a leer automáticamente.
+    """
+    key = f"{path}\0{mtime}"
+    bgr = _disk_cache.get(key + "\0bgr", mmap_mode="r")
+    gray = _disk_cache.get(key + "\0gray", mmap_mode="r")
+    if bgr is not None and gray is not None:
+        return Template(bgr, gray) # Proyecciones de solo lectura
+
+    bgr = cv2.imread(path, cv2.IMREAD_COLOR)
+    if bgr is None:
+        return None
+    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+    _disk_cache.put(key + "\0bgr", bgr)
+    _disk_cache.put(key + "\0gray", gray)
+    # Las matrices se comparten entre llamadas: congelarlas para evitar modificaciones accidentales
+    bgr.setflags(write=False)
+    gray.setflags(write=False)
+    return Template(bgr, gray)
+
+
+def load_template(path: str) -> Optional[Template]:
+    """
+    Devuelve el recorte de 'path' decodificado, reutilizando la versión cacheada
+    mientras el archivo no cambie en disco.
+    Args:
+        path (str): Ruta al archivo de imagen del recorte.
+    Returns:
+        Template: Imágenes BGR y en escala de grises, o None si el archivo no existe o no es una imagen válida.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    return _load(os.path.abspath(path), mtime)
+
+
+@functools.lru_cache(maxsize=512)
+def _load_scaled(path: str, mtime: float, scale: float) -> Optional[np.ndarray]:
+    """Versión en grises del recorte reescalada por 'scale' (cacheada igual que _load)."""
+    template = _load(path, mtime)
+    if template is None:
+        return None
+    h, w = template.gray.shape[:2]
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    # INTER_AREA al reducir (evita aliasing), INTER_LINEAR al ampliar
+    interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR
+    scaled = cv2.resize(template.gray, size, interpolation=interpolation)
+    scaled.setflags(write=False)
+    return scaled
+
+
+def load_scaled_template(path: str, scale: float) -> Optional[np.ndarray]:
+    """
+    Devuelve el recorte de 'path' en escala de grises reescalado por 'scale', para buscar
+    elementos de UI cuando el escalado de pantalla (DPI) difiere del que había al recortarlos.
+    Args:
+        path (str): Ruta al archivo de imagen del recorte.
+        scale (float): Factor de escala (1.0 = tamaño original).
+    Returns:
+        np.ndarray: Imagen en grises reescalada, o None si el archivo no existe o no es una imagen válida.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    return _load_scaled(os.path.abspath(path), mtime, round(scale, 3))
+
+
+def clear_template_cache() -> None:
+    """Descarta todos los recortes cacheados."""
+    _load.cache_clear()
+    _load_scaled.cache_clear()
@@ -0,0 +1,64 @@
+"""
+Calentamiento previo al despliegue (p. ej. en la construcción de la imagen o antes de arrancar Streamlit).
+
+- Compila a bytecode todos los módulos del proyecto.
+- Descarga/carga el modelo de embeddings y precalcula en la caché en disco (EMBEDDING_CACHE_DIR)
+  los embeddings de las descripciones de los recortes almacenados en Qdrant.
+- Abre las conexiones con OpenAI y Qdrant (AutomationAgent._warmup).
+
+Uso: python warmup.py
+"""
+import compileall
+import os
+import sys
+import time
+
+# El calentamiento se hace aquí de forma síncrona, no en el hilo de fondo del agente
+os.environ.setdefault("AGENT_WARMUP", "false")
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _stored_descriptions(qdrant_handler, batch_size: int = 256) -> list:
+    """Devuelve las descripciones de todos los recortes de la colección."""
+    descriptions = []
+    offset = None
+    while True:
+        points, offset = qdrant_handler.client.scroll(
+            collection_name=qdrant_handler.COLLECTION_NAME,
+            limit=batch_size,
+            offset=offset,
+            with_payload=["description"],
+            with_vectors=False,
+        )
+        descriptions.extend(p.payload["description"] for p in points if p.payload and p.payload.get("description"))
+        if offset is None:
+            return descriptions
+
+
+def main() -> int:
+    start = time.perf_counter()
+
+    print("Compilando módulos a bytecode...")
+    compileall.compile_dir(PROJECT_DIR, quiet=1)
+
+    # Importar el agente carga el modelo de embeddings y conecta con Qdrant
+    import automation_agent
+
+    try:
+        descriptions = _stored_descriptions(automation_agent.qdrant_handler)
+        if descriptions:
+            automation_agent.image_processor.generate_embeddings_from_texts(descriptions)
+        print(f"Embeddings precalculados para {len(descriptions)} descripciones de recortes.")
+    except Exception as e:
+        print(f"Advertencia: No se pudieron precalcular los embeddings de los recortes: {e}")
+
+    agent = automation_agent.AutomationAgent()
+    agent._warmup()
+
+    print(f"Calentamiento completado en {time.perf_counter() - start:.1f} s.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())